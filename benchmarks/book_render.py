@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+"""book_render.py
+
+render a synthetic book like list-offers does, marking our offers
+with the nicks of the active robots computed for every offer or once
+
+python3 benchmarks/book_render.py [offers] [active-robots] [coordinators]
+"""
+
+# pylint: disable=C0116 missing-function-docstring
+# pylint: disable=C0413 wrong-import-position
+
+import os
+import sys
+import io
+import time
+import random
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from roboauto.global_state import roboauto_state
+from roboauto.utils import global_setup, file_write
+from roboauto.order_local import get_offer_dic
+from roboauto.book import get_offers_unsorted, list_offers_general
+
+
+def robots_create(robots_number):
+    nicks = []
+    for i in range(robots_number):
+        robot_name = f"BenchmarkRobot{i}"
+        robot_dir = roboauto_state["active_home"] + "/" + robot_name
+        os.makedirs(robot_dir)
+        file_write(robot_dir + "/token", f"token{i}")
+        file_write(robot_dir + "/coordinator", "tos")
+        nicks.append(robot_name)
+
+    return nicks
+
+
+def book_create(offers_number, coordinators_number, our_nicks):
+    multi_book_response_json = []
+    for coordinator_index in range(coordinators_number):
+        offers = []
+        for i in range(offers_number // coordinators_number):
+            if random.random() < 0.3:
+                maker_nick = random.choice(our_nicks)
+            else:
+                maker_nick = f"SomeoneElse{coordinator_index}x{i}"
+            amount = random.randint(20, 2000)
+            offers.append({
+                "id": coordinator_index * offers_number + i,
+                "expires_at": "2024-06-01T12:30:00.000000Z",
+                "type": random.randint(0, 1),
+                "currency": random.choice((1, 2, 3)),
+                "amount": str(amount),
+                "has_range": random.random() < 0.5,
+                "min_amount": str(amount),
+                "max_amount": str(amount * 2),
+                "payment_method": "Revolut SEPA",
+                "premium": str(round(random.uniform(-3, 8), 2)),
+                "escrow_duration": 28800,
+                "bond_size": "3.00",
+                "maker_nick": maker_nick,
+                "maker_status": "Active"
+            })
+        multi_book_response_json.append({
+            "offers": offers,
+            "coordinator": f"c{coordinator_index:02d}"
+        })
+
+    return multi_book_response_json
+
+
+def benchmark(name, function):
+    starting_time = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function()
+    elapsed_time = time.perf_counter() - starting_time
+    print(f"{name:<32} {elapsed_time * 1000:10.2f} ms")
+
+
+def main(argv):
+    offers_number = int(argv[0]) if len(argv) > 0 else 500
+    robots_number = int(argv[1]) if len(argv) > 1 else 300
+    coordinators_number = int(argv[2]) if len(argv) > 2 else 5
+
+    random.seed(0)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if not global_setup(temp_dir + "/config", temp_dir + "/data"):
+            return False
+
+        our_nicks = robots_create(robots_number)
+        multi_book_response_json = book_create(
+            offers_number, coordinators_number, our_nicks
+        )
+
+        print(
+            f"{offers_number} offers, {robots_number} active robots, " +
+            f"{coordinators_number} coordinators"
+        )
+
+        def offers_nicks_every_offer():
+            for book in multi_book_response_json:
+                for offer in book["offers"]:
+                    get_offer_dic(offer, book["coordinator"])
+
+        benchmark("offers, nicks every offer", offers_nicks_every_offer)
+        benchmark("offers, nicks once", lambda: [
+            get_offers_unsorted(multi_book_response_json, book_type, "all")
+            for book_type in (0, 1)
+        ])
+        benchmark("list-offers render", lambda: [
+            list_offers_general(multi_book_response_json, book_type, "all")
+            for book_type in (0, 1)
+        ])
+
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(sys.argv[1:]) else 1)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+"""date_parse.py
+
+convert robosats expires_at dates to timestamps and local hours with
+time.strptime, like date_utils did before, and with the fast path and
+the caches of date_utils, checking that the results are the same
+
+the cold run uses distinct dates, the warm run the dates of the book,
+few distinct dates converted many times
+
+python3 benchmarks/date_parse.py [dates]
+"""
+
+# pylint: disable=C0116 missing-function-docstring
+# pylint: disable=C0413 wrong-import-position
+
+import os
+import sys
+import time
+import random
+import calendar
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from roboauto.date_utils import \
+    time_strptime_understand_format, timestamp_from_date_string, \
+    get_hour_from_date_string, get_hour_from_quarter
+
+
+def strptime_timestamp_hour(date_string):
+    """timestamp and local hour as computed before the fast path"""
+    date_time = time_strptime_understand_format(date_string)
+    if date_time is False:
+        return False
+    timestamp = calendar.timegm(date_time)
+    hour = int(time.strftime("%H", time.localtime(timestamp)))
+    return timestamp, hour
+
+
+def fast_timestamp_hour(date_string):
+    return timestamp_from_date_string(date_string), get_hour_from_date_string(date_string)
+
+
+def dates_create(dates_number, distinct_number):
+    starting_timestamp = int(time.time())
+    distinct_dates = [
+        time.strftime(
+            "%Y-%m-%dT%H:%M:%S", time.gmtime(starting_timestamp + random.randint(0, 86400))
+        ) + f".{random.randint(0, 999999):06d}Z"
+        for _ in range(distinct_number)
+    ]
+    return [random.choice(distinct_dates) for _ in range(dates_number)]
+
+
+def benchmark(name, function, dates):
+    timestamp_from_date_string.cache_clear()
+    get_hour_from_quarter.cache_clear()
+
+    starting_time = time.perf_counter()
+    results = [function(date_string) for date_string in dates]
+    elapsed = time.perf_counter() - starting_time
+
+    print(f"{name:<24} {elapsed * 1000:10.2f} ms {elapsed / len(dates) * 1e6:8.3f} us/date")
+
+    return results
+
+
+def main(argv):
+    dates_number = int(argv[0]) if len(argv) >= 1 else 100000
+
+    return_status = True
+
+    for run_name, distinct_number in (("cold", dates_number), ("warm", 500)):
+        dates = dates_create(dates_number, distinct_number)
+
+        results_strptime = benchmark(f"{run_name} strptime", strptime_timestamp_hour, dates)
+        results_fast = benchmark(f"{run_name} fast", fast_timestamp_hour, dates)
+
+        if results_strptime != results_fast:
+            print(f"error: {run_name} results are different", file=sys.stderr)
+            return_status = False
+
+    return return_status
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(sys.argv[1:]) else 1)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+"""import_time.py
+
+run local actions of bin/roboauto with python -X importtime, print the
+time spent importing and fail if an action imports a module that it
+should not need, like requests, gnupg, nostr_sdk or filelock
+
+python3 benchmarks/import_time.py [--max-ms=milliseconds] [--verbose]
+"""
+
+# pylint: disable=C0116 missing-function-docstring
+
+import os
+import sys
+import subprocess
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ("requests", "gnupg", "nostr_sdk", "filelock")
+
+LOCAL_ACTIONS = (
+    ("print-data-directory",),
+    ("list-configs",),
+    ("list-currencies",),
+    ("invoice-amount-calculate", "10000"),
+    ("list-active",),
+    ("list-waiting-queue",),
+    ("print-token", "BenchmarkRobot"),
+    ("order-summary", "--active"),
+    ("list-hours",)
+)
+
+
+def import_time_get(action, config_dir, data_dir):
+    """return the total import time in microseconds and the top level
+    modules imported by running the action"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT_DIR + os.pathsep + env.get("PYTHONPATH", "")
+    process = subprocess.run(
+        [
+            sys.executable, "-X", "importtime",
+            ROOT_DIR + "/bin/roboauto", "--no-daemon",
+            "--config-dir", config_dir, "--data-dir", data_dir
+        ] + list(action),
+        env=env, capture_output=True, text=True, check=False
+    )
+
+    total_us = 0
+    modules = set()
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line.split("|")
+        try:
+            self_us = int(fields[0].split(":", 1)[1])
+        except (ValueError, IndexError):
+            continue
+        total_us += self_us
+        modules.add(fields[2].strip().split(".")[0])
+
+    return total_us, modules
+
+
+def main(argv):
+    max_ms = None
+    verbose = False
+    for arg in argv:
+        if arg.startswith("--max-ms="):
+            max_ms = float(arg.split("=", 1)[1])
+        elif arg == "--verbose":
+            verbose = True
+        else:
+            print(f"error: option {arg} not recognized", file=sys.stderr)
+            return False
+
+    return_status = True
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config_dir = temp_dir + "/config"
+        data_dir = temp_dir + "/data"
+        robot_dir = data_dir + "/active/BenchmarkRobot"
+        os.makedirs(config_dir)
+        os.makedirs(robot_dir)
+        for file_name, content in (("token", "token"), ("coordinator", "tos")):
+            with open(robot_dir + "/" + file_name, "w", encoding="utf8") as file:
+                file.write(content + "\n")
+
+        for action in LOCAL_ACTIONS:
+            total_us, modules = import_time_get(action, config_dir, data_dir)
+            heavy_imported = sorted(set(HEAVY_MODULES) & modules)
+
+            print(f"{' '.join(action):<32} {total_us / 1000:8.2f} ms")
+            if verbose:
+                print("    " + " ".join(sorted(modules)))
+
+            if len(heavy_imported) > 0:
+                print(
+                    f"error: {action[0]} imports {' '.join(heavy_imported)}",
+                    file=sys.stderr
+                )
+                return_status = False
+            if max_ms is not None and total_us / 1000 > max_ms:
+                print(
+                    f"error: {action[0]} imports take more than {max_ms} ms",
+                    file=sys.stderr
+                )
+                return_status = False
+
+    return return_status
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(sys.argv[1:]) else 1)
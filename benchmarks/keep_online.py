@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+"""keep_online.py
+
+run keep-online against synthetic robots on local mock coordinators,
+benchmarks/mock_coordinator.py, paying the bonds with
+benchmarks/lightning_node_mock.py, and report the time of the rounds,
+the requests made for every robot and the cpu used
+
+every robot starts with make data, so in the first round all the
+orders are made and bonded, they expire after public-seconds and
+are made again in the following rounds
+
+python3 benchmarks/keep_online.py [robots] [coordinators] [rounds]
+    [--round-seconds=seconds] [--engine=sync|async]
+    [--latency=seconds] [--error-rate=rate]
+    [--public-seconds=seconds] [--take-rate=rate]
+    [--worker] [--verbose]
+"""
+
+# pylint: disable=C0116 missing-function-docstring
+# pylint: disable=C0413 wrong-import-position
+
+import os
+import sys
+import io
+import json
+import time
+import socket
+import resource
+import tempfile
+import contextlib
+import subprocess
+import urllib.request
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+from mock_coordinator import robot_nickname_get
+from roboauto.global_state import roboauto_state
+from roboauto.utils import \
+    global_setup, global_shutdown, update_roboauto_options, \
+    file_write, token_get_base91, generate_random_token_base62
+from roboauto.order_local import get_order_data, robot_order_set_local_make_data
+from roboauto.metrics import metrics_get
+from roboauto.keep_online import keep_online_no_lock, keep_online_async_no_lock
+
+
+def port_free_get():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as free_socket:
+        free_socket.bind(("127.0.0.1", 0))
+        return free_socket.getsockname()[1]
+
+
+def mock_coordinators_start(coordinators_number, mock_args):
+    """start the mock coordinators and wait until they are listening,
+    return their processes and ports"""
+    mocks = []
+    for _ in range(coordinators_number):
+        port = port_free_get()
+        # pylint: disable=R1732 consider-using-with
+        process = subprocess.Popen(
+            [
+                sys.executable, BENCHMARKS_DIR + "/mock_coordinator.py",
+                f"--port={port}"
+            ] + mock_args,
+            stdout=subprocess.PIPE, text=True
+        )
+        mocks.append((process, port))
+
+    for process, port in mocks:
+        if not process.stdout.readline().startswith("listening"):
+            print(f"error: mock coordinator on port {port} not started", file=sys.stderr)
+            return mocks, False
+
+    return mocks, True
+
+
+def mock_coordinators_stop(mocks):
+    for process, _ in mocks:
+        process.terminate()
+    for process, _ in mocks:
+        process.wait()
+        process.stdout.close()
+
+
+def mock_stats_get(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/mock/stats/", timeout=10) as response:
+        return json.loads(response.read())
+
+
+def config_write(config_dir, robots_number, ports, worker):
+    config = f"""\
+[general]
+order_maximum = {robots_number * 2}
+active_interval = 10
+pending_interval = 10
+urgent_interval = 2
+pay_interval = 1
+error_interval = 1
+lightning_node_worker = {"true" if worker else "false"}
+"""
+    for i, port in enumerate(ports):
+        config += f"""
+[federation.mock{i:02d}]
+short_alias = mock{i:02d}
+url = http://127.0.0.1:{port}
+"""
+
+    file_write(config_dir + "/config.ini", config)
+    os.symlink(BENCHMARKS_DIR + "/lightning_node_mock.py", config_dir + "/lightning-node")
+
+
+def robots_create(robots_number, coordinators_number):
+    make_data = get_order_data(
+        0, 1, "100", False, None, None,
+        "Revolut", "1.00", 3600, 28800, "3.00", None, None
+    )
+    for i in range(robots_number):
+        token = generate_random_token_base62()
+        robot_name = robot_nickname_get(token_get_base91(token))
+        robot_dir = roboauto_state["active_home"] + "/" + robot_name
+        os.makedirs(robot_dir)
+        file_write(robot_dir + "/token", token)
+        file_write(robot_dir + "/coordinator", f"mock{i % coordinators_number:02d}")
+        robot_order_set_local_make_data(robot_dir, make_data)
+
+
+def histogram_total(metrics, name):
+    """sum and count of the histogram name, over all its labels"""
+    values = metrics.get(name, {"values": {}})["values"].values()
+    return sum(value["sum"] for value in values), sum(value["count"] for value in values)
+
+
+def counter_total(metrics, name, label=None):
+    """values of the counter name, by the value of label"""
+    totals = {}
+    for labels_key, value in metrics.get(name, {"values": {}})["values"].items():
+        label_value = dict(labels_key).get(label, "")
+        totals[label_value] = totals.get(label_value, 0) + value
+    return totals
+
+
+def report_print(
+    robots_number, rounds, wall_seconds, cpu_self, cpu_children, metrics, mock_stats
+):
+    checks_seconds, checks_number = histogram_total(metrics, "keep_online_check_seconds")
+    _, requests_number = histogram_total(metrics, "requests_seconds")
+    offline_number = sum(stats["offline_number"] for stats in mock_stats)
+    offline_seconds_mean = sum(
+        stats["offline_seconds_mean"] * stats["offline_number"] for stats in mock_stats
+    ) / offline_number if offline_number else 0
+
+    print(f"robots                  {robots_number}")
+    print(f"rounds                  {rounds}")
+    print(f"wall time               {wall_seconds:10.2f} s")
+    print(f"round time              {wall_seconds / max(1, rounds):10.2f} s")
+    print(f"cpu roboauto            {cpu_self:10.2f} s")
+    print(f"cpu lightning-node      {cpu_children:10.2f} s")
+    print(f"checks                  {checks_number}")
+    print(
+        "check time mean         " +
+        f"{checks_seconds / checks_number * 1000 if checks_number else 0:10.2f} ms"
+    )
+    print(f"requests                {requests_number}")
+    print(f"requests per robot      {requests_number / max(1, robots_number):10.2f}")
+    print(f"requests per check      {requests_number / max(1, checks_number):10.2f}")
+    for result, number in sorted(counter_total(metrics, "payments_total", "result").items()):
+        print(f"payments {result:<14} {number}")
+    print(f"orders made             {sum(stats['orders_made'] for stats in mock_stats)}")
+    print(f"orders public           {sum(stats['orders_public'] for stats in mock_stats)}")
+    print(f"orders expired          {sum(stats['orders_expired'] for stats in mock_stats)}")
+    print(f"mock errors             {sum(stats['errors'] for stats in mock_stats)}")
+    print(f"offline after expiry    {offline_seconds_mean:10.2f} s mean")
+    print(
+        "offline after expiry    " +
+        f"{max((stats['offline_seconds_max'] for stats in mock_stats), default=0):10.2f} s max"
+    )
+
+
+def main(argv):
+    numbers = []
+    engine = "sync"
+    round_seconds = 20
+    flags = set()
+    mock_args = []
+    for arg in argv:
+        if arg.isdigit():
+            numbers.append(int(arg))
+        elif arg.startswith("--engine="):
+            engine = arg.split("=", 1)[1]
+            if engine not in ("sync", "async"):
+                print(f"error: engine {engine} should be sync or async", file=sys.stderr)
+                return False
+        elif arg.startswith("--round-seconds="):
+            round_seconds = float(arg.split("=", 1)[1])
+        elif arg.split("=", 1)[0] in (
+            "--latency", "--error-rate", "--public-seconds", "--take-rate"
+        ):
+            mock_args.append(arg)
+        elif arg in ("--worker", "--verbose"):
+            flags.add(arg)
+        else:
+            print(f"error: option {arg} not recognized", file=sys.stderr)
+            return False
+    robots_number, coordinators_number, rounds = (numbers + [100, 4, 3][len(numbers):])[:3]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config_dir = temp_dir + "/config"
+        data_dir = temp_dir + "/data"
+
+        mocks, mocks_started = mock_coordinators_start(coordinators_number, mock_args)
+        try:
+            if not mocks_started:
+                return False
+
+            if not global_setup(config_dir=config_dir, data_dir=data_dir):
+                return False
+            config_write(
+                config_dir, robots_number, [port for _, port in mocks], "--worker" in flags
+            )
+            if not update_roboauto_options():
+                return False
+            roboauto_state["keep_online_round_seconds"] = round_seconds
+            robots_create(robots_number, coordinators_number)
+
+            if engine == "async":
+                keep_online_function = keep_online_async_no_lock
+            else:
+                keep_online_function = keep_online_no_lock
+
+            output = sys.stdout if "--verbose" in flags else io.StringIO()
+            usage_before = resource.getrusage(resource.RUSAGE_SELF)
+            children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            starting_time = time.perf_counter()
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                keep_online_function(True, False, max_rounds=rounds)
+                global_shutdown()
+            wall_seconds = time.perf_counter() - starting_time
+            usage_after = resource.getrusage(resource.RUSAGE_SELF)
+            children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+            mock_stats = [mock_stats_get(port) for _, port in mocks]
+        finally:
+            mock_coordinators_stop(mocks)
+            subprocess.run(
+                ["gpgconf", "--kill", "gpg-agent"],
+                env=dict(os.environ, GNUPGHOME=data_dir + "/gnupg"),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False
+            )
+
+    report_print(
+        robots_number, rounds, wall_seconds,
+        usage_after.ru_utime + usage_after.ru_stime -
+        usage_before.ru_utime - usage_before.ru_stime,
+        children_after.ru_utime + children_after.ru_stime -
+        children_before.ru_utime - children_before.ru_stime,
+        metrics_get(), mock_stats
+    )
+
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(sys.argv[1:]) else 1)
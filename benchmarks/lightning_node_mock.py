@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""lightning_node_mock.py
+
+lightning-node for benchmarks/mock_coordinator.py, the invoices of the
+mock coordinators are lnmock<port>x<order-id>, paying one of them
+tells the coordinator on 127.0.0.1:<port> that the bond is locked
+
+lightning_node_mock.py check invoice amount
+lightning_node_mock.py invoice amount label
+lightning_node_mock.py pay invoice label
+lightning_node_mock.py worker
+
+like a real pay, the pay process does not end when the invoice is
+paid, it waits until roboauto stops it
+"""
+
+# pylint: disable=C0116 missing-function-docstring
+
+import os
+import sys
+import json
+import time
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.request
+
+
+def lightning_check(invoice, amount):
+    return True, f"invoice {invoice} amount {amount} ok"
+
+
+def lightning_invoice(amount, _label):
+    return True, f"lnmockreward{amount}"
+
+
+def lightning_pay(invoice, _label, pay_log=None):
+    """with pay_log, like the worker of the real lightning-node, the
+    payment is started in its own process group and its standard error
+    is written to pay_log"""
+    # pylint: disable=R1732 consider-using-with
+    pay_process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "pay-run", invoice],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=pay_log, start_new_session=pay_log is not None
+    )
+
+    return True, str(pay_process.pid)
+
+
+def lightning_worker_pay(invoice, label):
+    pay_log_fd, pay_log = tempfile.mkstemp()
+    with os.fdopen(pay_log_fd, "w") as pay_log_file:
+        response_ok, response_output = lightning_pay(invoice, label, pay_log_file)
+
+    return response_ok, response_output, pay_log
+
+
+def lightning_pay_run(invoice):
+    """send the payment to the mock coordinator and wait to be stopped"""
+    port = invoice[len("lnmock"):].split("x", 1)[0]
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/mock/pay/",
+        data=json.dumps({"invoice": invoice}).encode("utf8"),
+        headers={"Content-Type": "application/json"},
+        method="POST"
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+    except (urllib.error.URLError, OSError) as e:
+        print(f"error: paying {invoice} {repr(e)}", file=sys.stderr)
+        return False
+
+    time.sleep(3600)
+
+    return True
+
+
+LIGHTNING_ACTIONS = {
+    "check": lightning_check,
+    "invoice": lightning_invoice,
+    "pay": lightning_pay
+}
+
+
+def lightning_worker_handle(request, output_lock):
+    action_function = LIGHTNING_ACTIONS.get(request.get("action", None), None)
+    args = (list(request.get("args", [])) + ["", ""])[:2]
+    response_log = ""
+    if action_function is None:
+        response_ok, response_output = False, ""
+    elif action_function is lightning_pay:
+        response_ok, response_output, response_log = lightning_worker_pay(*args)
+    else:
+        response_ok, response_output = action_function(*args)
+
+    with output_lock:
+        print(json.dumps({
+            "id": request["id"],
+            "ok": response_ok,
+            "output": response_output,
+            "log": response_log
+        }), flush=True)
+
+
+def lightning_worker():
+    """json lines protocol of the lightning-node worker, every request
+    is answered in its own thread"""
+    output_lock = threading.Lock()
+    for request_line in sys.stdin:
+        try:
+            request = json.loads(request_line)
+        except json.JSONDecodeError:
+            print("error: request is not valid json", file=sys.stderr)
+            continue
+        if not isinstance(request, dict) or "id" not in request:
+            print("error: request without id", file=sys.stderr)
+            continue
+        threading.Thread(
+            target=lightning_worker_handle, args=(request, output_lock), daemon=True
+        ).start()
+
+    return True
+
+
+def main(argv):
+    if len(argv) < 1:
+        print("error: insert action", file=sys.stderr)
+        return False
+    action = argv[0]
+
+    if action == "worker":
+        return lightning_worker()
+    if action == "pay-run" and len(argv) >= 2:
+        return lightning_pay_run(argv[1])
+
+    action_function = LIGHTNING_ACTIONS.get(action, None)
+    if action_function is None or len(argv) < 3:
+        print(f"error: action {action} not available", file=sys.stderr)
+        return False
+
+    action_ok, action_output = action_function(argv[1], argv[2])
+    print(action_output, flush=True)
+
+    return action_ok
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(sys.argv[1:]) else 1)
@@ -0,0 +1,449 @@
+#!/usr/bin/env python3
+
+"""mock_coordinator.py
+
+local stand-in for a robosats coordinator on 127.0.0.1, requests to
+127.0.0.1 do not go through tor, so keep-online can be run and
+measured without onion coordinators and a lightning node
+
+robots are created at their first request, orders made with
+/api/make/ wait for the maker bond, are public after the bond invoice
+is paid with /mock/pay/, like benchmarks/lightning_node_mock.py does,
+can be taken for a while and expire after public-seconds
+
+GET  /api/robot/ /api/order/ /api/book/ /api/chat/ /api/info/
+POST /api/make/ /api/chat/ /api/reward/ /mock/pay/
+GET  /mock/stats/
+
+python3 benchmarks/mock_coordinator.py --port=port
+    [--latency=seconds] [--error-rate=rate]
+    [--bond-seconds=seconds] [--public-seconds=seconds]
+    [--take-rate=rate] [--taker-seconds=seconds]
+
+latency is the average time of every api request, error-rate the
+ratio of api requests answered with 500, take-rate the ratio of
+public orders that are taken by someone that does not lock the
+taker bond in taker-seconds
+"""
+
+# pylint: disable=C0116 missing-function-docstring
+# pylint: disable=C0413 wrong-import-position
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import tempfile
+import threading
+import subprocess
+import http.server
+import urllib.parse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from roboauto.global_state import roboauto_state
+from roboauto.utils import string_to_multiline_format
+from roboauto.gpg_key import gpg_generate_robot
+
+mock_options = {
+    "port": 0,
+    "latency": 0.0,
+    "error_rate": 0.0,
+    "bond_seconds": 60.0,
+    "public_seconds": 30.0,
+    "take_rate": 0.0,
+    "taker_seconds": 10.0
+}
+
+mock_state = {
+    "lock": threading.Lock(),
+    "robots": {},
+    "orders": {},
+    "order_counter": 0,
+    "public_key": "",
+    "private_key": "",
+    "requests": 0,
+    "errors": 0,
+    "orders_made": 0,
+    "orders_public": 0,
+    "orders_expired": 0,
+    "offline_seconds": []
+}
+
+
+def robot_nickname_get(token_base91):
+    """nickname of the robot with token_base91, the robots created by
+    the benchmarks should be named in the same way"""
+    return "MockRobot" + hashlib.sha256(token_base91.encode("utf8")).hexdigest()[:12]
+
+
+def mock_keys_generate():
+    """every robot uses the same gpg key, robots are not checking
+    that keys are different"""
+
+    with tempfile.TemporaryDirectory() as gnupg_home:
+        roboauto_state["gnupg_home"] = gnupg_home
+        _, public_key, private_key = gpg_generate_robot("mock")
+        # the agent started for the temporary directory is not needed
+        subprocess.run(
+            ["gpgconf", "--kill", "gpg-agent"],
+            env=dict(os.environ, GNUPGHOME=gnupg_home),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False
+        )
+
+    # robosats replaces new lines with backslashes
+    mock_state["public_key"] = string_to_multiline_format(public_key)
+    mock_state["private_key"] = string_to_multiline_format(private_key)
+
+
+def date_string_get(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000000Z", time.gmtime(timestamp))
+
+
+def robot_get(token_base91):
+    robot = mock_state["robots"].get(token_base91, None)
+    if robot is None:
+        robot = {
+            "nickname": robot_nickname_get(token_base91),
+            "active_order_id": None,
+            "last_order_id": None,
+            "expired_at": None
+        }
+        mock_state["robots"][token_base91] = robot
+
+    return robot
+
+
+def order_update(order, current_time):
+    """move the order to the status it should have at current_time"""
+    robot = order["robot"]
+
+    if order["status"] == 0 and current_time >= order["expires_at"]:
+        order["status"] = 5
+        order["expiry_reason"] = 1
+
+    if order["status"] == 3 and current_time >= order["taken_until"]:
+        order["status"] = 1
+
+    if \
+        order["status"] == 1 and order["taken_at"] is not None and \
+        current_time >= order["taken_at"]:
+        order["status"] = 3
+        order["taken_until"] = order["taken_at"] + mock_options["taker_seconds"]
+        order["taken_at"] = None
+
+    if order["status"] in (1, 3) and current_time >= order["expires_at"]:
+        order["status"] = 5
+        order["expiry_reason"] = 0
+
+    if order["status"] == 5 and robot["active_order_id"] == order["id"]:
+        robot["active_order_id"] = None
+        robot["expired_at"] = order["expires_at"]
+        mock_state["orders_expired"] += 1
+
+
+def order_response_get(order):
+    return {
+        "id": order["id"],
+        "status": order["status"],
+        "created_at": date_string_get(order["created_at"]),
+        "expires_at": date_string_get(order["expires_at"]),
+        "type": order["type"],
+        "currency": order["currency"],
+        "amount": order["amount"],
+        "has_range": order["has_range"],
+        "min_amount": order["min_amount"],
+        "max_amount": order["max_amount"],
+        "payment_method": order["payment_method"],
+        "premium": order["premium"],
+        "public_duration": order["public_duration"],
+        "escrow_duration": order["escrow_duration"],
+        "bond_size": order["bond_size"],
+        "maker_nick": order["robot"]["nickname"],
+        "maker_status": "Active",
+        "is_maker": True,
+        "is_taker": False,
+        "is_participant": True,
+        "is_buyer": order["type"] == 0,
+        "is_seller": order["type"] == 1,
+        "taker": None,
+        "bond_invoice": order["bond_invoice"],
+        "bond_satoshis": 3000,
+        "expiry_reason": order["expiry_reason"]
+    }
+
+
+def order_make(robot, make_data):
+    if robot["active_order_id"] is not None:
+        return {"bad_request": "You are already maker of an active order"}
+
+    current_time = time.time()
+
+    mock_state["order_counter"] += 1
+    order_id = mock_state["order_counter"]
+
+    order = {
+        "id": order_id,
+        "robot": robot,
+        "status": 0,
+        "created_at": current_time,
+        "expires_at": current_time + mock_options["bond_seconds"],
+        "taken_at": None,
+        "taken_until": None,
+        "expiry_reason": None,
+        "type": make_data.get("type", 0),
+        "currency": make_data.get("currency", 1),
+        "amount": make_data.get("amount", None),
+        "has_range": make_data.get("has_range", False),
+        "min_amount": make_data.get("min_amount", None),
+        "max_amount": make_data.get("max_amount", None),
+        "payment_method": make_data.get("payment_method", "Revolut"),
+        "premium": str(make_data.get("premium", "0")),
+        "public_duration": make_data.get("public_duration", 86400),
+        "escrow_duration": make_data.get("escrow_duration", 28800),
+        "bond_size": str(make_data.get("bond_size", "3.00")),
+        "bond_invoice": f"lnmock{mock_options['port']}x{order_id}"
+    }
+    mock_state["orders"][order_id] = order
+    mock_state["orders_made"] += 1
+
+    robot["active_order_id"] = order_id
+    robot["last_order_id"] = order_id
+
+    return order_response_get(order)
+
+
+def order_pay(invoice):
+    """the maker bond of the order of the invoice is locked"""
+    try:
+        order_id = int(invoice.rsplit("x", 1)[1])
+    except (ValueError, IndexError):
+        return {"bad_request": "invoice not valid"}
+
+    order = mock_state["orders"].get(order_id, None)
+    if order is None:
+        return {"bad_request": "order not found"}
+
+    current_time = time.time()
+    order_update(order, current_time)
+    if order["status"] != 0:
+        return {"bad_request": "order is not waiting for maker bond"}
+
+    robot = order["robot"]
+
+    order["status"] = 1
+    order["expires_at"] = current_time + mock_options["public_seconds"]
+    if random.random() < mock_options["take_rate"]:
+        order["taken_at"] = current_time + random.uniform(
+            0, max(0, mock_options["public_seconds"] - mock_options["taker_seconds"])
+        )
+    mock_state["orders_public"] += 1
+    if robot["expired_at"] is not None:
+        mock_state["offline_seconds"].append(current_time - robot["expired_at"])
+        robot["expired_at"] = None
+
+    return {"paid": True}
+
+
+def mock_stats_get():
+    offline_seconds = mock_state["offline_seconds"]
+    return {
+        "requests": mock_state["requests"],
+        "errors": mock_state["errors"],
+        "robots": len(mock_state["robots"]),
+        "orders_made": mock_state["orders_made"],
+        "orders_public": mock_state["orders_public"],
+        "orders_expired": mock_state["orders_expired"],
+        "offline_number": len(offline_seconds),
+        "offline_seconds_mean":
+            sum(offline_seconds) / len(offline_seconds) if offline_seconds else 0,
+        "offline_seconds_max": max(offline_seconds) if offline_seconds else 0
+    }
+
+
+def api_get(path, query, robot):
+    if path == "/api/info/":
+        return 200, {"version": {"major": 0, "minor": 0, "patch": 0}, "mock": True}
+
+    if path == "/api/book/":
+        current_time = time.time()
+        offers = []
+        for order in mock_state["orders"].values():
+            order_update(order, current_time)
+            if order["status"] == 1:
+                offers.append(order_response_get(order))
+        if len(offers) < 1:
+            return 404, {"not_found": "No orders found, be the first to make one"}
+        return 200, offers
+
+    if robot is None:
+        return 403, {"detail": "Authentication credentials were not provided."}
+
+    if path == "/api/robot/":
+        robot_response = {
+            "nickname": robot["nickname"],
+            "public_key": mock_state["public_key"],
+            "encrypted_private_key": mock_state["private_key"],
+            "earned_rewards": 0,
+            "wants_stealth": True,
+            "found": True
+        }
+        if robot["active_order_id"] is not None:
+            order_update(mock_state["orders"][robot["active_order_id"]], time.time())
+        if robot["active_order_id"] is not None:
+            robot_response["active_order_id"] = robot["active_order_id"]
+        if robot["last_order_id"] is not None:
+            robot_response["last_order_id"] = robot["last_order_id"]
+        return 200, robot_response
+
+    if path == "/api/order/":
+        try:
+            order_id = int(query.get("order_id", [""])[0])
+        except ValueError:
+            return 400, {"bad_request": "Order id parameter not found in request"}
+        order = mock_state["orders"].get(order_id, None)
+        if order is None:
+            return 404, {"bad_request": "Invalid order Id"}
+        if order["robot"] is not robot:
+            return 403, {"bad_request": "This order is not yours"}
+        order_update(order, time.time())
+        return 200, order_response_get(order)
+
+    if path == "/api/chat/":
+        return 200, {"messages": [], "peer_connected": False, "offset": 0}
+
+    return 404, {"detail": "Not found."}
+
+
+def api_post(path, body_json, robot):
+    if path == "/mock/pay/":
+        return 200, order_pay(str(body_json.get("invoice", "")))
+
+    if robot is None:
+        return 403, {"detail": "Authentication credentials were not provided."}
+
+    if path == "/api/make/":
+        return 200, order_make(robot, body_json)
+
+    if path == "/api/chat/":
+        return 200, {"messages": [], "peer_connected": False, "offset": 0}
+
+    if path == "/api/reward/":
+        return 200, {"successful_withdrawal": True}
+
+    return 404, {"detail": "Not found."}
+
+
+def token_from_headers(headers):
+    authorization = headers.get("Authorization", None)
+    if authorization is None or not authorization.startswith("Token "):
+        return None
+
+    return authorization[len("Token "):].split(" | ", 1)[0].strip()
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    """answer the requests of roboauto like a coordinator"""
+
+    protocol_version = "HTTP/1.1"
+
+    # pylint: disable=C0103 invalid-name
+    def do_GET(self):
+        self.handle_request(None)
+
+    def do_POST(self):
+        content_length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(content_length).decode("utf8")
+        try:
+            body_json = json.loads(body) if body else {}
+        except json.JSONDecodeError:
+            body_json = None
+        if not isinstance(body_json, dict):
+            self.respond(400, {"bad_request": "body is not valid json"})
+            return
+        self.handle_request(body_json)
+
+    def handle_request(self, body_json):
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path
+        if not path.endswith("/"):
+            path += "/"
+
+        if path == "/mock/stats/":
+            with mock_state["lock"]:
+                self.respond(200, mock_stats_get())
+            return
+
+        if path.startswith("/api/"):
+            if mock_options["latency"] > 0:
+                time.sleep(random.uniform(0.5, 1.5) * mock_options["latency"])
+            with mock_state["lock"]:
+                mock_state["requests"] += 1
+                is_error = random.random() < mock_options["error_rate"]
+                if is_error:
+                    mock_state["errors"] += 1
+            if is_error:
+                self.respond(500, {"detail": "mock error"})
+                return
+
+        with mock_state["lock"]:
+            token_base91 = token_from_headers(self.headers)
+            robot = robot_get(token_base91) if token_base91 is not None else None
+            if body_json is None:
+                status_code, response_json = api_get(
+                    path, urllib.parse.parse_qs(url.query), robot
+                )
+            else:
+                status_code, response_json = api_post(path, body_json, robot)
+
+        self.respond(status_code, response_json)
+
+    def respond(self, status_code, response_json):
+        body = json.dumps(response_json).encode("utf8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # pylint: disable=W0622 redefined-builtin
+        pass
+
+
+def main(argv):
+    for arg in argv:
+        option_key, _, option_value = arg.partition("=")
+        option = option_key.lstrip("-").replace("-", "_")
+        if not option_key.startswith("--") or option not in mock_options:
+            print(f"error: option {arg} not recognized", file=sys.stderr)
+            return False
+        try:
+            mock_options[option] = type(mock_options[option])(option_value)
+        except ValueError:
+            print(f"error: option {arg} not valid", file=sys.stderr)
+            return False
+
+    mock_keys_generate()
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", mock_options["port"]), MockHandler)
+    server.daemon_threads = True
+    mock_options["port"] = server.server_address[1]
+
+    # the benchmarks wait for this line before starting
+    print(f"listening on http://127.0.0.1:{mock_options['port']}", flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main(sys.argv[1:]) else 1)
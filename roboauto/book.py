@@ -5,19 +5,24 @@
 # pylint: disable=C0116 missing-function-docstring
 
 import os
+import re
+import time
+import threading
+import functools
 
 from roboauto.logger import print_out, print_err
-from roboauto.global_state import roboauto_state
+from roboauto.global_state import roboauto_state, roboauto_options
 from roboauto.robot import robot_list_dir, waiting_queue_get
 from roboauto.order_data import get_currency_string, order_is_public
 from roboauto.order_local import \
-    get_offer_dic, offer_dic_print, order_dic_from_robot_dir
+    get_offer_dic, offer_dic_print, order_dic_from_robot_dir, our_nicks_get
 from roboauto.requests_api import response_is_error, requests_api_book
 from roboauto.date_utils import \
     get_hour_offer, get_current_timestamp
 from roboauto.utils import \
     json_loads, roboauto_get_multi_coordinators_from_argv, \
-    roboauto_get_coordinator_url, file_json_write, file_json_read
+    roboauto_get_coordinator_url, file_json_write, file_json_read, get_int, \
+    lock_file_name_get
 
 
 def get_offers_per_hour(relative):
@@ -96,9 +101,10 @@ def list_offers_per_hour_argv(argv):
     return list_offers_per_hour(hour_relative)
 
 
-def get_book_response_json(coordinator, until_true=False):
+def get_book_response_json(coordinator, until_true=False, timeout=None):
     """wrap around requests_api_book to check if the response
-    is correct"""
+    is correct, with a timeout requests are retried just until
+    timeout seconds are passed"""
     base_url = roboauto_get_coordinator_url(coordinator)
     if base_url is False:
         return False
@@ -108,13 +114,18 @@ def get_book_response_json(coordinator, until_true=False):
     else:
         level_print = 0
 
+    requests_options = {
+        "until_true": until_true,
+        "error_print": level_print
+    }
+    if timeout is not None:
+        requests_options["timeout"] = timeout
+        requests_options["deadline"] = time.monotonic() + timeout
+
     # in keep-online print to the terminal the errors of book requests
     # just when the verbosity is at least 1, but still print in the logs
     book_response_all = requests_api_book(
-        base_url, coordinator, options={
-            "until_true": until_true,
-            "error_print": level_print
-        }
+        base_url, coordinator, options=requests_options
     )
     if response_is_error(book_response_all):
         print_err(f"{coordinator} book response", level=level_print)
@@ -144,23 +155,35 @@ def get_book_response_json(coordinator, until_true=False):
             )
             return False
 
-    if not file_json_write(
-        roboauto_state["coordinators_home"] + "/" + coordinator, book_response_json
-    ):
+    # written to a temporary file and moved so that other instances
+    # reading the local book never see it half written
+    book_response_file = book_local_file_get(coordinator)
+    book_response_file_tmp = book_response_file + ".tmp." + str(os.getpid())
+    if not file_json_write(book_response_file_tmp, book_response_json):
+        return False
+    try:
+        os.replace(book_response_file_tmp, book_response_file)
+    except OSError:
+        print_err(f"{coordinator} saving local book")
         return False
 
     return book_response_json
 
 
-def get_offers_unsorted(multi_book_response_json, book_type, book_currency):
+def get_offers_unsorted(
+    multi_book_response_json, book_type, book_currency, our_nicks=None
+):
     """get offers unsorted from multi responses,
     filtering type and currency"""
+    if our_nicks is None:
+        our_nicks = our_nicks_get()
+
     offers = []
     for book in multi_book_response_json:
         book_response_json = book["offers"]
         coordinator = book["coordinator"]
         for offer in book_response_json:
-            offer_dic = get_offer_dic(offer, coordinator)
+            offer_dic = get_offer_dic(offer, coordinator, our_nicks=our_nicks)
 
             if offer_dic["order_type"] == "buy" and book_type == 1:
                 continue
@@ -176,9 +199,12 @@ def get_offers_unsorted(multi_book_response_json, book_type, book_currency):
 
 
 def list_offers_general(
-    multi_book_response_json, book_type, book_currency, search_element=""
+    multi_book_response_json, book_type, book_currency, search_element="",
+    our_nicks=None
 ):
-    offers_unsorted = get_offers_unsorted(multi_book_response_json, book_type, book_currency)
+    offers_unsorted = get_offers_unsorted(
+        multi_book_response_json, book_type, book_currency, our_nicks=our_nicks
+    )
     if offers_unsorted is False:
         print_err("getting unsorted offers")
         return False
@@ -206,21 +232,133 @@ def list_offers_general(
     return True
 
 
-def get_multi_book_response_json(coordinators, until_true=False, book_local=False):
-    multi_book_response_json = []
+def book_local_file_get(coordinator):
+    return roboauto_state["coordinators_home"] + "/" + coordinator
+
+
+def book_local_age(coordinator):
+    """seconds passed since the local book of the coordinator was
+    fetched, None if there is no local book"""
+    try:
+        fetch_timestamp = os.stat(book_local_file_get(coordinator)).st_mtime
+    except OSError:
+        return None
+
+    return max(time.time() - fetch_timestamp, 0)
+
+
+def book_local_is_fresh(coordinator, max_age):
+    book_age = book_local_age(coordinator)
+
+    return book_age is not None and book_age < max_age
+
+
+def get_local_book_response_json(coordinator):
+    book_response_file = book_local_file_get(coordinator)
+    if not os.path.isfile(book_response_file):
+        print_err(f"{coordinator} local book not present")
+        return False
+
+    return file_json_read(book_response_file)
+
+
+def get_cached_book_response_json(
+    coordinator, max_age, until_true=False, timeout=None
+):
+    """get the local book if it was fetched less than max_age seconds
+    ago, otherwise request it, the request is done while holding the
+    book lock so that instances polling the book at the same time
+    make just one request and the others read its result"""
+    # filelock takes long to import, list-hours does not need it
+    # pylint: disable=C0415 import-outside-toplevel
+    import filelock
+
+    if book_local_is_fresh(coordinator, max_age):
+        return get_local_book_response_json(coordinator)
+
+    filelock_timeout = roboauto_state["filelock_timeout"]
+    try:
+        with filelock.FileLock(
+            lock_file_name_get("book-" + coordinator),
+            timeout=filelock_timeout
+        ):
+            if book_local_is_fresh(coordinator, max_age):
+                return get_local_book_response_json(coordinator)
+
+            return get_book_response_json(
+                coordinator, until_true=until_true, timeout=timeout
+            )
+    except filelock.Timeout:
+        print_err(f"{coordinator} book filelock timeout {filelock_timeout}")
+        return False
+
 
-    for coordinator in coordinators:
-        if book_local is False:
-            book_response_json = get_book_response_json(
-                coordinator, until_true=until_true
+def get_multi_book_response_json(
+    coordinators, until_true=False, book_local=False, timeout=None,
+    max_age=None
+):
+    """books of the coordinators are requested at the same time, every
+    coordinator with its circuit, coordinators whose book can not be
+    get are skipped, the order of coordinators is kept
+    max_age is the number of seconds a local book is used instead of
+    requesting it again, when None book_cache_ttl is used"""
+
+    coordinators = list(coordinators)
+
+    if max_age is None:
+        max_age = roboauto_options["book_cache_ttl"]
+
+    if book_local is False and len(coordinators) > 0:
+        if max_age > 0:
+            book_function = functools.partial(
+                get_cached_book_response_json, max_age=max_age,
+                until_true=until_true, timeout=timeout
             )
         else:
-            book_response_file = roboauto_state["coordinators_home"] + "/" + coordinator
-            if os.path.isfile(book_response_file):
-                book_response_json = file_json_read(book_response_file)
+            book_function = functools.partial(
+                get_book_response_json, until_true=until_true, timeout=timeout
+            )
+
+        book_results = [False] * len(coordinators)
+
+        def book_thread_run(i, coordinator):
+            book_results[i] = book_function(coordinator)
+
+        # daemon threads, with a timeout the books received late are
+        # not waited for, not even when the interpreter exits
+        book_threads = [
+            threading.Thread(
+                target=book_thread_run, args=(i, coordinator),
+                name="book-" + coordinator, daemon=True
+            ) for i, coordinator in enumerate(coordinators)
+        ]
+        for book_thread in book_threads:
+            book_thread.start()
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        for book_thread in book_threads:
+            if deadline is None:
+                book_thread.join()
             else:
-                print_err(f"{coordinator} local book not present")
-                book_response_json = False
+                book_thread.join(timeout=max(0, deadline - time.monotonic()))
+
+        book_responses = []
+        for i, (coordinator, book_thread) in enumerate(zip(coordinators, book_threads)):
+            if book_thread.is_alive():
+                print_err(f"{coordinator} book not received in {timeout} seconds")
+                book_responses.append(False)
+            else:
+                book_responses.append(book_results[i])
+    else:
+        book_responses = [
+            get_local_book_response_json(coordinator) for coordinator in coordinators
+        ]
+
+    multi_book_response_json = []
+
+    for coordinator, book_response_json in zip(coordinators, book_responses):
         if book_response_json is False:
             continue
 
@@ -239,6 +377,8 @@ def get_multi_book_response_json(coordinators, until_true=False, book_local=Fals
 def list_offers_argv(argv: list):
     until_true = False
     book_local = False
+    timeout = None
+    max_age = None
     while len(argv) >= 1:
         if argv[0] == "--until-success":
             argv = argv[1:]
@@ -246,6 +386,22 @@ def list_offers_argv(argv: list):
         elif argv[0] == "--local":
             argv = argv[1:]
             book_local = True
+        elif re.match('^--timeout=', argv[0]) is not None:
+            timeout = get_int(argv[0].split("=", 1)[1])
+            if timeout is False:
+                return False
+            if timeout <= 0:
+                print_err("timeout should be positive")
+                return False
+            argv = argv[1:]
+        elif re.match('^--max-age=', argv[0]) is not None:
+            max_age = get_int(argv[0].split("=", 1)[1])
+            if max_age is False:
+                return False
+            if max_age < 0:
+                print_err("max age can not be negative")
+                return False
+            argv = argv[1:]
         else:
             break
 
@@ -253,6 +409,10 @@ def list_offers_argv(argv: list):
         print_err("--until-success and --local can not be both present")
         return False
 
+    if book_local is True and max_age is not None:
+        print_err("--local and --max-age can not be both present")
+        return False
+
     coordinators, argv = roboauto_get_multi_coordinators_from_argv(argv)
     if coordinators is False:
         return False
@@ -282,16 +442,20 @@ def list_offers_argv(argv: list):
         search_element = ""
 
     multi_book_response_json = get_multi_book_response_json(
-        coordinators, until_true=until_true, book_local=book_local
+        coordinators, until_true=until_true, book_local=book_local,
+        timeout=timeout, max_age=max_age
     )
     if multi_book_response_json is False:
         return False
 
     return_status = True
 
+    our_nicks = our_nicks_get()
+
     if which_offers in ("all", "buy"):
         if list_offers_general(
-            multi_book_response_json, 0, currency, search_element
+            multi_book_response_json, 0, currency, search_element,
+            our_nicks=our_nicks
         ) is False:
             return_status = False
 
@@ -300,7 +464,8 @@ def list_offers_argv(argv: list):
 
     if which_offers in ("all", "sell"):
         if list_offers_general(
-            multi_book_response_json, 1, currency, search_element
+            multi_book_response_json, 1, currency, search_element,
+            our_nicks=our_nicks
         ) is False:
             return_status = False
 
@@ -4,13 +4,15 @@
 
 # pylint: disable=C0116 missing-function-docstring
 
+import os
 import re
+import hashlib
 
 from roboauto.logger import print_out, print_err
 from roboauto.date_utils import date_convert_time_zone_and_format_string
 from roboauto.utils import \
     json_loads, string_from_multiline_format, string_to_multiline_format, \
-    input_ask, file_json_write
+    input_ask, file_json_write, file_json_read, dir_make_sure_exists
 from roboauto.order_local import order_robot_get_last_order_id
 from roboauto.requests_api import \
     response_is_error, requests_api_chat_post, requests_api_chat
@@ -21,7 +23,72 @@ from roboauto.gpg_key import \
     gpg_import_key, gpg_encrypt_sign_message, gpg_decrypt_check_message
 
 
-def messages_from_chat_response(robot_dic, chat_response_json):
+def chat_store_file_get(robot_dir, order_id):
+    return robot_dir + "/chats/" + str(order_id)
+
+
+def chat_store_load(robot_dir, order_id):
+    """the chat store of an order keeps the messages already received,
+    the index of the last one and the messages already decrypted,
+    keyed by the hash of the encrypted message"""
+    chat_store_file = chat_store_file_get(robot_dir, order_id)
+    if not os.path.isfile(chat_store_file):
+        return {
+            "last_index": 0,
+            "messages": [],
+            "decrypted": {}
+        }
+
+    chat_store = file_json_read(chat_store_file)
+    if \
+        not isinstance(chat_store, dict) or \
+        not isinstance(chat_store.get("last_index", None), int) or \
+        not isinstance(chat_store.get("messages", None), list) or \
+        not isinstance(chat_store.get("decrypted", None), dict):
+        print_err(f"{chat_store_file} is not a valid chat store")
+        return False
+
+    return chat_store
+
+
+def chat_store_save(robot_dir, order_id, chat_store):
+    if not dir_make_sure_exists(robot_dir + "/chats"):
+        return False
+
+    return file_json_write(chat_store_file_get(robot_dir, order_id), chat_store)
+
+
+def chat_store_add_messages(chat_store, new_messages):
+    """add the new messages to the store, messages already present
+    are replaced, if the messages do not have an index the store
+    just keeps the new ones and the next request starts again from 0"""
+    messages_index = {}
+    for message in chat_store["messages"] + new_messages:
+        message_index = message.get("index", None) if isinstance(message, dict) else None
+        if not isinstance(message_index, int):
+            chat_store["messages"] = new_messages
+            chat_store["last_index"] = 0
+            return True
+        messages_index[message_index] = message
+
+    chat_store["messages"] = [
+        messages_index[message_index] for message_index in sorted(messages_index)
+    ]
+    chat_store["last_index"] = max(messages_index, default=0)
+
+    return True
+
+
+def message_decrypted_key_get(message_enc, signature_fingerprint):
+    return hashlib.sha256(
+        (str(signature_fingerprint) + "\n" + message_enc).encode("utf8")
+    ).hexdigest()
+
+
+def messages_from_chat_response(robot_dic, chat_response_json, decrypted_cache=None):
+    """decrypted_cache is a dictionary of messages already decrypted,
+    keyed by message_decrypted_key_get, new decrypted messages
+    are added to it"""
     robot_name, _, robot_dir, token, _, _, _ = robot_var_from_dic(robot_dic)
 
     unsorted_messages = chat_response_json.get("messages", False)
@@ -71,9 +138,15 @@ def messages_from_chat_response(robot_dic, chat_response_json):
                 signature_fingerprint = current_fingerprint
             else:
                 signature_fingerprint = peer_fingerprint
-            decrypted_message, signature_error = gpg_decrypt_check_message(
-                message_enc, signature_fingerprint, passphrase=token, error_print=False
-            )
+            decrypted_key = message_decrypted_key_get(message_enc, signature_fingerprint)
+            if decrypted_cache is not None and decrypted_key in decrypted_cache:
+                decrypted_message, signature_error = decrypted_cache[decrypted_key]
+            else:
+                decrypted_message, signature_error = gpg_decrypt_check_message(
+                    message_enc, signature_fingerprint, passphrase=token, error_print=False
+                )
+                if decrypted_cache is not None and decrypted_message is not False:
+                    decrypted_cache[decrypted_key] = [decrypted_message, signature_error]
             if decrypted_message is not False:
                 message_print = decrypted_message
             else:
@@ -102,6 +175,11 @@ def messages_from_chat_response(robot_dic, chat_response_json):
 
 
 def robot_requests_chat(robot_dic):
+    """request just the messages after the last one in the chat store
+    of the order and decrypt just the ones never decrypted, the returned
+    response text is the one of the request with just the new messages,
+    the returned response json, the chat-response file and the
+    decrypted messages have all the messages"""
     multi_false = False, False, False
 
     robot_name, _, robot_dir, _, _, token_base91, robot_url = robot_var_from_dic(robot_dic)
@@ -110,7 +188,14 @@ def robot_requests_chat(robot_dic):
     if order_id is False:
         return multi_false
 
-    chat_response_all = requests_api_chat(token_base91, order_id, robot_url, robot_name)
+    chat_store = chat_store_load(robot_dir, order_id)
+    if chat_store is False:
+        return multi_false
+
+    chat_response_all = requests_api_chat(
+        token_base91, order_id, robot_url, robot_name,
+        offset=chat_store["last_index"]
+    )
     if response_is_error(chat_response_all):
         return multi_false
     chat_response = chat_response_all.text
@@ -126,6 +211,15 @@ def robot_requests_chat(robot_dic):
         print_err("getting chat messages")
         return multi_false
 
+    new_messages = chat_response_json.get("messages", False)
+    if not isinstance(new_messages, list):
+        print_err(chat_response, end="", error=False, date=False)
+        print_err("chat response does not have messages")
+        return multi_false
+
+    chat_store_add_messages(chat_store, new_messages)
+    chat_response_json["messages"] = chat_store["messages"]
+
     chat_response_file = robot_dir + "/chat-response"
     if not file_json_write(chat_response_file, chat_response_json):
         return multi_false
@@ -146,10 +240,15 @@ def robot_requests_chat(robot_dic):
     ) is False:
         return multi_false
 
-    decrypted_messages = messages_from_chat_response(robot_dic, chat_response_json)
+    decrypted_messages = messages_from_chat_response(
+        robot_dic, chat_response_json, decrypted_cache=chat_store["decrypted"]
+    )
     if decrypted_messages is False:
         return multi_false
 
+    if chat_store_save(robot_dir, order_id, chat_store) is False:
+        return multi_false
+
     return chat_response, chat_response_json, decrypted_messages
 
 
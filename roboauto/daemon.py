@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+"""daemon.py"""
+
+# pylint: disable=C0116 missing-function-docstring
+
+import os
+import io
+import sys
+import json
+import socket
+import signal
+import contextlib
+
+from roboauto.logger import print_out, print_err
+from roboauto.global_state import roboauto_state
+from roboauto.utils import \
+    update_roboauto_options, state_set_command_type, json_loads, \
+    config_reload_signal_handler
+
+
+# actions that can be run by the daemon, they do not ask for input
+# and running them again locally when the daemon fails is safe
+DAEMON_ACTIONS = (
+    "list-active", "list-pending", "list-inactive", "list-paused",
+    "list-waiting-queue", "print-token", "print-coordinator",
+    "order-info-dir", "order-summary", "list-hours",
+    "robosats-info", "robot-info", "order-info", "chat-print",
+    "list-historical", "list-limits", "list-price", "list-ticks",
+    "list-offers"
+)
+
+
+def daemon_socket_file_get():
+    return roboauto_state["data_home"] + "/daemon.sock"
+
+
+def daemon_forward_allowed(action, argv):
+    if action not in DAEMON_ACTIONS:
+        return False
+
+    for arg in argv:
+        if arg in ("--stdin", "--stdin-base91"):
+            return False
+
+    return True
+
+
+def daemon_argv_paths_absolute(action, argv):
+    """the daemon has its own working directory, relative paths
+    of the client are made absolute"""
+    if action != "order-info-dir":
+        return argv
+
+    argv = list(argv)
+    for i, arg in enumerate(argv[:-1]):
+        if arg == "--dir":
+            argv[i + 1] = os.path.abspath(argv[i + 1])
+
+    return argv
+
+
+def daemon_request_send(request, socket_file):
+    """send a request to the daemon and return its response,
+    False if the daemon can not be reached or it does not start the
+    action in daemon_accept_timeout seconds, because it is running
+    the action of another client"""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(5)
+            connection.connect(socket_file)
+            connection.sendall((json.dumps(request) + "\n").encode("utf8"))
+            connection.settimeout(roboauto_state["daemon_accept_timeout"])
+            with connection.makefile("r", encoding="utf8") as connection_file:
+                response_line = connection_file.readline()
+                response = json_loads(response_line)
+                if isinstance(response, dict) and response.get("accepted") is True:
+                    # the action is running, it can take long
+                    connection.settimeout(None)
+                    response_line = connection_file.readline()
+                    response = json_loads(response_line)
+    except OSError:
+        return False
+
+    if not isinstance(response, dict):
+        return False
+
+    return response
+
+
+def daemon_is_running(socket_file):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(5)
+            connection.connect(socket_file)
+    except OSError:
+        return False
+
+    return True
+
+
+def daemon_forward(action, argv):
+    """run the action in the daemon if it is running, return None if
+    the action has to be run locally"""
+    if not daemon_forward_allowed(action, argv):
+        return None
+
+    socket_file = daemon_socket_file_get()
+    if not os.path.exists(socket_file):
+        return None
+
+    response = daemon_request_send({
+        "config_home": roboauto_state["config_home"],
+        "action": action,
+        "argv": daemon_argv_paths_absolute(action, argv)
+    }, socket_file)
+    if response is False or response.get("refused", True) is not False:
+        return None
+
+    sys.stdout.write(response.get("stdout", ""))
+    sys.stdout.flush()
+    sys.stderr.write(response.get("stderr", ""))
+    sys.stderr.flush()
+
+    return response.get("return_status", False) is True
+
+
+def daemon_request_handle(connection, action_run):
+    # the daemon has to keep serving when an action fails
+    # pylint: disable=W0718 broad-exception-caught
+
+    connection.settimeout(10)
+    with connection.makefile("r", encoding="utf8") as connection_file:
+        request_line = connection_file.readline()
+    connection.settimeout(None)
+
+    # connections without a request just check that the daemon is running
+    if request_line == "":
+        return None
+
+    request = json_loads(request_line)
+    if \
+        not isinstance(request, dict) or \
+        not isinstance(request.get("action"), str) or \
+        not isinstance(request.get("argv"), list) or \
+        not all(isinstance(arg, str) for arg in request["argv"]):
+        print_err("daemon request not valid")
+        return {"refused": True}
+
+    action = request["action"]
+    argv = request["argv"]
+
+    if request.get("config_home") != roboauto_state["config_home"]:
+        return {"refused": True}
+    if not daemon_forward_allowed(action, argv):
+        print_err(f"daemon action {action} not allowed")
+        return {"refused": True}
+
+    if update_roboauto_options(True) is False:
+        print_err("reading the config file")
+        return {"refused": True}
+
+    # the client runs the action locally if it does not receive this
+    # in time, in that case it has already closed the connection
+    try:
+        connection.sendall((json.dumps({"accepted": True}) + "\n").encode("utf8"))
+    except OSError:
+        return None
+
+    print_out(f"daemon {action} " + " ".join(argv), level=1)
+
+    stdout_buffer = io.StringIO()
+    stderr_buffer = io.StringIO()
+    stdin_original = sys.stdin
+    # actions run by the daemon can not ask for input
+    sys.stdin = io.StringIO("")
+    try:
+        with \
+            contextlib.redirect_stdout(stdout_buffer), \
+            contextlib.redirect_stderr(stderr_buffer):
+            try:
+                return_status = action_run(action, argv)
+            except EOFError:
+                print_err("input is not available in the daemon")
+                return_status = False
+            except Exception as e:
+                print_err(f"daemon {action} {repr(e)}")
+                return_status = False
+    finally:
+        sys.stdin = stdin_original
+        state_set_command_type("daemon")
+
+    return {
+        "refused": False,
+        "stdout": stdout_buffer.getvalue(),
+        "stderr": stderr_buffer.getvalue(),
+        "return_status": return_status is True
+    }
+
+
+def daemon_signal_handler(signum, frame):
+    # pylint: disable=W0613 unused-argument
+    raise KeyboardInterrupt
+
+
+def daemon_run(argv, action_run):
+    """keep state like the config, the gpg handle, the requests
+    sessions and the robot registry in memory and run the actions
+    received on the socket in the data directory, one at a time,
+    clients waiting while another action runs run theirs locally"""
+    if len(argv) > 0:
+        print_err("daemon does not accept arguments")
+        return False
+
+    socket_file = daemon_socket_file_get()
+    if os.path.exists(socket_file):
+        if daemon_is_running(socket_file):
+            print_err("daemon already running")
+            return False
+        try:
+            os.remove(socket_file)
+        except OSError:
+            print_err(f"removing {socket_file}")
+            return False
+
+    # a client disconnecting should not stop the daemon
+    signal.signal(signal.SIGPIPE, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, daemon_signal_handler)
+    # kill -HUP reloads the config file before the next action
+    signal.signal(signal.SIGHUP, config_reload_signal_handler)
+
+    state_set_command_type("daemon")
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask_original = os.umask(0o177)
+    try:
+        server.bind(socket_file)
+    except OSError:
+        server.close()
+        print_err(f"binding {socket_file}")
+        return False
+    finally:
+        os.umask(umask_original)
+
+    try:
+        server.listen()
+        print_out(f"daemon listening on {socket_file}")
+
+        while True:
+            connection, _ = server.accept()
+            with connection:
+                try:
+                    response = daemon_request_handle(connection, action_run)
+                    if response is not None:
+                        connection.sendall(
+                            (json.dumps(response) + "\n").encode("utf8")
+                        )
+                except OSError as e:
+                    print_err(f"daemon connection {repr(e)}")
+    except KeyboardInterrupt:
+        print_out("daemon stopping")
+    finally:
+        server.close()
+        try:
+            os.remove(socket_file)
+        except OSError:
+            pass
+
+    return True
@@ -7,6 +7,7 @@
 import time
 import calendar
 import datetime
+import functools
 
 from roboauto.global_state import roboauto_options
 
@@ -29,13 +30,56 @@ def timestamp_from_utc_date(time_input):
     return calendar.timegm(time_input)
 
 
+def timestamp_from_robosats_date(date_string):
+    """fast path for the dates of robosats, 2024-06-01T12:30:00.000000Z
+    or 2024-06-01T12:30:00Z, return False if date_string is not in
+    one of those formats"""
+    if len(date_string) not in (20, 27) or date_string[-1] != "Z":
+        return False
+    if \
+        date_string[4] != "-" or date_string[7] != "-" or date_string[10] != "T" or \
+        date_string[13] != ":" or date_string[16] != ":":
+        return False
+    if len(date_string) == 27 and date_string[19] != ".":
+        return False
+
+    digits = \
+        date_string[0:4] + date_string[5:7] + date_string[8:10] + \
+        date_string[11:13] + date_string[14:16] + date_string[17:19] + \
+        date_string[20:26]
+    if not digits.isascii() or not digits.isdigit():
+        return False
+
+    year = int(date_string[0:4])
+    month = int(date_string[5:7])
+    day = int(date_string[8:10])
+    hour = int(date_string[11:13])
+    minute = int(date_string[14:16])
+    second = int(date_string[17:19])
+
+    # the same dates refused by time.strptime
+    if \
+        not 1 <= month <= 12 or \
+        not 1 <= day <= calendar.monthrange(year, month)[1] or \
+        hour > 23 or minute > 59 or second > 61:
+        return False
+
+    return calendar.timegm((year, month, day, hour, minute, second))
+
+
+@functools.lru_cache(maxsize=4096)
 def timestamp_from_date_string(date_string):
+    """the same expires_at are converted for every robot and offer,
+    so the timestamps are cached"""
+    timestamp = timestamp_from_robosats_date(date_string)
+    if timestamp is not False:
+        return timestamp
+
     return timestamp_from_utc_date(time_strptime_understand_format(date_string))
 
 
 def date_convert_time_zone_and_format(time_input, output_format):
-    """used by date_convert_time_zone_and_format_string and
-    date_convert_time_zone_and_format_timestamp
+    """used by date_convert_time_zone_and_format_timestamp
     time.localtime seconds since epoch --> tuple in local timezone"""
 
     return time.strftime(
@@ -51,9 +95,9 @@ def date_convert_time_zone_and_format_string(
     """convert a date string utc in input format to a local
     time zone date string in output format"""
 
-    return date_convert_time_zone_and_format(
-        time_strptime_understand_format(date_string),
-        output_format
+    return time.strftime(
+        output_format,
+        time.localtime(timestamp_from_date_string(date_string))
     )
 
 
@@ -69,10 +113,21 @@ def date_convert_time_zone_and_format_timestamp(
     )
 
 
+# time zone offsets and daylight saving changes are multiples of 15
+# minutes, so the local hour is the same for every second of a quarter
+# of hour and it is computed once for every quarter
+@functools.lru_cache(maxsize=4096)
+def get_hour_from_quarter(quarter):
+    return time.localtime(quarter * 900).tm_hour
+
+
 def get_current_hour_from_timestamp(timestamp):
-    return int(date_convert_time_zone_and_format_timestamp(
-        timestamp, "%H"
-    ))
+    return get_hour_from_quarter(int(timestamp) // 900)
+
+
+def get_hour_from_date_string(date_string):
+    """local hour of a date string utc"""
+    return get_current_hour_from_timestamp(timestamp_from_date_string(date_string))
 
 
 def get_current_minutes_from_timestamp(timestamp):
@@ -90,9 +145,7 @@ def get_hour_offer(hour_date, current_timestamp, relative):
 
         date_hour = (24 - int((current_timestamp - unix_time) / 3600)) % 24
     else:
-        date_hour = int(date_convert_time_zone_and_format_string(
-            hour_date, output_format="%H"
-        ))
+        date_hour = get_hour_from_date_string(hour_date)
 
     return date_hour
 
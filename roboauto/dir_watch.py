@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""dir_watch.py"""
+
+# pylint: disable=C0116 missing-function-docstring
+
+import os
+import struct
+
+from roboauto.logger import print_out, print_err
+from roboauto.global_state import roboauto_state
+
+# linux/inotify.h
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+DIR_WATCH_MASK = \
+    IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+    IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+# events after which the names in the directories are not known
+DIR_WATCH_MASK_RESCAN = IN_DELETE_SELF | IN_MOVE_SELF | IN_Q_OVERFLOW | IN_IGNORED
+
+# struct inotify_event, wd mask cookie len followed by len bytes of name
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+
+def dir_watch_libc_get():
+    """libc with inotify, None if it is not available"""
+
+    # pylint: disable=C0415 import-outside-toplevel
+    import ctypes
+    import ctypes.util
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+
+def dir_watch_inotify_start(directories):
+    """watch the directories with inotify, return the inotify file
+    descriptor and the directory of every watch descriptor, None if
+    inotify is not available"""
+    libc = dir_watch_libc_get()
+    if libc is None:
+        return None
+
+    inotify_fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if inotify_fd < 0:
+        return None
+
+    watches = {}
+    for directory in directories:
+        watch_descriptor = libc.inotify_add_watch(
+            inotify_fd, os.fsencode(directory), DIR_WATCH_MASK
+        )
+        if watch_descriptor < 0:
+            os.close(inotify_fd)
+            return None
+        watches[watch_descriptor] = directory
+
+    return inotify_fd, watches
+
+
+def dir_watch_mtimes_get(directories):
+    mtimes = {}
+    for directory in directories:
+        try:
+            mtimes[directory] = os.stat(directory).st_mtime_ns
+        except OSError:
+            mtimes[directory] = None
+
+    return mtimes
+
+
+def dir_watch_start(directories):
+    """start watching the robots added to and removed from directories,
+    with inotify when available, otherwise checking the mtimes of the
+    directories"""
+    dir_watch_stop()
+
+    dir_watch = roboauto_state["dir_watch"]
+    dir_watch["directories"] = tuple(directories)
+
+    inotify_started = dir_watch_inotify_start(directories)
+    if inotify_started is not None:
+        dir_watch["inotify_fd"], dir_watch["watches"] = inotify_started
+        print_out("watching robot directories with inotify", level=1)
+    else:
+        dir_watch["mtimes"] = dir_watch_mtimes_get(directories)
+        print_out("inotify not available, checking robot directories mtimes", level=1)
+
+    return True
+
+
+def dir_watch_stop():
+    dir_watch = roboauto_state["dir_watch"]
+
+    if dir_watch["inotify_fd"] is not None:
+        try:
+            os.close(dir_watch["inotify_fd"])
+        except OSError:
+            pass
+
+    dir_watch["directories"] = None
+    dir_watch["inotify_fd"] = None
+    dir_watch["watches"] = {}
+    dir_watch["mtimes"] = None
+
+    return True
+
+
+def dir_watch_inotify_read(dir_watch):
+    """return the names added, removed or moved in the watched
+    directories since the last read, None if they are not known"""
+    robot_names = set()
+    while True:
+        try:
+            data = os.read(dir_watch["inotify_fd"], 65536)
+        except BlockingIOError:
+            return robot_names
+        except OSError as e:
+            print_err(f"reading inotify events {repr(e)}")
+            return None
+
+        offset = 0
+        while offset + INOTIFY_EVENT_HEADER.size <= len(data):
+            watch_descriptor, mask, _, name_length = \
+                INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + name_length].split(b"\0", 1)[0])
+            offset += name_length
+
+            if mask & DIR_WATCH_MASK_RESCAN or watch_descriptor not in dir_watch["watches"]:
+                return None
+            if name:
+                robot_names.add(name)
+
+
+def dir_watch_changes(directories):
+    """return the names of the robots that could have been added to,
+    removed from or moved between directories since the last call,
+    None if every robot should be checked, like the first time or
+    when inotify is not available and a directory changed"""
+    dir_watch = roboauto_state["dir_watch"]
+    if dir_watch["directories"] != tuple(directories):
+        # the directories are listed by the caller after the watch is
+        # started, so no change is lost
+        dir_watch_start(directories)
+        return None
+
+    if dir_watch["inotify_fd"] is None:
+        mtimes = dir_watch_mtimes_get(directories)
+        if mtimes == dir_watch["mtimes"]:
+            return set()
+        dir_watch["mtimes"] = mtimes
+        return None
+
+    robot_names = dir_watch_inotify_read(dir_watch)
+    if robot_names is None:
+        print_out("robot directories events lost, listing them again", level=1)
+        dir_watch_start(directories)
+
+    return robot_names
@@ -2,6 +2,8 @@
 
 """global_state.py"""
 
+import threading
+
 # options that can be changed in config file
 roboauto_options = {
     "user_agent": "Mozilla/5.0 (Windows NT 10.0; rv:109.0) Gecko/20100101 Firefox/115.0",
@@ -18,12 +20,27 @@ roboauto_options = {
     "requests_timeout": 120,
     "orders_timeout": 60,
     "active_interval": 80,
-    "pending_interval": 120,
+    "pending_interval": 60,
+    "urgent_interval": 15,
     "pay_interval": 2,
     "error_interval": 5,
+    "circuit_breaker_failures": 5,
+    "circuit_breaker_timeout": 60,
     "default_duration": 86400,
     "default_escrow": 28800,
     "default_bond_size": 3.00,
+    "keep_online_concurrency": 8,
+    "keep_online_coordinator_concurrency": 4,
+    "recreate_concurrency": 8,
+    "storage_backend": "files",
+    "book_cache_ttl": 0,
+    "robot_pool_size": 0,
+    "lightning_node_worker": False,
+    "metrics_port": 0,
+    "log_json": False,
+    "log_rotate_size": 0,
+    "log_rotate_hours": 0,
+    "log_rotate_keep": 5,
     "federation": {
         "exp": None,
         "sau": None,
@@ -75,12 +92,82 @@ roboauto_state = {
     "current_command_type": "info",
     "keep_online_hour_relative": False,
     "gpg": None,
+    "gpg_lock": threading.RLock(),
+    "gpg_imported": {},
+    "gpg_trusted": set(),
+    "gpg_agent_cache_ttl": 86400,
     "logger": None,
+    "logger_lock": threading.Lock(),
+    "logger_queue": None,
+    "logger_thread": None,
+    "logger_atexit": False,
+    "logger_file_name": None,
+    "logger_opened_at": 0,
+    "logger_buffer_lines": 10000,
+    "logger_date": (None, None, ""),
+    "logger_context": threading.local(),
     "log_level": 0,
     "filelock_timeout": 120,
+    "requests_sessions": {},
+    "requests_sessions_lock": threading.Lock(),
+    "requests_session_idle_timeout": 300,
     "requests_max_retries": 8,
+    "requests_hosts": {},
+    "requests_circuits": {},
+    "requests_circuits_lock": threading.Lock(),
+    "requests_process_file": None,
+    "requests_processes_fd": None,
+    "requests_processes_lock": threading.Lock(),
+    "requests_processes_exclusive_users": 0,
+    "requests_processes_others": True,
+    "requests_processes_checked": None,
+    "requests_processes_check_interval": 5,
+    "metrics": {},
+    "metrics_lock": threading.Lock(),
+    "metrics_server": None,
+    "requests_hosts_lock": threading.Lock(),
+    "error_interval_maximum": 60,
+    "circuit_breaker_timeout_maximum": 900,
     "sleep_interval": 5,
+    # seconds a client waits for the daemon to start its action, when
+    # the daemon is busy with another action it is run locally
+    "daemon_accept_timeout": 2,
+    # robosats/api/logics.py user_activity_status
+    # 2 minutes Active
+    # 10 minutes Seen recently
+    # every round keep-online checks rewards, updates the waiting
+    # queue and logs the number of checked robots
+    "keep_online_round_seconds": 60,
     "waiting_queue_remove_after": 10,
+    "waiting_queue_lock": threading.RLock(),
+    "order_maximum_lock": threading.RLock(),
+    # robots whose bond is being started, counted in order_maximum
+    "order_maximum_reserved": set(),
+    "robot_registry": {},
+    "robot_registry_mtimes": {},
+    "robot_registry_lock": threading.Lock(),
+    "active_order_index": {
+        "mtime": None,
+        "robots": {},
+        "hours": {}
+    },
+    "active_order_index_lock": threading.RLock(),
+    "storage_local": threading.local(),
+    "storage_stale_lock": threading.Lock(),
+    "dir_watch": {
+        "directories": None,
+        "inotify_fd": None,
+        "watches": {},
+        "mtimes": None
+    },
+    "lightning_node_worker_handle": None,
+    "lightning_node_worker_lock": threading.Lock(),
+    "pay_jobs": {},
+    "pay_jobs_lock": threading.Lock(),
+    "recreate_queue": {},
+    "recreate_queue_lock": threading.Lock(),
+    "robot_pool_refill_event": threading.Event(),
+    "robot_pool_refill_interval": 600,
     "fetch_site": "cross-site",
     # "fetch_site": "same-origin",
     "config_home": "",
@@ -90,12 +177,17 @@ roboauto_state = {
     "inactive_home": "",
     "paused_home": "",
     "coordinators_home": "",
+    "pool_home": "",
     "lock_home": "",
     "gnupg_home": "",
     "log_home": "",
     "waiting_queue_file": "",
     "config_file": "",
     "config_file_hash": None,
+    "config_file_stat": None,
+    "config_reload_requested": False,
+    "config_changed": set(),
+    "config_callbacks": [],
     "message_notification_command": "",
     "lightning_node_command": "",
 }
@@ -4,18 +4,59 @@
 
 # pylint: disable=C0116 missing-function-docstring
 
-import gnupg
+import os
+import hashlib
+import subprocess
 
 from roboauto.global_state import roboauto_state
 from roboauto.logger import print_err
 from roboauto.date_utils import date_get_yesterday
-from roboauto.utils import token_get_double_sha256
+from roboauto.utils import token_get_double_sha256, file_write
+
+
+def gpg_agent_setup():
+    """configure the gpg-agent of the roboauto gnupg home to accept the
+    passphrase from roboauto and to keep unlocked keys cached, then
+    start it, so that it is already running for the first operation
+    and stays alive for the next roboauto processes"""
+    gnupg_home = roboauto_state["gnupg_home"]
+
+    agent_config_file = gnupg_home + "/gpg-agent.conf"
+    if not os.path.isfile(agent_config_file):
+        cache_ttl = roboauto_state["gpg_agent_cache_ttl"]
+        if not file_write(
+            agent_config_file,
+            "allow-loopback-pinentry\n" +
+            f"default-cache-ttl {cache_ttl}\n" +
+            f"max-cache-ttl {cache_ttl}"
+        ):
+            return False
+
+    try:
+        subprocess.run(
+            ["gpgconf", "--launch", "gpg-agent"],
+            env=dict(os.environ, GNUPGHOME=gnupg_home),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            timeout=roboauto_state["filelock_timeout"], check=False
+        )
+    except (OSError, subprocess.SubprocessError):
+        # gpg starts the agent by itself when needed
+        return False
+
+    return True
 
 
 def gpg_get():
-    if roboauto_state["gpg"] is None:
-        roboauto_state["gpg"] = \
-            gnupg.GPG(gnupghome=roboauto_state["gnupg_home"], verbose=False)
+    with roboauto_state["gpg_lock"]:
+        if roboauto_state["gpg"] is None:
+            # imported when first needed, actions without gpg start faster
+            # pylint: disable=C0415 import-outside-toplevel
+            import gnupg
+
+            gpg_agent_setup()
+
+            roboauto_state["gpg"] = \
+                gnupg.GPG(gnupghome=roboauto_state["gnupg_home"], verbose=False)
 
     return roboauto_state["gpg"]
 
@@ -57,19 +98,35 @@ Creation-Date: {yesterday}
 
 
 def gpg_import_key(key, set_trust=True, passphrase=None, error_print=True):
+    """import the key and return its fingerprint, keys already imported
+    and trusted by this process are not passed to gpg again"""
     gpg = gpg_get()
 
-    key = gpg.import_keys(key, passphrase=passphrase)
+    key_digest = hashlib.sha256(str(key).encode("utf8")).hexdigest()
 
-    if not hasattr(key, "count") or key.count != 1:
-        if error_print:
-            print_err("imported key is multiple keys")
-        return False
+    with roboauto_state["gpg_lock"]:
+        fingerprint = roboauto_state["gpg_imported"].get(key_digest, None)
+
+    if fingerprint is None:
+        key = gpg.import_keys(key, passphrase=passphrase)
+
+        if not hasattr(key, "count") or key.count != 1:
+            if error_print:
+                print_err("imported key is multiple keys")
+            return False
+
+        fingerprint = key.fingerprints[0]
 
-    fingerprint = key.fingerprints[0]
+        with roboauto_state["gpg_lock"]:
+            roboauto_state["gpg_imported"][key_digest] = fingerprint
 
     if set_trust is True:
-        gpg.trust_keys(fingerprint, "TRUST_ULTIMATE")
+        with roboauto_state["gpg_lock"]:
+            is_trusted = fingerprint in roboauto_state["gpg_trusted"]
+        if not is_trusted:
+            gpg.trust_keys(fingerprint, "TRUST_ULTIMATE")
+            with roboauto_state["gpg_lock"]:
+                roboauto_state["gpg_trusted"].add(fingerprint)
 
     return fingerprint
 
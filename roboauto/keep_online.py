@@ -3,18 +3,27 @@
 """keep_online.py"""
 
 # pylint: disable=C0116 missing-function-docstring
+# pylint: disable=C0302 too-many-lines
 
+import os
+import re
 import time
+import heapq
+import signal
+import asyncio
+import itertools
+import concurrent.futures
 
 import filelock
 
-from roboauto.logger import print_out, print_err, logger_flush
+from roboauto.logger import \
+    print_out, print_err, logger_flush, logger_context_set, logger_context_clear
 from roboauto.global_state import roboauto_state, roboauto_options
 from roboauto.robot import \
     robot_list_dir, robot_load_from_name, waiting_queue_get, \
     robot_change_dir, robot_get_dir_dic, robot_wait, \
     robot_unwait, robot_check_and_claim_reward, \
-    robot_requests_get_order_id
+    robot_requests_get_order_id, robot_pool_refill_start, robot_pool_refill_notify
 from roboauto.chat import robot_requests_chat, robot_send_chat_message
 from roboauto.order_data import  \
     order_is_public, order_is_paused, order_is_finished, \
@@ -27,7 +36,7 @@ from roboauto.order_data import  \
 from roboauto.order_local import \
     robot_handle_taken, order_dic_from_robot_dir, \
     order_robot_get_last_order_id, order_save_order_file, \
-    order_is_this_hour_and_online, robot_have_make_data, \
+    active_orders_count_this_hour, robot_have_make_data, \
     robot_order_get_local_make_data
 from roboauto.order import \
     order_requests_order_dic, bond_order, make_order, \
@@ -35,11 +44,19 @@ from roboauto.order import \
     order_remove_initial_message_file
 from roboauto.order_action import \
     order_seller_bond_escrow, order_buyer_update_invoice
+from roboauto.subprocess_commands import \
+    pay_jobs_count, pay_jobs_wait, pay_jobs_check
+from roboauto.dir_watch import dir_watch_changes
+from roboauto.metrics import \
+    metrics_observe, metrics_increment, metrics_set, \
+    metrics_server_start, metrics_server_stop, METRICS_BUCKETS_CYCLE_SECONDS
 from roboauto.date_utils import \
     get_current_timestamp, get_current_minutes_from_timestamp, \
     timestamp_from_date_string, date_convert_time_zone_and_format_string
+from roboauto.requests_api import requests_sessions_close
 from roboauto.utils import \
-    update_roboauto_options, lock_file_name_get, \
+    update_roboauto_options, config_callback_add, config_reload_signal_handler, \
+    lock_file_name_get, \
     shuffle_dic, file_is_executable, arg_key_value_number, \
     bad_request_is_cancelled, bad_request_is_wrong_robot
 
@@ -120,7 +137,150 @@ def robot_pending_should_save_order_to_file(order_dic, old_order_dic, robot_dic,
     return return_status
 
 
-def robot_handle_active_expired(robot_dic, all_dic, make_data, expiry_reason=None):
+def active_orders_count_with_bonds():
+    """active orders this hour, counting also the orders whose
+    bond is being started or paid in background and the orders
+    waiting to be recreated, they will be soon online"""
+    with roboauto_state["recreate_queue_lock"]:
+        recreate_number = len(roboauto_state["recreate_queue"])
+
+    with roboauto_state["order_maximum_lock"]:
+        reserved_number = len(roboauto_state["order_maximum_reserved"])
+
+    return \
+        active_orders_count_this_hour() + pay_jobs_count("bond") + \
+        recreate_number + reserved_number
+
+
+def order_maximum_reserve(robot_name):
+    """reserve a slot of order_maximum for the bond of robot_name,
+    the count and the reservation are atomic, the bond is then
+    started without holding order_maximum_lock, return False
+    if order_maximum is reached"""
+    with roboauto_state["order_maximum_lock"]:
+        if active_orders_count_with_bonds() >= roboauto_options["order_maximum"]:
+            return False
+        roboauto_state["order_maximum_reserved"].add(robot_name)
+
+    return True
+
+
+def order_maximum_release(robot_name):
+    """after the bond is started it is counted by the pay jobs"""
+    with roboauto_state["order_maximum_lock"]:
+        roboauto_state["order_maximum_reserved"].discard(robot_name)
+
+
+def recreate_queue_has(robot_name):
+    with roboauto_state["recreate_queue_lock"]:
+        return robot_name in roboauto_state["recreate_queue"]
+
+
+def recreate_queue_add(robot_dic, make_data):
+    """the order will be made by keep_online_recreate_batch
+    together with the other robots expired in the same cycle"""
+    with roboauto_state["recreate_queue_lock"]:
+        roboauto_state["recreate_queue"][robot_dic["name"]] = {
+            "robot_dic": robot_dic,
+            "make_data": make_data,
+            "added": time.time(),
+            "started": False
+        }
+
+    print_out(f"{robot_dic['name']} waiting to be recreated", level=1)
+
+    return True
+
+
+# seconds a robot can wait in the recreate queue while other
+# robots are still being checked
+KEEP_ONLINE_RECREATE_MAXIMUM_WAIT = 10
+
+
+def recreate_queue_should_run(wait_time, checks_running=0):
+    """the batch is run when there are no robots to be checked
+    immediately, so that all the robots expired together are in
+    the same batch, or when a robot has waited too long"""
+    with roboauto_state["recreate_queue_lock"]:
+        added_list = [
+            entry["added"] for entry in roboauto_state["recreate_queue"].values()
+            if not entry["started"]
+        ]
+
+    if len(added_list) < 1:
+        return False
+
+    if (wait_time is None or wait_time > 0) and checks_running < 1:
+        return True
+
+    return time.time() - min(added_list) >= KEEP_ONLINE_RECREATE_MAXIMUM_WAIT
+
+
+def keep_online_recreate_robot(entry):
+    # a robot that fails must not stop the others of the batch
+    # pylint: disable=W0718 broad-exception-caught
+
+    robot_dic = entry["robot_dic"]
+
+    logger_context_set(robot_dic["name"], robot_dic["coordinator"])
+    try:
+        return make_order(
+            robot_dic,
+            entry["make_data"],
+            check_change=True,
+            background=True
+        ) is not False
+    except Exception as e:
+        print_err(f"{robot_dic['name']} recreating order {repr(e)}")
+        return False
+    finally:
+        logger_context_clear()
+
+
+def keep_online_recreate_batch():
+    """make the orders of the robots in the recreate queue at the same
+    time, bonds are then paid in background, return the number of
+    robots that failed"""
+
+    with roboauto_state["recreate_queue_lock"]:
+        entries = [
+            entry for entry in roboauto_state["recreate_queue"].values()
+            if not entry["started"]
+        ]
+        for entry in entries:
+            entry["started"] = True
+
+    if len(entries) < 1:
+        return 0
+
+    starting_time = time.time()
+
+    # entries left in the queue would never be recreated and would
+    # count against order_maximum
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(len(entries), roboauto_options["recreate_concurrency"]))
+        ) as executor:
+            recreated_list = list(executor.map(keep_online_recreate_robot, entries))
+    finally:
+        with roboauto_state["recreate_queue_lock"]:
+            for entry in entries:
+                roboauto_state["recreate_queue"].pop(entry["robot_dic"]["name"], None)
+
+    metrics_observe("keep_online_recreate_seconds", time.time() - starting_time)
+    metrics_increment("keep_online_recreated_total", len(entries))
+
+    failed_number = recreated_list.count(False)
+    print_out(
+        f"{len(entries)} robots recreated in " +
+        f"{int(time.time() - starting_time)} seconds {failed_number} failed",
+        level=1 if failed_number < 1 else 0
+    )
+
+    return failed_number
+
+
+def robot_handle_active_expired(robot_dic, make_data, expiry_reason=None):
     robot_name = robot_dic["name"]
     robot_dir = robot_dic["dir"]
 
@@ -140,33 +300,32 @@ def robot_handle_active_expired(robot_dic, all_dic, make_data, expiry_reason=Non
             print_out(f"{robot_name} unusual expiry, moving to paused")
             return robot_change_dir(robot_name, "paused")
 
-    if count_active_orders_this_hour(all_dic) < roboauto_options["order_maximum"]:
-        if make_data is None or make_data is False:
-            make_data = robot_order_get_local_make_data(robot_dir)
+    if recreate_queue_has(robot_name):
+        return True
+
+    # when robots are checked concurrently the count and the queueing
+    # of the order should be atomic, otherwise order_maximum can be exceeded
+    with roboauto_state["order_maximum_lock"]:
+        if active_orders_count_with_bonds() < roboauto_options["order_maximum"]:
             if make_data is None or make_data is False:
-                print_out(
-                    f"{robot_name} does not have orders and make data, " +
-                    "moving to paused"
-                )
-                return robot_change_dir(robot_name, "paused")
-            print_out(f"{robot_name} creating order from make data")
+                make_data = robot_order_get_local_make_data(robot_dir)
+                if make_data is None or make_data is False:
+                    print_out(
+                        f"{robot_name} does not have orders and make data, " +
+                        "moving to paused"
+                    )
+                    return robot_change_dir(robot_name, "paused")
+                print_out(f"{robot_name} creating order from make data")
 
-        # will return None when maxium robot orders is reached,
-        # it is ok to return True since the robot is checked correctly
-        if make_order(
-            robot_dic,
-            make_data,
-            check_change=True
-        ) is False:
-            return False
-    else:
-        if not robot_wait(robot_name):
-            return False
+            return recreate_queue_add(robot_dic, make_data)
+        else:
+            if not robot_wait(robot_name):
+                return False
 
     return True
 
 
-def robot_handle_active(robot_dic, all_dic):
+def robot_handle_active(robot_dic):
     """handle an active robot"""
 
     robot_name = robot_dic["name"]
@@ -175,7 +334,7 @@ def robot_handle_active(robot_dic, all_dic):
 
     # handle robot with make data
     if robot_have_make_data(robot_dir):
-        return robot_handle_active_expired(robot_dic, all_dic, None)
+        return robot_handle_active_expired(robot_dic, None)
 
     order_id = order_robot_get_last_order_id(robot_dic, error_print=False)
     if order_id is False or order_id is None:
@@ -184,6 +343,8 @@ def robot_handle_active(robot_dic, all_dic):
         if order_id is False or order_id is None:
             return False
 
+    logger_context_set(robot_name, robot_coordinator, order_id)
+
     old_order_dic = order_dic_from_robot_dir(robot_dir, order_id, error_print=False)
 
     # save to file just when status id is different from previous
@@ -208,6 +369,9 @@ def robot_handle_active(robot_dic, all_dic):
     elif isinstance(order_dic, str):
         return False
 
+    # used by the scheduler to decide when to check the robot again
+    robot_dic["order_dic"] = order_dic
+
     order_info = order_dic["order_info"]
 
     status_id = order_info["status"]
@@ -265,15 +429,18 @@ def robot_handle_active(robot_dic, all_dic):
                 print_err("moving " + robot_name + " to paused")
                 return False
         elif order_is_waiting_maker_bond(status_id):
-            if count_active_orders_this_hour(all_dic) < roboauto_options["order_maximum"]:
-                if bond_order(robot_dic, order_id) is False:
-                    return False
+            if order_maximum_reserve(robot_name):
+                try:
+                    if bond_order(robot_dic, order_id, background=True) is False:
+                        return False
+                finally:
+                    order_maximum_release(robot_name)
             else:
                 if not robot_wait(robot_name):
                     return False
         elif order_is_expired(status_id):
             return robot_handle_active_expired(
-                robot_dic, all_dic, order_dic["order_data"],
+                robot_dic, order_dic["order_data"],
                 expiry_reason=order_response_json.get("expiry_reason", None)
             )
         elif \
@@ -296,28 +463,7 @@ def robot_handle_active(robot_dic, all_dic):
     return True
 
 
-def count_active_orders_this_hour(all_dic):
-    robot_this_hour = 0
-
-    for robot_name, robot_info in all_dic.items():
-        robot_state = robot_info["state"]
-        if robot_state != "active":
-            continue
-
-        order_dic = order_dic_from_robot_dir(
-            roboauto_state["active_home"] + "/" + robot_name,
-            order_id=None, error_print=False
-        )
-        if order_dic is False or order_dic is None:
-            continue
-
-        if order_is_this_hour_and_online(order_dic):
-            robot_this_hour += 1
-
-    return robot_this_hour
-
-
-def should_remove_from_waiting_queue(all_dic):
+def should_remove_from_waiting_queue():
     current_timestamp = get_current_timestamp()
 
     # let old orders expire
@@ -325,7 +471,7 @@ def should_remove_from_waiting_queue(all_dic):
     min_minutes = roboauto_state["waiting_queue_remove_after"]
     if \
         current_minutes > min_minutes and \
-        count_active_orders_this_hour(all_dic) < roboauto_options["order_maximum"] and \
+        active_orders_count_this_hour() < roboauto_options["order_maximum"] and \
         len(waiting_queue_get()) > 0:
         return True
 
@@ -347,6 +493,22 @@ def pending_robot_should_act(expires_timestamp, duration, reference):
     return False
 
 
+def pending_robot_seconds_to_act(expires_timestamp, duration, reference):
+    """seconds before pending_robot_should_act will return True,
+    None if it never will"""
+
+    remaining_seconds = expires_timestamp - get_current_timestamp()
+    if remaining_seconds < 0:
+        return None
+
+    if reference > 0:
+        return max(0, remaining_seconds - reference)
+    elif reference < 0:
+        return max(0, remaining_seconds - (duration + reference))
+
+    return None
+
+
 def robot_handle_pending(robot_dic):
     robot_name = robot_dic["name"]
     robot_dir = robot_dic["dir"]
@@ -359,6 +521,8 @@ def robot_handle_pending(robot_dic):
         if order_id is False or order_id is None:
             return False
 
+    logger_context_set(robot_name, robot_coordinator, order_id)
+
     old_order_dic = order_dic_from_robot_dir(robot_dir, order_id, error_print=False)
 
     # save to file just when status id is different from previous
@@ -383,6 +547,9 @@ def robot_handle_pending(robot_dic):
     elif isinstance(order_dic, str):
         return False
 
+    # used by the scheduler to decide when to check the robot again
+    robot_dic["order_dic"] = order_dic
+
     order_response_json = order_dic["order_response_json"]
     order_info = order_dic["order_info"]
 
@@ -442,7 +609,9 @@ def robot_handle_pending(robot_dic):
                             f"{robot_name} {order_id} "
                             f"expires at {date_short_expire}, paying escrow"
                         )
-                        return order_seller_bond_escrow(robot_dic, True)
+                        return order_seller_bond_escrow(
+                            robot_dic, True, background=True
+                        )
                 else:
                     if \
                         order_is_waiting_seller_buyer(status_id) or \
@@ -565,16 +734,131 @@ def robot_check_last_checked(robot_dic, seconds_not_checked):
     return True
 
 
-def robot_dic_update(all_dic):
-    """return number of added and failed robots"""
+def robot_pending_seconds_to_act(robot_dic, order_dic):
+    """seconds before a pending robot has to pay the escrow, send the
+    invoice or send the initial message, None if it does not have to"""
+
+    order_response_json = order_dic["order_response_json"]
+    status_id = order_dic["order_info"]["status"]
+
+    expires_at = order_response_json.get("expires_at", False)
+    if expires_at is False:
+        return None
+    expires_timestamp = timestamp_from_date_string(expires_at)
+
+    is_seller = order_response_json.get("is_seller", False)
+
+    if \
+        order_is_waiting_seller_buyer(status_id) or \
+        order_is_waiting_seller(status_id) or \
+        order_is_waiting_buyer(status_id):
+        if roboauto_options["seconds_pending_order"] == 0:
+            return None
+        if is_seller and order_is_waiting_buyer(status_id):
+            return None
+        if not is_seller and order_is_waiting_seller(status_id):
+            return None
+        escrow_duration = order_response_json.get("escrow_duration", False)
+        if escrow_duration is False:
+            return None
+        return pending_robot_seconds_to_act(
+            expires_timestamp, int(escrow_duration),
+            roboauto_options["seconds_pending_order"]
+        )
+
+    initial_message = order_read_initial_message_from_file(robot_dic["dir"])
+    if initial_message is None or initial_message is False:
+        return None
+    total_secs_exp = order_response_json.get("total_secs_exp", False)
+    timing = initial_message.get("timing", False)
+    if total_secs_exp is False or timing is False:
+        return None
+
+    return pending_robot_seconds_to_act(expires_timestamp, int(total_secs_exp), timing)
+
+
+def robot_next_check_interval(robot_dic, robot_info, robot_checked):
+    """seconds before the robot should be checked again
+    robots about to expire, being taken, with a failed check or that
+    have to do something soon are checked every urgent_interval
+    pending robots at most every pending_interval
+    public robots back off up to active_interval"""
+
+    urgent_interval = max(1, roboauto_options["urgent_interval"])
+
+    order_dic = robot_dic.get("order_dic", None)
+    if robot_checked is False or order_dic is None:
+        return urgent_interval
+
+    order_response_json = order_dic["order_response_json"]
+    status_id = order_dic["order_info"]["status"]
+
+    if robot_info["state"] == "pending":
+        if not order_is_pending(status_id):
+            return urgent_interval
+        pending_interval = max(urgent_interval, roboauto_options["pending_interval"])
+        seconds_to_act = robot_pending_seconds_to_act(robot_dic, order_dic)
+        if seconds_to_act is None:
+            return pending_interval
+        return max(urgent_interval, min(pending_interval, seconds_to_act))
 
-    active_set = robot_list_dir(robot_get_dir_dic()["active"], get_set=True)
-    pending_set = robot_list_dir(robot_get_dir_dic()["pending"], get_set=True)
+    active_interval = max(urgent_interval, roboauto_options["active_interval"])
+
+    # expired robots waiting to be recreated do not change until
+    # they are removed from the waiting queue
+    if order_is_expired(status_id) and robot_dic["name"] in waiting_queue_get():
+        return active_interval
+
+    if not order_is_public(status_id):
+        return urgent_interval
+
+    expires_at = order_response_json.get("expires_at", False)
+    if expires_at is False:
+        return urgent_interval
+    seconds_to_expire = timestamp_from_date_string(expires_at) - get_current_timestamp()
+    if seconds_to_expire < active_interval:
+        return urgent_interval
+
+    previous_interval = robot_info.get("interval", urgent_interval)
+
+    return max(urgent_interval, min(
+        previous_interval * 2, active_interval, seconds_to_expire - active_interval
+    ))
+
+
+def robot_dic_update(all_dic):
+    """update all_dic with the robots added to, removed from or moved
+    between the active and pending directories, the directories are
+    listed just when they are not watched or events were lost
+    return number of added and failed robots"""
+
+    active_dir = robot_get_dir_dic()["active"]
+    pending_dir = robot_get_dir_dic()["pending"]
+
+    robot_names = dir_watch_changes((active_dir, pending_dir))
+    if robot_names is None:
+        active_set = set(robot_list_dir(active_dir, get_set=True))
+        pending_set = set(robot_list_dir(pending_dir, get_set=True))
+        robot_names = set(all_dic) | active_set | pending_set
+    elif len(robot_names) < 1:
+        return 0, 0
+    else:
+        active_set = {
+            robot_name for robot_name in robot_names
+            if os.path.isdir(active_dir + "/" + robot_name)
+        }
+        pending_set = {
+            robot_name for robot_name in robot_names
+            if os.path.isdir(pending_dir + "/" + robot_name)
+        }
 
     added_robots = 0
     failed_robots = 0
 
-    for robot_name, robot_info in list(all_dic.items()):
+    for robot_name in robot_names:
+        robot_info = all_dic.get(robot_name, None)
+        if robot_info is None:
+            continue
         robot_state = robot_info["state"]
         if robot_state == "active":
             if robot_name not in active_set:
@@ -604,7 +888,7 @@ def robot_dic_update(all_dic):
         if robot_active not in all_dic:
             print_out(f"{robot_active} added to active directory")
 
-            if count_active_orders_this_hour(all_dic) >= roboauto_options["order_maximum"]:
+            if active_orders_count_this_hour() >= roboauto_options["order_maximum"]:
                 robot_wait(robot_active)
 
             all_dic[robot_active] = {
@@ -620,7 +904,7 @@ def robot_dic_update(all_dic):
                 failed_robots += 1
                 continue
 
-            if robot_handle_active(robot_dic, all_dic) is False:
+            if robot_handle_active(robot_dic) is False:
                 failed_robots += 1
 
     for robot_pending in pending_set:
@@ -646,19 +930,63 @@ def robot_dic_update(all_dic):
     return added_robots, failed_robots
 
 
-# active_dic is the set of current active robots
-# with an associated time % roboauto_options["active_interval"]
-# pending_dic is the set of current pending robots
-# with an associated time % roboauto_options["pending_interval"]
-# this way robots are not checked all together,
-# but every one is checked at a different time
-def keep_online_no_lock(should_sleep, initial_info):
+def keep_online_check_robot(robot_dic, robot_info):
+    """check a single active or pending robot, return False if
+    the check failed"""
+
+    robot_name = robot_dic["name"]
+    robot_state = robot_info["state"]
+
+    starting_time = time.time()
+
+    robot_dic.pop("order_dic", None)
+
+    logger_context_set(robot_name, robot_dic["coordinator"])
+    try:
+        if robot_state == "active":
+            robot_checked = robot_handle_active(robot_dic)
+        elif robot_state == "pending":
+            robot_checked = robot_handle_pending(robot_dic)
+        else:
+            print_err(f"{robot_name} {robot_state} is not active or pending")
+            robot_checked = False
+    finally:
+        logger_context_clear()
+
+    robot_info["interval"] = robot_next_check_interval(
+        robot_dic, robot_info, robot_checked
+    )
+
+    metrics_observe(
+        "keep_online_check_seconds", time.time() - starting_time,
+        labels={"state": robot_state}
+    )
+    metrics_increment("keep_online_checks_total", labels={
+        "state": robot_state,
+        "result": "failed" if robot_checked is False else "ok"
+    })
+
+    if robot_checked is False:
+        robot_check_last_checked(
+            robot_dic, int(starting_time) - robot_info["last_checked"]
+        )
+        return False
+
+    robot_info["last_checked"] = int(starting_time)
+
+    return True
+
+
+def keep_online_all_dic_get(initial_info):
+    """get the shuffled dictionary of active and pending robots,
+    return None if there are no robots"""
+
     active_list = robot_list_dir(roboauto_state["active_home"])
     pending_list = robot_list_dir(roboauto_state["pending_home"])
 
     if len(active_list) < 1 and len(pending_list) < 1:
         print_out("there are no active or pending robots", date=False)
-        return True
+        return None
 
     if initial_info:
         if len(active_list) >= 1:
@@ -693,115 +1021,498 @@ def keep_online_no_lock(should_sleep, initial_info):
             "last_checked": int(all_starting_time)
         }
 
-    all_dic = shuffle_dic(ordered_all_dic)
+    return shuffle_dic(ordered_all_dic)
+
+
+def keep_online_check_reward(all_dic, robot_check_current):
+    """every loop make a robot requests to check for rewards,
+    return the index of the next robot to check"""
+
+    if len(all_dic) < 1:
+        return 0
+
+    if robot_check_current >= len(all_dic):
+        robot_check_current = 0
+
+    robot_name = list(all_dic.keys())[robot_check_current]
+    robot_dic = robot_load_from_name(robot_name)
+    if robot_dic is False:
+        print_err(f"{robot_name} skipping request robot")
+    else:
+        _ = robot_check_and_claim_reward(robot_dic, error_print_not_found_level=2)
+
+    return robot_check_current + 1
+
+
+def keep_online_metrics_update(all_dic, total_robots, failed_numbers):
+    robots_states = {"active": 0, "pending": 0}
+    for robot_info in list(all_dic.values()):
+        robot_state = robot_info["state"]
+        robots_states[robot_state] = robots_states.get(robot_state, 0) + 1
+    for robot_state, robots_number in robots_states.items():
+        metrics_set("robots", robots_number, labels={"state": robot_state})
+
+    metrics_set("keep_online_round_robots", total_robots)
+    metrics_set("keep_online_round_failed", failed_numbers)
+    metrics_set(
+        "keep_online_unstable",
+        0 if failed_numbers < total_robots / 2 else 1
+    )
+    metrics_set("waiting_queue_robots", len(waiting_queue_get()))
+    metrics_set("orders_online_this_hour", active_orders_count_this_hour())
+    metrics_set("pay_jobs", pay_jobs_count())
+    with roboauto_state["recreate_queue_lock"]:
+        metrics_set("recreate_queue_robots", len(roboauto_state["recreate_queue"]))
+
+
+def keep_online_cycle_new(all_dic):
+    """a cycle ends when every robot present at its start was checked
+    at least once"""
+    return {
+        "starting_time": time.time(),
+        "remaining": set(all_dic)
+    }
+
+
+def keep_online_cycle_checked(cycle, robot_name, all_dic):
+    """remove robot_name from the robots of the cycle still to check,
+    when the cycle ends observe its duration and start a new one"""
+    remaining = cycle["remaining"]
+    remaining.discard(robot_name)
+    if len(remaining) > 0:
+        return cycle
+
+    metrics_observe(
+        "keep_online_cycle_seconds", time.time() - cycle["starting_time"],
+        buckets=METRICS_BUCKETS_CYCLE_SECONDS
+    )
+
+    return keep_online_cycle_new(all_dic)
+
 
-    robot_check_current = 0
+def keep_online_cycle_prune(cycle, all_dic):
+    """robots removed from keep-online are not waited for, called
+    at the end of every round instead of after every check"""
+    cycle["remaining"].intersection_update(all_dic)
+    if len(cycle["remaining"]) > 0:
+        return cycle
 
+    return keep_online_cycle_checked(cycle, None, all_dic)
+
+
+def keep_online_loop_end(all_starting_time, total_robots, failed_numbers, all_dic):
+    if should_remove_from_waiting_queue():
+        robot_unwaited = robot_unwait(waiting_queue_get())
+        if robot_unwaited is not False:
+            print_out(f"{robot_unwaited} removed from waiting queue")
+
+    keep_online_metrics_update(all_dic, total_robots, failed_numbers)
+
+    all_elapsed_time = int(time.time() - all_starting_time)
+    if failed_numbers < total_robots / 2:
+        print_out(
+            f"{total_robots} robots checked in {all_elapsed_time} seconds " +
+            f"{failed_numbers} failed",
+            level=1
+        )
+    else:
+        print_out(
+            f"{total_robots} robots checked in {all_elapsed_time} seconds " +
+            f"{failed_numbers} failed, connection may be instable",
+            level=0
+        )
     logger_flush()
 
-    while True:
-        all_starting_time = time.time()
 
-        total_robots = len(all_dic)
-        if robot_check_current >= total_robots:
-            robot_check_current = 0
+def keep_online_schedule_robot(schedule, robot_name, robot_info):
+    """push the robot in the schedule, it will be checked after
+    robot_info["interval"] seconds"""
+
+    robot_info["next_check"] = time.time() + robot_info.get("interval", 0)
+    heapq.heappush(
+        schedule["heap"],
+        (robot_info["next_check"], next(schedule["counter"]), robot_name)
+    )
+
+
+def keep_online_schedule_update(schedule, all_dic, interval):
+    """push in the schedule the robots of all_dic that are not in it,
+    the robots added by robot_dic_update are already checked"""
+
+    for robot_name, robot_info in list(all_dic.items()):
+        if "next_check" not in robot_info:
+            robot_info["interval"] = interval
+            keep_online_schedule_robot(schedule, robot_name, robot_info)
+
+
+def keep_online_schedule_wait(schedule, all_dic):
+    """return the seconds before the deadline of the first robot in the
+    schedule, None if the schedule is empty
+    robots removed from all_dic or rescheduled are discarded"""
+
+    heap = schedule["heap"]
+    while len(heap) > 0:
+        deadline, _, robot_name = heap[0]
+        robot_info = all_dic.get(robot_name, None)
+        if robot_info is None or robot_info.get("next_check", None) != deadline:
+            heapq.heappop(heap)
+            continue
+        return max(0, deadline - time.time())
 
+    return None
+
+
+def keep_online_schedule_pop(schedule):
+    _, _, robot_name = heapq.heappop(schedule["heap"])
+    return robot_name
+
+
+def keep_online_timeout_get(wait_time, pay_wait, round_starting_time):
+    """seconds to wait before the next robot, payment job or round,
+    wait_time and pay_wait are None when there is nothing to wait"""
+
+    timeouts = [
+        round_starting_time + roboauto_state["keep_online_round_seconds"] - time.time()
+    ]
+    for timeout in (wait_time, pay_wait):
+        if timeout is not None:
+            timeouts.append(timeout)
+
+    return max(0, min(timeouts))
+
+
+# all_dic is the set of current active and pending robots
+# every robot is checked when its deadline in the schedule is reached
+# public robots are checked at most every roboauto_options["active_interval"]
+# pending robots at most every roboauto_options["pending_interval"]
+# this way robots are not checked all together,
+# and robots that need attention are checked before the others
+# if max_rounds is set, return after max_rounds rounds
+def keep_online_no_lock(should_sleep, initial_info, max_rounds=None):
+    all_dic = keep_online_all_dic_get(initial_info)
+    if all_dic is None:
+        return True
+
+    schedule = {
+        "heap": [],
+        "counter": itertools.count()
+    }
+    keep_online_schedule_update(schedule, all_dic, 0)
+
+    robot_check_current = keep_online_check_reward(all_dic, 0)
+
+    round_starting_time = time.time()
+    rounds_number = 0
+    total_robots = 0
+    failed_numbers = 0
+    cycle = keep_online_cycle_new(all_dic)
+
+    logger_flush()
+
+    while True:
         if len(all_dic) < 1:
             print_out("there are no active or pending robots", date=False)
             return True
 
-        # every loop make a robot requests to check for rewards
-        robot_name = list(all_dic.keys())[robot_check_current]
+        if time.time() - round_starting_time >= roboauto_state["keep_online_round_seconds"]:
+            keep_online_loop_end(
+                round_starting_time, total_robots, failed_numbers, all_dic
+            )
+            cycle = keep_online_cycle_prune(cycle, all_dic)
+            rounds_number += 1
+            if max_rounds is not None and rounds_number >= max_rounds:
+                return True
+            round_starting_time = time.time()
+            total_robots = 0
+            failed_numbers = 0
+            robot_check_current = keep_online_check_reward(all_dic, robot_check_current)
+
+        # bonds and escrows being paid are checked between the robots
+        pay_jobs_check()
+
+        wait_time = keep_online_schedule_wait(schedule, all_dic)
+        if recreate_queue_should_run(wait_time):
+            failed_numbers += keep_online_recreate_batch()
+            continue
+        if wait_time is None:
+            keep_online_schedule_update(
+                schedule, all_dic, roboauto_options["urgent_interval"]
+            )
+            continue
+
+        if should_sleep is True and wait_time > 0:
+            time.sleep(keep_online_timeout_get(
+                wait_time, pay_jobs_wait(), round_starting_time
+            ))
+            continue
+
+        robot_name = keep_online_schedule_pop(schedule)
+        robot_info = all_dic[robot_name]
+        robot_state = robot_info["state"]
+
+        total_robots += 1
+
         robot_dic = robot_load_from_name(robot_name)
         if robot_dic is False:
-            print_err(f"{robot_name} skipping request robot")
-        else:
-            _ = robot_check_and_claim_reward(robot_dic, error_print_not_found_level=2)
+            print_err(f"{robot_name} skipping {robot_state} robot")
+            failed_numbers += 1
+            robot_info["interval"] = roboauto_options["urgent_interval"]
+        elif keep_online_check_robot(robot_dic, robot_info) is False:
+            failed_numbers += 1
+        cycle = keep_online_cycle_checked(cycle, robot_name, all_dic)
+
+        if robot_name in all_dic and all_dic[robot_name] is robot_info:
+            keep_online_schedule_robot(schedule, robot_name, robot_info)
+
+        added_robots, additional_failed_robots = robot_dic_update(all_dic)
+        total_robots += added_robots
+        failed_numbers += additional_failed_robots
+        keep_online_schedule_update(
+            schedule, all_dic, roboauto_options["urgent_interval"]
+        )
+
+        # allow to adjust configs while roboauto is running
+        if update_roboauto_options(True) is False:
+            print_err("reading the config file")
 
-        robot_check_current += 1
+        logger_flush()
 
-        failed_numbers = 0
 
-        for robot_name, robot_info in list(all_dic.items()):
-            if robot_name not in all_dic:
-                total_robots -= 1
-                continue
-            robot_state = robot_info["state"]
+async def keep_online_async_check_robot(
+    loop, executor, semaphores, robot_name, robot_info
+):
+    """check a robot in the executor, limiting the number of robots
+    checked at the same time in total and for every coordinator
+    requests of the same robot are still serialized by
+    requests_tor_response, one request per circuit"""
 
-            starting_time = time.time()
+    robot_dic = await loop.run_in_executor(
+        executor, robot_load_from_name, robot_name
+    )
+    if robot_dic is False:
+        print_err(f"{robot_name} skipping {robot_info['state']} robot")
+        robot_info["interval"] = roboauto_options["urgent_interval"]
+        return False
 
-            robot_dic = robot_load_from_name(robot_name)
-            if robot_dic is False:
-                print_err(f"{robot_name} skipping {robot_state} robot")
-                failed_numbers += 1
-                continue
+    coordinator = robot_dic["coordinator"]
+    if coordinator not in semaphores["coordinators"]:
+        semaphores["coordinators"][coordinator] = asyncio.Semaphore(
+            max(1, roboauto_options["keep_online_coordinator_concurrency"])
+        )
 
-            if robot_state == "active":
-                if robot_handle_active(robot_dic, all_dic) is False:
-                    failed_numbers += 1
-                    robot_check_last_checked(
-                        robot_dic, int(starting_time) - robot_info["last_checked"]
+    async with semaphores["coordinators"][coordinator]:
+        async with semaphores["global"]:
+            return await loop.run_in_executor(
+                executor, keep_online_check_robot, robot_dic, robot_info
+            )
+
+
+async def keep_online_async_loop(should_sleep, all_dic, max_rounds=None):
+    # keep-online has to keep running when a background job fails
+    # pylint: disable=W0718 broad-exception-caught
+
+    loop = asyncio.get_running_loop()
+
+    concurrency = max(1, roboauto_options["keep_online_concurrency"])
+
+    schedule = {
+        "heap": [],
+        "counter": itertools.count()
+    }
+    keep_online_schedule_update(schedule, all_dic, 0)
+
+    # robot_name: (robot_info, task)
+    running = {}
+    # bonds and escrows being paid are checked in the executor
+    # while the robots are checked
+    pay_task = None
+    recreate_task = None
+    semaphores = {}
+
+    round_starting_time = time.time()
+    rounds_number = 0
+    total_robots = 0
+    failed_numbers = 0
+    cycle = keep_online_cycle_new(all_dic)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        robot_check_current = await loop.run_in_executor(
+            executor, keep_online_check_reward, all_dic, 0
+        )
+
+        while True:
+            if len(all_dic) < 1 and len(running) < 1:
+                print_out("there are no active or pending robots", date=False)
+                return True
+
+            if \
+                time.time() - round_starting_time >= \
+                roboauto_state["keep_online_round_seconds"]:
+                await loop.run_in_executor(
+                    executor, keep_online_loop_end,
+                    round_starting_time, total_robots, failed_numbers, all_dic
+                )
+                cycle = keep_online_cycle_prune(cycle, all_dic)
+                rounds_number += 1
+                if max_rounds is not None and rounds_number >= max_rounds:
+                    await asyncio.gather(
+                        *(task for _, task in running.values()),
+                        *(task for task in (pay_task, recreate_task) if task is not None)
                     )
+                    return True
+                round_starting_time = time.time()
+                total_robots = 0
+                failed_numbers = 0
+                robot_check_current = await loop.run_in_executor(
+                    executor, keep_online_check_reward, all_dic, robot_check_current
+                )
+
+            # options can change while running, semaphores are recreated
+            # when no robot is being checked
+            if len(running) < 1:
+                semaphores = {
+                    "global": asyncio.Semaphore(
+                        max(1, roboauto_options["keep_online_concurrency"])
+                    ),
+                    "coordinators": {}
+                }
+
+            wait_time = keep_online_schedule_wait(schedule, all_dic)
+            while wait_time is not None and (should_sleep is False or wait_time <= 0):
+                robot_name = keep_online_schedule_pop(schedule)
+                robot_info = all_dic[robot_name]
+                if robot_name in running:
+                    # removed and added again by robot_dic_update while checked
+                    robot_info["interval"] = roboauto_options["urgent_interval"]
+                    keep_online_schedule_robot(schedule, robot_name, robot_info)
                 else:
-                    all_dic[robot_name]["last_checked"] = int(starting_time)
-            elif robot_state == "pending":
-                if robot_handle_pending(robot_dic) is False:
-                    failed_numbers += 1
-                    robot_check_last_checked(
-                        robot_dic, int(starting_time) - robot_info["last_checked"]
+                    running[robot_name] = (robot_info, asyncio.create_task(
+                        keep_online_async_check_robot(
+                            loop, executor, semaphores, robot_name, robot_info
+                        )
+                    ))
+                wait_time = keep_online_schedule_wait(schedule, all_dic)
+
+            pay_wait = None
+            if pay_task is None:
+                pay_wait = pay_jobs_wait()
+                if pay_wait is not None and pay_wait <= 0:
+                    pay_task = asyncio.ensure_future(
+                        loop.run_in_executor(executor, pay_jobs_check)
                     )
-                else:
-                    all_dic[robot_name]["last_checked"] = int(starting_time)
+                    pay_wait = None
+
+            if \
+                recreate_task is None and \
+                recreate_queue_should_run(wait_time, len(running)):
+                recreate_task = asyncio.ensure_future(
+                    loop.run_in_executor(executor, keep_online_recreate_batch)
+                )
+
+            timeout = keep_online_timeout_get(wait_time, pay_wait, round_starting_time)
+
+            if len(running) < 1 and pay_task is None and recreate_task is None:
+                if wait_time is None:
+                    keep_online_schedule_update(
+                        schedule, all_dic, roboauto_options["urgent_interval"]
+                    )
+                    continue
+                await asyncio.sleep(timeout)
+                continue
 
-            added_robots, additional_failed_robots = robot_dic_update(all_dic)
+            tasks = [task for _, task in running.values()]
+            for task in (pay_task, recreate_task):
+                if task is not None:
+                    tasks.append(task)
+            done, _ = await asyncio.wait(
+                tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if len(done) < 1:
+                continue
+
+            if pay_task is not None and pay_task in done:
+                finished_pay_task = pay_task
+                pay_task = None
+                # bonds and escrows are checked again at the next interval
+                try:
+                    finished_pay_task.result()
+                except Exception as e:
+                    print_err(f"checking payments {repr(e)}")
+            if recreate_task is not None and recreate_task in done:
+                finished_recreate_task = recreate_task
+                recreate_task = None
+                failed_numbers += finished_recreate_task.result()
+
+            for robot_name, (robot_info, task) in list(running.items()):
+                if task not in done:
+                    continue
+                running.pop(robot_name)
+                total_robots += 1
+                if task.result() is False:
+                    failed_numbers += 1
+                cycle = keep_online_cycle_checked(cycle, robot_name, all_dic)
+                if robot_name in all_dic and all_dic[robot_name] is robot_info:
+                    keep_online_schedule_robot(schedule, robot_name, robot_info)
+
+            added_robots, additional_failed_robots = await loop.run_in_executor(
+                executor, robot_dic_update, all_dic
+            )
             total_robots += added_robots
             failed_numbers += additional_failed_robots
+            keep_online_schedule_update(
+                schedule, all_dic, roboauto_options["urgent_interval"]
+            )
 
             # allow to adjust configs while roboauto is running
             if update_roboauto_options(True) is False:
                 print_err("reading the config file")
 
-            if len(all_dic) < 1:
-                print_out("there are no active or pending robots", date=False)
-                return True
-
             logger_flush()
 
-            elapsed_time = time.time() - starting_time
 
-            # robosats/api/logics.py user_activity_status
-            # 2 minutes Active
-            # 10 minutes Seen recently
+def keep_online_async_no_lock(should_sleep, initial_info, max_rounds=None):
+    """check the robots concurrently when their deadline is reached,
+    if max_rounds is set return after max_rounds rounds"""
 
-            if should_sleep is True:
-                half_max_time = (120 / len(all_dic)) / 2
-                if elapsed_time < half_max_time:
-                    time.sleep(half_max_time)
+    all_dic = keep_online_all_dic_get(initial_info)
+    if all_dic is None:
+        return True
 
-        if should_remove_from_waiting_queue(all_dic):
-            robot_unwaited = robot_unwait(waiting_queue_get())
-            if robot_unwaited is not False:
-                print_out(f"{robot_unwaited} removed from waiting queue")
+    logger_flush()
 
-        all_elapsed_time = int(time.time() - all_starting_time)
-        if failed_numbers < total_robots / 2:
-            print_out(
-                f"{total_robots} robots checked in {all_elapsed_time} seconds " +
-                f"{failed_numbers} failed",
-                level=1
-            )
-        else:
-            print_out(
-                f"{total_robots} robots checked in {all_elapsed_time} seconds " +
-                f"{failed_numbers} failed, connection may be instable",
-                level=0
-            )
-        logger_flush()
+    return asyncio.run(keep_online_async_loop(should_sleep, all_dic, max_rounds=max_rounds))
+
+
+def keep_online_metrics_port_update():
+    metrics_server_stop()
+
+    if roboauto_options["metrics_port"] > 0:
+        return metrics_server_start(roboauto_options["metrics_port"])
+
+    return True
+
+
+def keep_online_config_callbacks_add():
+    """apply the options changed in the config file while keep-online
+    is running to the components that keep them"""
+
+    # connections kept alive go through the old proxy or to old urls
+    config_callback_add(("tor_host", "tor_port", "federation"), requests_sessions_close)
+    config_callback_add((
+        "robot_pool_size", "robot_maximum_orders", "create_new_after_maximum_orders"
+    ), robot_pool_refill_notify)
+    config_callback_add(("metrics_port",), keep_online_metrics_port_update)
+
+    # kill -HUP reloads the config file
+    signal.signal(signal.SIGHUP, config_reload_signal_handler)
+
+    return True
 
 
 def keep_online(argv):
     should_sleep = True
     initial_info = True
+    engine = "sync"
     while len(argv) >= 1:
         current_arg = argv[0]
         argv = argv[1:]
@@ -810,6 +1521,11 @@ def keep_online(argv):
             should_sleep = False
         elif current_arg == "--no-initial-info":
             initial_info = False
+        elif re.match('^--engine=', current_arg) is not None:
+            engine = current_arg.split("=", 1)[1]
+            if engine not in ("sync", "async"):
+                print_err(f"engine {engine} should be sync or async", date=False)
+                return False
         else:
             arg_verbosity = arg_key_value_number("verbosity", current_arg)
             if arg_verbosity is False:
@@ -829,6 +1545,15 @@ def keep_online(argv):
             lock_file_name_get("keep-online"),
             timeout=0
         ):
+            robot_pool_refill_start()
+
+            keep_online_config_callbacks_add()
+
+            if roboauto_options["metrics_port"] > 0:
+                metrics_server_start(roboauto_options["metrics_port"])
+
+            if engine == "async":
+                return keep_online_async_no_lock(should_sleep, initial_info)
             return keep_online_no_lock(should_sleep, initial_info)
     except filelock.Timeout:
         print_err("keep online is already running", date=False, error=False)
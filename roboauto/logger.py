@@ -4,63 +4,267 @@
 
 # pylint: disable=C0116 missing-function-docstring
 
+import os
 import sys
+import json
+import time
+import queue
+import atexit
+import threading
 
-from roboauto.global_state import roboauto_state
-from roboauto.date_utils import date_get_current
+from roboauto.global_state import roboauto_state, roboauto_options
 
 
-def logger_flush():
-    if roboauto_state["logger"] is not None:
-        roboauto_state["logger"].flush()
+def logger_date_get():
+    """current date in roboauto_options["date_format"], formatted at
+    most once every second"""
+    current_second = int(time.time())
+    date_format = roboauto_options["date_format"]
 
+    date_cached = roboauto_state["logger_date"]
+    if date_cached[0] == current_second and date_cached[1] == date_format:
+        return date_cached[2]
 
-def print_and_log(arg, end="\n", file_stream=None, level: int | bool = True):
+    date_string = time.strftime(date_format, time.localtime(current_second))
+    roboauto_state["logger_date"] = (current_second, date_format, date_string)
+
+    return date_string
+
+
+def logger_context_set(robot_name=None, coordinator=None, order_id=None):
+    """robot, coordinator and order id added to the json lines logged
+    by the current thread"""
+    logger_context = roboauto_state["logger_context"]
+    logger_context.robot = robot_name
+    logger_context.coordinator = coordinator
+    logger_context.order_id = order_id
+
+
+def logger_context_clear():
+    logger_context_set()
+
+
+def logger_context_fields():
+    logger_context = roboauto_state["logger_context"]
+
+    fields = {}
+    for key in ("robot", "coordinator", "order_id"):
+        value = getattr(logger_context, key, None)
+        if value is not None:
+            fields[key] = value
+
+    return fields
+
+
+def logger_file_open():
+    """open the log file, return False if it can not be opened"""
+    try:
+        # pylint: disable=R1732 consider-using-with
+        roboauto_state["logger"] = open(
+            roboauto_state["logger_file_name"], "a", encoding="utf8"
+        )
+    except OSError:
+        return False
+
+    roboauto_state["logger_opened_at"] = time.time()
+
+    return True
+
+
+def logger_should_rotate():
+    log_file = roboauto_state["logger"]
+
+    rotate_size = roboauto_options["log_rotate_size"]
+    if rotate_size > 0 and log_file.tell() >= rotate_size * 1024 * 1024:
+        return True
+
+    rotate_hours = roboauto_options["log_rotate_hours"]
+    if \
+        rotate_hours > 0 and \
+        time.time() - roboauto_state["logger_opened_at"] >= rotate_hours * 3600:
+        return True
+
+    return False
+
+
+def logger_rotate():
+    """move file.log to file.log.1, file.log.1 to file.log.2 and so on,
+    keeping roboauto_options["log_rotate_keep"] old files"""
+    log_file_name = roboauto_state["logger_file_name"]
+    rotate_keep = max(1, roboauto_options["log_rotate_keep"])
+
+    roboauto_state["logger"].close()
+
+    try:
+        for i in range(rotate_keep - 1, 0, -1):
+            if os.path.isfile(f"{log_file_name}.{i}"):
+                os.replace(f"{log_file_name}.{i}", f"{log_file_name}.{i + 1}")
+        os.replace(log_file_name, f"{log_file_name}.1")
+    except OSError as e:
+        print(f"error: rotating {log_file_name} {repr(e)}", file=sys.stderr)
+
+    return logger_file_open()
+
+
+def logger_record_format(record):
+    date_string, kind, message, end, fields = record
+
+    if roboauto_options["log_json"] is not True:
+        if date_string is not None:
+            return "[" + date_string + "] " + message + end
+        return message + end
+
+    message = (message + end).rstrip("\n")
+    if message.strip() == "":
+        return ""
+
+    record_json = {
+        "date": date_string if date_string is not None else logger_date_get(),
+        "level": kind,
+        "message": message
+    }
+    record_json.update(fields)
+
+    return json.dumps(record_json) + "\n"
+
+
+def logger_writer(logger_queue):
+    """write the queued records to the log file, the file is flushed
+    every time the queue is empty, a None record stops the writer"""
+    while True:
+        records = [logger_queue.get()]
+        while records[-1] is not None:
+            try:
+                records.append(logger_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        if roboauto_state["logger"] is not None:
+            try:
+                roboauto_state["logger"].write("".join(
+                    logger_record_format(record) for record in records
+                    if record is not None
+                ))
+                roboauto_state["logger"].flush()
+
+                if logger_should_rotate():
+                    logger_rotate()
+            except (OSError, ValueError) as e:
+                print(f"error: writing log {repr(e)}", file=sys.stderr)
+
+        for _ in records:
+            logger_queue.task_done()
+
+        if records[-1] is None:
+            return
+
+
+def logger_start():
+    """open the log file of the current command and start the writer
+    thread, return False if the log file can not be opened"""
+    with roboauto_state["logger_lock"]:
+        if roboauto_state["logger_queue"] is not None:
+            return True
+
+        roboauto_state["logger_file_name"] = \
+            roboauto_state["log_home"] + "/" + \
+            roboauto_state["current_command_type"] + \
+            ".log"
+        if not logger_file_open():
+            return False
+
+        # lines are not lost when the writer is slower, callers wait
+        # when the buffer is full
+        logger_queue = queue.Queue(maxsize=roboauto_state["logger_buffer_lines"])
+        logger_thread = threading.Thread(
+            target=logger_writer, args=(logger_queue,),
+            name="logger-writer", daemon=True
+        )
+        logger_thread.start()
+
+        roboauto_state["logger_queue"] = logger_queue
+        roboauto_state["logger_thread"] = logger_thread
+
+        if not roboauto_state["logger_atexit"]:
+            atexit.register(logger_close)
+            roboauto_state["logger_atexit"] = True
+
+    return True
+
+
+def logger_flush(wait=False):
+    """the writer flushes the log file every time it has written all
+    the queued lines, if wait is True also wait until that happens"""
+    logger_queue = roboauto_state["logger_queue"]
+    if wait and logger_queue is not None:
+        logger_queue.join()
+
+
+def logger_close():
+    """write the queued lines, stop the writer and close the log file"""
+    with roboauto_state["logger_lock"]:
+        logger_queue = roboauto_state["logger_queue"]
+        if logger_queue is None:
+            return
+
+        logger_queue.put(None)
+        roboauto_state["logger_thread"].join()
+
+        roboauto_state["logger_queue"] = None
+        roboauto_state["logger_thread"] = None
+        if roboauto_state["logger"] is not None:
+            roboauto_state["logger"].close()
+            roboauto_state["logger"] = None
+
+
+def print_and_log(
+    arg, end="\n", file_stream=None, level: int | bool = True,
+    date_string=None, kind="out"
+):
     """level is for writing to stdout/stderr, everything is always
     saved to the log file.
     level goes from 0 (True) -> always log also to the terminal
     to higher integers that will be logged to the terminal just
-    when roboauto_state["log_level"] is high enough"""
+    when roboauto_state["log_level"] is high enough
+    date_string is prepended to the line, kind is the level of the
+    line in the json log"""
 
     if level is True:
         level_int = 0
     else:
         level_int = level
 
+    string_print = str(arg)
+
     if level_int <= roboauto_state["log_level"]:
+        if date_string is not None:
+            terminal_print = "[" + date_string + "] " + string_print
+        else:
+            terminal_print = string_print
         if file_stream is None:
-            print(arg, end=end)
+            print(terminal_print, end=end)
         else:
-            print(arg, end=end, file=file_stream)
+            print(terminal_print, end=end, file=file_stream)
 
     if roboauto_state["current_command_type"] != "info":
-        if roboauto_state["logger"] is None:
-            log_file_name = \
-                roboauto_state["log_home"] + "/" + \
-                roboauto_state["current_command_type"] + \
-                ".log"
-
-            try:
-                # pylint: disable=R1732 consider-using-with
-                roboauto_state["logger"] = open(
-                    log_file_name, "a", encoding="utf8"
-                )
-            except OSError:
+        if roboauto_state["logger_queue"] is None:
+            if not logger_start():
                 return False
 
-        print(arg, end=end, file=roboauto_state["logger"])
+        logger_queue = roboauto_state["logger_queue"]
+        if logger_queue is None:
+            return False
+        logger_queue.put((date_string, kind, string_print, end, logger_context_fields()))
 
     return True
 
 
 def print_out(arg, end="\n", date=True, level: int | bool = True):
-    string_print = str(arg)
-
+    date_string = None
     if roboauto_state["current_command_type"] == "keep-online" and date:
-        date_current = date_get_current()
-        string_print = "[" + date_current + "] " + string_print
+        date_string = logger_date_get()
 
-    print_and_log(string_print, end=end, level=level)
+    print_and_log(arg, end=end, level=level, date_string=date_string)
 
 
 def print_stderr(
@@ -72,11 +276,14 @@ def print_stderr(
     if error:
         string_print = error_string + string_print
 
+    date_string = None
     if roboauto_state["current_command_type"] == "keep-online" and date:
-        date_current = date_get_current()
-        string_print = "[" + date_current + "] " + string_print
+        date_string = logger_date_get()
 
-    print_and_log(string_print, end=end, file_stream=sys.stderr, level=level)
+    print_and_log(
+        string_print, end=end, file_stream=sys.stderr, level=level,
+        date_string=date_string, kind=error_string.split(":", 1)[0]
+    )
 
 
 def print_war(arg, end="\n", date=True, error=True, level: int | bool = True):
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+"""metrics.py"""
+
+# pylint: disable=C0116 missing-function-docstring
+
+import copy
+import threading
+
+from roboauto.logger import print_out, print_err
+from roboauto.global_state import roboauto_state
+
+# prefix of the metrics exposed by the metrics server
+METRICS_PREFIX = "roboauto_"
+
+
+# upper bounds of the buckets of histograms measuring seconds
+METRICS_BUCKETS_SECONDS = (0.001, 0.01, 0.1, 1, 10, 60, 120)
+
+# upper bounds of the buckets of histograms measuring keep-online cycles
+METRICS_BUCKETS_CYCLE_SECONDS = (60, 300, 900, 1800, 3600, 7200, 14400)
+
+
+def metrics_labels_key(labels):
+    if labels is None:
+        return ()
+
+    return tuple(sorted(labels.items()))
+
+
+def metrics_entry_get(name, metric_type, buckets=None):
+    """return the metric name, creating it if it does not exist,
+    roboauto_state["metrics_lock"] should be held"""
+    metrics = roboauto_state["metrics"]
+
+    metric = metrics.get(name, None)
+    if metric is None:
+        metric = {
+            "type": metric_type,
+            "buckets": buckets,
+            "values": {}
+        }
+        metrics[name] = metric
+
+    return metric
+
+
+def metrics_increment(name, value=1, labels=None):
+    """add value to the counter name"""
+    with roboauto_state["metrics_lock"]:
+        values = metrics_entry_get(name, "counter")["values"]
+        labels_key = metrics_labels_key(labels)
+        values[labels_key] = values.get(labels_key, 0) + value
+
+
+def metrics_set(name, value, labels=None):
+    """set the gauge name to value"""
+    with roboauto_state["metrics_lock"]:
+        metrics_entry_get(name, "gauge")["values"][metrics_labels_key(labels)] = value
+
+
+def metrics_observe(name, value, labels=None, buckets=METRICS_BUCKETS_SECONDS):
+    """add value to the histogram name, every bucket counts the
+    values less or equal than its upper bound"""
+    with roboauto_state["metrics_lock"]:
+        metric = metrics_entry_get(name, "histogram", buckets=buckets)
+        labels_key = metrics_labels_key(labels)
+
+        histogram = metric["values"].get(labels_key, None)
+        if histogram is None:
+            histogram = {
+                "buckets": [0] * len(metric["buckets"]),
+                "sum": 0,
+                "count": 0
+            }
+            metric["values"][labels_key] = histogram
+
+        for i, bucket in enumerate(metric["buckets"]):
+            if value <= bucket:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def metrics_get():
+    """return a copy of the metrics
+    name: {"type", "buckets", "values": {labels: value}}"""
+    with roboauto_state["metrics_lock"]:
+        return copy.deepcopy(roboauto_state["metrics"])
+
+
+def metrics_label_value_escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def metrics_labels_string(labels_key, additional_labels=()):
+    labels = list(labels_key) + list(additional_labels)
+    if len(labels) < 1:
+        return ""
+
+    return "{" + ",".join(
+        f"{label}=\"{metrics_label_value_escape(value)}\"" for label, value in labels
+    ) + "}"
+
+
+def metrics_render():
+    """return the metrics in the prometheus text format"""
+    lines = []
+    for name, metric in sorted(metrics_get().items()):
+        full_name = METRICS_PREFIX + name
+        lines.append(f"# TYPE {full_name} {metric['type']}")
+        for labels_key, value in sorted(metric["values"].items()):
+            if metric["type"] != "histogram":
+                lines.append(f"{full_name}{metrics_labels_string(labels_key)} {value}")
+                continue
+
+            for bucket, bucket_count in zip(metric["buckets"], value["buckets"]):
+                labels_string = metrics_labels_string(labels_key, (("le", bucket),))
+                lines.append(f"{full_name}_bucket{labels_string} {bucket_count}")
+            labels_string = metrics_labels_string(labels_key, (("le", "+Inf"),))
+            lines.append(f"{full_name}_bucket{labels_string} {value['count']}")
+            lines.append(f"{full_name}_sum{metrics_labels_string(labels_key)} {value['sum']}")
+            lines.append(
+                f"{full_name}_count{metrics_labels_string(labels_key)} {value['count']}"
+            )
+
+    return "\n".join(lines) + "\n"
+
+
+def metrics_server_start(port):
+    """serve the metrics on http://127.0.0.1:port/metrics in a
+    daemon thread, return False if the port can not be used"""
+
+    # pylint: disable=C0415 import-outside-toplevel
+    import http.server
+
+    if roboauto_state["metrics_server"] is not None:
+        return True
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        """answer GET /metrics"""
+
+        # pylint: disable=C0103 invalid-name
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = metrics_render().encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # pylint: disable=W0622 redefined-builtin
+            pass
+
+    try:
+        metrics_server = http.server.ThreadingHTTPServer(
+            ("127.0.0.1", port), MetricsHandler
+        )
+    except OSError as e:
+        print_err(f"metrics server on port {port} {repr(e)}")
+        return False
+
+    metrics_server.daemon_threads = True
+    roboauto_state["metrics_server"] = metrics_server
+
+    threading.Thread(target=metrics_server.serve_forever, daemon=True).start()
+
+    print_out(f"metrics available at http://127.0.0.1:{port}/metrics")
+
+    return True
+
+
+def metrics_server_stop():
+    metrics_server = roboauto_state["metrics_server"]
+    if metrics_server is None:
+        return True
+
+    metrics_server.shutdown()
+    metrics_server.server_close()
+    roboauto_state["metrics_server"] = None
+
+    return True
@@ -4,11 +4,11 @@
 
 # pylint: disable=C0116 missing-function-docstring
 
+# nostr_sdk is a native extension that takes a long time to load,
+# it and asyncio are imported in the functions that use them
+# pylint: disable=C0415 import-outside-toplevel
+
 import datetime
-import asyncio
-from nostr_sdk import \
-    PublicKey, SecretKey, Keys, ClientBuilder, Proxy, RelayUrl, \
-    EventBuilder, Kind, Tag, Timestamp
 
 from roboauto.logger import print_out, print_err
 from roboauto.utils import \
@@ -18,6 +18,8 @@ from roboauto.date_utils import get_current_timestamp
 
 
 def nostr_pubkey_from_token(token):
+    from nostr_sdk import SecretKey, Keys
+
     # https://github.com/RoboSats/robosats/pull/2055/files
     nostr_seckey = SecretKey.parse(sha512_sha256(token))
     nostr_pubkey = Keys(nostr_seckey).public_key().to_hex()
@@ -41,6 +43,11 @@ def coordinator_relays_get():
 def nostr_create_publish_event(
     token, coord_pubkey, coord_token, coord_short_alias, order_id, rating
 ):
+    import asyncio
+    from nostr_sdk import \
+        PublicKey, SecretKey, Keys, ClientBuilder, Proxy, RelayUrl, \
+        EventBuilder, Kind, Tag, Timestamp
+
     async def _nostr_create_publish_event():
         review_id = 31986
 
@@ -14,13 +14,13 @@ from roboauto.order_data import \
     order_is_public, order_is_paused, order_is_waiting_maker_bond, \
     order_is_waiting_taker_bond, order_is_expired
 from roboauto.order_local import \
-    get_order_data, order_dic_from_robot_dir, \
-    order_save_order_file, get_order_user, order_id_list_from_robot_dir, \
-    order_is_this_hour_and_online, robot_set_make_response, \
-    robot_order_set_local_make_data, robot_order_remove_local_make_data
+    get_order_data, order_save_order_file, get_order_user, \
+    order_id_list_from_robot_dir, active_orders_count_this_hour, \
+    robot_set_make_response, robot_order_set_local_make_data, \
+    robot_order_remove_local_make_data
 from roboauto.robot import \
     robot_change_dir, robot_var_from_dic, robot_requests_get_order_id, \
-    robot_generate, robot_list_dir
+    robot_generate, robot_pool_take
 from roboauto.requests_api import \
     requests_api_order, requests_api_order_cancel, \
     requests_api_make, response_is_error, requests_api_order_take
@@ -28,7 +28,7 @@ from roboauto.utils import \
     json_dumps, string_is_false_none_null, file_is_executable, \
     json_loads, roboauto_get_coordinator_from_url, file_json_write, \
     file_json_read, file_remove, bad_request_is_cancelled
-from roboauto.subprocess_commands import subprocess_pay_invoice_and_check
+from roboauto.subprocess_commands import subprocess_pay_invoice_and_check, pay_job_get
 
 
 def order_user_empty_get():
@@ -304,13 +304,22 @@ def order_string_status_print(robot_name, order_id, order_description, peer_nick
         print_out(f"{robot_name} {peer_nick} {order_id} {order_description}")
 
 
-def bond_order(robot_dic, order_id, taker=False, take_amount=None, use_node=True):
+def bond_order(
+    robot_dic, order_id, taker=False, take_amount=None, use_node=True,
+    background=False
+):
     """bond an order, after checking the invoice with lightning-node check
     will run lightning-node check and lightning-node pay as subprocesses
-    if use_node is True it will simply print out the invoice"""
+    if use_node is True it will simply print out the invoice
+    if background is True it will return after starting the payment,
+    the order is then checked by pay_jobs_check"""
 
     robot_name = robot_dic["name"]
 
+    if pay_job_get(robot_name) is not None:
+        print_out(f"{robot_name} {order_id} bond is being paid", level=1)
+        return True
+
     if taker is False:
         order_function = None
     else:
@@ -387,12 +396,14 @@ def bond_order(robot_dic, order_id, taker=False, take_amount=None, use_node=True
         lambda order_status : not checking_function(order_status),
         "checking if order is bonded...",
         string_paid, string_not_paid,
-        order_requests_order_dic, failure_function
+        order_requests_order_dic, failure_function,
+        job_type="bond", background=background
     )
 
 
 def make_order(
-    robot_dic, make_data, should_bond=True, check_change=False, use_node=True
+    robot_dic, make_data, should_bond=True, check_change=False, use_node=True,
+    background=False
 ):
     """make the request to the coordinator to create an order.
     if should_bond is true, also bond it, if it is false do not create
@@ -429,7 +440,9 @@ def make_order(
                 f"{robot_name} {coordinator} maximum orders {max_orders} reached"
             )
             if roboauto_options["create_new_after_maximum_orders"] is True:
-                new_robot_dic = robot_generate(coordinator, robot_state)
+                new_robot_dic = robot_pool_take(coordinator, robot_state)
+                if new_robot_dic is None:
+                    new_robot_dic = robot_generate(coordinator, robot_state)
                 if new_robot_dic is False:
                     return False
                 new_robot_name = new_robot_dic["name"]
@@ -461,7 +474,8 @@ def make_order(
                     new_robot_dic, make_data,
                     should_bond=should_bond,
                     check_change=check_change,
-                    use_node=use_node
+                    use_node=use_node,
+                    background=background
                 )
             else:
                 print_out(f"{robot_name} moving to inactive")
@@ -472,20 +486,7 @@ def make_order(
                 return None
 
     if should_bond is False:
-        robot_this_hour = 0
-
-        active_list = robot_list_dir(roboauto_state["active_home"])
-        for robot_active in active_list:
-            # pylint: disable=R0801 duplicate-code
-            order_dic = order_dic_from_robot_dir(
-                roboauto_state["active_home"] + "/" + robot_active,
-                order_id=None, error_print=False
-            )
-            if order_dic is False or order_dic is None:
-                continue
-
-            if order_is_this_hour_and_online(order_dic):
-                robot_this_hour += 1
+        robot_this_hour = active_orders_count_this_hour()
 
         order_maximum = roboauto_options["order_maximum"]
         if robot_this_hour >= order_maximum:
@@ -550,7 +551,7 @@ def make_order(
         print_out(f"{robot_name} order {order_id} will not be bonded")
         return True
 
-    return bond_order(robot_dic, order_id, use_node=use_node)
+    return bond_order(robot_dic, order_id, use_node=use_node, background=background)
 
 
 def order_initial_message_file_get(robot_dir):
@@ -35,7 +35,7 @@ from roboauto.requests_api import \
 from roboauto.gpg_key import gpg_sign_message
 from roboauto.subprocess_commands import \
     subprocess_generate_invoice, \
-    subprocess_pay_invoice_and_check
+    subprocess_pay_invoice_and_check, pay_job_get
 from roboauto.chat import robot_requests_chat
 
 
@@ -258,9 +258,15 @@ def order_buyer_update_address(robot_dic, extra_arg):
     )
 
 
-def order_seller_bond_escrow(robot_dic, extra_arg):
+def order_seller_bond_escrow(robot_dic, extra_arg, background=False):
+    """pay the escrow, if background is True return after starting the
+    payment, the order is then checked by pay_jobs_check"""
     robot_name = robot_dic["name"]
 
+    if pay_job_get(robot_name) is not None:
+        print_out(f"{robot_name} escrow is being paid", level=1)
+        return True
+
     order_dic = order_requests_order_dic(robot_dic, order_id=False)
     if order_dic is False or isinstance(order_dic, str):
         return False
@@ -321,7 +327,7 @@ def order_seller_bond_escrow(robot_dic, extra_arg):
         robot_name + "-" + str(peer_nick) + "-" + order_id + "-" + \
         order_user["type"] + "-" + order_user["currency"] + "-" + \
         amount_correct + "-" + premium_string_get(order_user["premium"])
-    if subprocess_pay_invoice_and_check(
+    return subprocess_pay_invoice_and_check(
         robot_dic, order_id,
         escrow_invoice, str(escrow_satoshis), pay_label,
         lambda order_status : \
@@ -331,11 +337,10 @@ def order_seller_bond_escrow(robot_dic, extra_arg):
         "escrow paid successfully",
         "escrow not paid in time",
         order_requests_order_dic, order_is_expired,
-        maximum_retries=100
-    ) is False:
-        return False
-
-    return True
+        maximum_retries=100,
+        completion_function=lambda order_dic : order_dic is not False,
+        job_type="escrow", background=background
+    )
 
 
 def order_post_action_simple(
@@ -4,6 +4,7 @@
 
 # pylint: disable=C0116 missing-function-docstring
 # pylint: disable=C0209 consider-using-f-string
+# pylint: disable=C0302 too-many-lines
 
 import os
 import re
@@ -12,8 +13,9 @@ import shutil
 from roboauto.logger import print_out, print_err
 from roboauto.global_state import roboauto_state, roboauto_options
 from roboauto.date_utils import \
-    date_convert_time_zone_and_format_string, \
-    get_current_timestamp, get_hour_offer, get_current_hour_from_timestamp
+    date_convert_time_zone_and_format_string, timestamp_from_date_string, \
+    get_current_timestamp, get_hour_offer, get_current_hour_from_timestamp, \
+    get_hour_from_date_string
 from roboauto.utils import \
     json_dumps, file_json_read, is_float, get_int, bool_none_to_int_string, \
     dir_make_sure_exists, file_json_write, directory_get_file_numbers, file_remove
@@ -23,7 +25,11 @@ from roboauto.order_data import \
     order_is_public, order_is_paused, order_is_waiting_taker_bond
 from roboauto.robot import \
     robot_list_dir, robot_get_dir_dic, \
-    robot_load_from_name
+    robot_load_from_name, robot_registry_remove
+from roboauto.storage import \
+    storage_is_sqlite, storage_robot_list, storage_robot_set_state, \
+    storage_order_save, storage_active_orders_this_hour, \
+    storage_active_orders_expires_at
 
 
 def get_order_data(
@@ -70,7 +76,14 @@ def get_order_user(
     }
 
 
-def get_offer_dic(offer, coordinator):
+def our_nicks_get():
+    """nicks of the active robots, to mark our offers in the book"""
+    return frozenset(robot_list_dir(roboauto_state["active_home"], get_set=True))
+
+
+def get_offer_dic(offer, coordinator, our_nicks=None):
+    """our_nicks is the result of our_nicks_get, when rendering many
+    offers it should be computed once and passed"""
     offer_id = offer.get("id", "")
     expires_at = offer.get("expires_at", "")
     order_type_bool = offer.get("type", "")
@@ -114,7 +127,9 @@ def get_offer_dic(offer, coordinator):
         amount_format = "%7.3f"
 
     duration = str(int(escrow_duration_seconds / 3600))
-    if maker_nick in robot_list_dir(roboauto_state["active_home"]):
+    if our_nicks is None:
+        our_nicks = our_nicks_get()
+    if maker_nick in our_nicks:
         ours = " * "
     else:
         ours = " - "
@@ -239,6 +254,43 @@ def robot_order_remove_local_make_data(robot_dir):
     return True
 
 
+def robot_and_last_order_list(robot_state, check_coordinator=False, error_print=True):
+    """yield the robots of a state with their last order, from the
+    database when the storage backend is sqlite
+    robot_dic is False for robots that can not be loaded"""
+
+    if storage_is_sqlite():
+        robot_list = storage_robot_list(robot_state)
+        if robot_list is False:
+            yield False, None
+            return
+        for robot_dic in robot_list:
+            order_dic = robot_dic.pop("order_dic")
+            if \
+                check_coordinator and \
+                roboauto_options["federation"].get(robot_dic["coordinator"], None) is None:
+                if error_print:
+                    print_err(f"{robot_dic['name']} coordinator not present")
+                yield False, None
+                continue
+            yield robot_dic, order_dic
+        return
+
+    dir_home = robot_get_dir_dic()[robot_state]
+    for robot_name in robot_list_dir(dir_home):
+        robot_dic = robot_load_from_name(
+            robot_name, check_coordinator=check_coordinator, error_print=error_print
+        )
+        if robot_dic is False:
+            yield False, None
+            continue
+
+        order_dic = order_dic_from_robot_dir(
+            robot_dic["dir"], error_print=False
+        )
+        yield robot_dic, order_dic
+
+
 def robot_print_dir_argv(robot_state, argv):
     print_action = None
     if len(argv) > 0:
@@ -251,15 +303,10 @@ def robot_print_dir_argv(robot_state, argv):
 
     robot_dic_and_expires_at_list = []
 
-    dir_home = robot_get_dir_dic()[robot_state]
-    for robot_name in robot_list_dir(dir_home):
-        robot_dic = robot_load_from_name(robot_name, check_coordinator=False)
+    for robot_dic, order_dic in robot_and_last_order_list(robot_state):
         if robot_dic is False:
             return False
 
-        order_dic = order_dic_from_robot_dir(
-            robot_dic["dir"], error_print=False
-        )
         if order_dic is None or order_dic is False:
             expires_at = ""
         else:
@@ -404,7 +451,7 @@ def robot_no_order_response_print(robot_name, coordinator):
     robot_order_not_complete_print(robot_name, coordinator, "no order response")
 
 
-def order_dic_print(order_dic, robot_name, coordinator, one_line, full_mode):
+def order_dic_print(order_dic, robot_name, coordinator, one_line, full_mode, our_nicks=None):
     # pylint: disable=R1702 too-many-nested-blocks
 
     if not one_line:
@@ -431,7 +478,7 @@ def order_dic_print(order_dic, robot_name, coordinator, one_line, full_mode):
     else:
         if "order_response_json" in order_dic:
             offer_dic_print(get_offer_dic(
-                order_dic["order_response_json"], coordinator
+                order_dic["order_response_json"], coordinator, our_nicks=our_nicks
             ))
         else:
             robot_no_order_response_print(robot_name, coordinator)
@@ -470,10 +517,11 @@ def order_info_local_print_ordered_list(robot_list):
         order_list_unsorted,
         key=lambda order_data: float(order_data["order_dic"]["order_response_json"]["premium"])
     )
+    our_nicks = our_nicks_get()
     for order_data in order_list_sorted:
         order_dic_print(
             order_data["order_dic"], order_data["robot_name"], order_data["coordinator"],
-            one_line=True, full_mode=False
+            one_line=True, full_mode=False, our_nicks=our_nicks
         )
 
     return True
@@ -537,17 +585,15 @@ def order_summary(argv):
         print_err(f"{first_arg} not recognized")
         return False
 
-    for robot_name in os.listdir(robot_get_dir_dic()[first_arg[2:]]):
-        robot_dic = robot_load_from_name(robot_name, error_print=False)
+    for robot_dic, order_dic in robot_and_last_order_list(
+        first_arg[2:], check_coordinator=True, error_print=False
+    ):
         if robot_dic is False:
             continue
 
         robot_dir = robot_dic["dir"]
         coordinator = robot_dic["coordinator"]
 
-        order_dic = order_dic_from_robot_dir(
-            robot_dir, order_id=None, error_print=False
-        )
         if order_dic is not None and order_dic is not False:
             order_user = order_dic.get("order_user", False)
             if order_user is False:
@@ -608,6 +654,12 @@ def order_save_order_file(robot_dir, order_id, order_dic):
         print_err("saving order %s to file" % order_id)
         return False
 
+    active_order_index_update(robot_dir, order_id, order_dic)
+
+    if storage_is_sqlite() and os.path.dirname(robot_dir) in robot_get_dir_dic().values():
+        # on errors the database is marked stale and imported again
+        storage_order_save(os.path.basename(robot_dir), order_id, order_dic)
+
     return True
 
 
@@ -635,6 +687,13 @@ def robot_handle_taken(robot_name, status_id, order_id, other):
             (robot_dir, dest_dir)
         )
         return False
+    finally:
+        robot_registry_remove(robot_name)
+        active_order_index_remove(robot_name)
+
+    if storage_is_sqlite():
+        # on errors the database is marked stale and imported again
+        storage_robot_set_state(robot_name, dest_name)
 
     message_output = message_notification_send(
         "order-taken",
@@ -807,3 +866,157 @@ def order_is_this_hour_and_online(order, coordinator=False):
         return False
 
     return True
+
+
+def active_order_index_entry(order_id, order_dic):
+    """hour and online status of an order,
+    the same used by order_is_this_hour_and_online"""
+
+    order_info = order_dic.get("order_info", False)
+    order_response_json = order_dic.get("order_response_json", False)
+    if order_info is False or order_response_json is False:
+        return None
+
+    expires_at = order_response_json.get("expires_at", False)
+    status_id = order_info.get("status", False)
+    if expires_at is False or status_id is False:
+        return None
+
+    return {
+        "order_id": int(order_id),
+        "expires_timestamp": int(timestamp_from_date_string(expires_at)),
+        "hour": get_hour_from_date_string(expires_at),
+        "online": \
+            order_is_public(status_id) or \
+            order_is_paused(status_id) or \
+            order_is_waiting_taker_bond(status_id)
+    }
+
+
+def active_order_index_set(robot_name, entry):
+    """set the last order of an active robot in the index,
+    None for robots without orders"""
+
+    index = roboauto_state["active_order_index"]
+
+    old_entry = index["robots"].get(robot_name, None)
+    if old_entry is not None:
+        index["hours"].get(old_entry["hour"], set()).discard(robot_name)
+
+    index["robots"][robot_name] = entry
+    if entry is not None and entry["online"]:
+        index["hours"].setdefault(entry["hour"], set()).add(robot_name)
+
+
+def active_order_index_remove(robot_name):
+    index = roboauto_state["active_order_index"]
+
+    with roboauto_state["active_order_index_lock"]:
+        active_order_index_set(robot_name, None)
+        index["robots"].pop(robot_name, None)
+
+
+def active_order_index_load(robot_name):
+    robot_dir = roboauto_state["active_home"] + "/" + robot_name
+
+    order_id = order_id_last_from_robot_dir(robot_dir, error_print=False)
+    if order_id is False or order_id is None:
+        return None
+
+    order_dic = order_dic_from_robot_dir(robot_dir, order_id, error_print=False)
+    if order_dic is False or order_dic is None:
+        return None
+
+    return active_order_index_entry(order_id, order_dic)
+
+
+def active_order_index_sync():
+    """add and remove robots from the index when the active directory
+    changes, the index is built the first time it is used"""
+
+    index = roboauto_state["active_order_index"]
+
+    try:
+        mtime = os.stat(roboauto_state["active_home"]).st_mtime_ns
+    except OSError:
+        return False
+
+    if mtime == index["mtime"]:
+        return True
+
+    active_set = robot_list_dir(roboauto_state["active_home"], get_set=True)
+
+    for robot_name in list(index["robots"].keys()):
+        if robot_name not in active_set:
+            active_order_index_remove(robot_name)
+
+    for robot_name in active_set:
+        if robot_name not in index["robots"]:
+            active_order_index_set(robot_name, active_order_index_load(robot_name))
+
+    index["mtime"] = mtime
+
+    return True
+
+
+def active_order_index_update(robot_dir, order_id, order_dic):
+    """update the index when the last order of an active robot is saved"""
+
+    if os.path.dirname(robot_dir) != roboauto_state["active_home"]:
+        return True
+
+    robot_name = os.path.basename(robot_dir)
+    index = roboauto_state["active_order_index"]
+
+    with roboauto_state["active_order_index_lock"]:
+        # the index is not built yet or the robot was just added
+        if robot_name not in index["robots"]:
+            return True
+
+        old_entry = index["robots"][robot_name]
+        if old_entry is not None and old_entry["order_id"] > int(order_id):
+            return True
+
+        active_order_index_set(robot_name, active_order_index_entry(order_id, order_dic))
+
+    return True
+
+
+def active_orders_count_this_hour():
+    """number of active robots with the last order online
+    and expiring in the current hour"""
+
+    index = roboauto_state["active_order_index"]
+
+    current_timestamp = get_current_timestamp()
+    current_hour = get_current_hour_from_timestamp(current_timestamp)
+
+    if storage_is_sqlite():
+        if not roboauto_state["keep_online_hour_relative"]:
+            robot_this_hour = storage_active_orders_this_hour(current_hour)
+            if robot_this_hour is False:
+                return 0
+            return robot_this_hour
+        expires_timestamp_list = storage_active_orders_expires_at()
+        if expires_timestamp_list is False:
+            return 0
+    else:
+        with roboauto_state["active_order_index_lock"]:
+            if active_order_index_sync() is False:
+                return 0
+
+            if not roboauto_state["keep_online_hour_relative"]:
+                return len(index["hours"].get(current_hour, ()))
+
+            expires_timestamp_list = [
+                entry["expires_timestamp"] for entry in index["robots"].values()
+                if entry is not None and entry["online"]
+            ]
+
+    robot_this_hour = 0
+    for expires_timestamp in expires_timestamp_list:
+        date_hour = (24 - int((current_timestamp - expires_timestamp) / 3600)) % 24
+        if date_hour == current_hour:
+            robot_this_hour += 1
+
+    return robot_this_hour
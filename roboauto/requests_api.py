@@ -4,14 +4,27 @@
 
 # pylint: disable=C0116 missing-function-docstring
 
+# requests and filelock are imported by the functions making the
+# requests, so that actions that do not use the network do not wait
+# for them to load
+# pylint: disable=C0415 import-outside-toplevel
+
+import os
+import fcntl
 import time
+import threading
+import random
+import typing
+import contextlib
+import urllib.parse
 
-import requests
-import filelock
+if typing.TYPE_CHECKING:
+    import requests
 
 from roboauto.logger import print_err
 from roboauto.utils import json_dumps, lock_file_name_get
 from roboauto.global_state import roboauto_options, roboauto_state
+from roboauto.metrics import metrics_observe, metrics_increment
 
 
 def response_is_error(response):
@@ -27,9 +40,366 @@ def response_is_error(response):
     return False
 
 
+def requests_session_get(user):
+    """get the requests session of user, creating it if it does not exist
+    sessions keep the connections alive, so consecutive requests
+    of the same user reuse the same connection through the same
+    tor circuit, sessions not used for requests_session_idle_timeout
+    seconds are closed"""
+
+    import requests
+
+    current_time = time.time()
+    idle_timeout = roboauto_state["requests_session_idle_timeout"]
+
+    with roboauto_state["requests_sessions_lock"]:
+        sessions = roboauto_state["requests_sessions"]
+
+        for session_user, session_entry in list(sessions.items()):
+            if current_time - session_entry["last_used"] > idle_timeout:
+                sessions.pop(session_user)["session"].close()
+
+        session_entry = sessions.get(user, None)
+        if session_entry is None:
+            session_entry = {
+                "session": requests.Session(),
+                "last_used": current_time
+            }
+            sessions[user] = session_entry
+        else:
+            session_entry["last_used"] = current_time
+
+        return session_entry["session"]
+
+
+def requests_session_remove(user):
+    """close the session of user, so that the next request
+    will open a new connection"""
+
+    with roboauto_state["requests_sessions_lock"]:
+        session_entry = roboauto_state["requests_sessions"].pop(user, None)
+        if session_entry is not None:
+            session_entry["session"].close()
+
+
+def requests_sessions_close():
+    """close all the sessions, the next requests will open new
+    connections, used when the tor proxy or the coordinators change"""
+
+    with roboauto_state["requests_sessions_lock"]:
+        for session_entry in roboauto_state["requests_sessions"].values():
+            session_entry["session"].close()
+        roboauto_state["requests_sessions"].clear()
+
+
+def requests_processes_dir_get():
+    return roboauto_state["lock_home"] + "/processes"
+
+
+def requests_processes_lock_file_get():
+    return roboauto_state["lock_home"] + "/processes.lock"
+
+
+def requests_process_register():
+    """save the pid of this process in the processes directory and
+    take a shared lock on the processes lock file, that is kept until
+    global_shutdown removes the file and closes the lock
+    while a process makes requests with the lock taken exclusively
+    the others wait here, it stops taking it when it sees their files"""
+
+    with roboauto_state["requests_processes_lock"]:
+        if roboauto_state["requests_process_file"] is not None:
+            return True
+
+        processes_dir = requests_processes_dir_get()
+        process_file = processes_dir + "/" + str(os.getpid())
+        try:
+            os.makedirs(processes_dir, exist_ok=True)
+            with open(process_file, "w", encoding="utf8"):
+                pass
+        except OSError:
+            print_err(f"creating {process_file}")
+            return False
+
+        lock_file = requests_processes_lock_file_get()
+        deadline = time.monotonic() + \
+            roboauto_state["filelock_timeout"] + roboauto_options["requests_timeout"]
+        processes_fd = None
+        try:
+            processes_fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+            while True:
+                try:
+                    fcntl.lockf(processes_fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    break
+                except (BlockingIOError, PermissionError):
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.1)
+        except OSError:
+            print_err(f"locking {lock_file}")
+            if processes_fd is not None:
+                os.close(processes_fd)
+            try:
+                os.remove(process_file)
+            except OSError:
+                pass
+            return False
+
+        roboauto_state["requests_process_file"] = process_file
+        roboauto_state["requests_processes_fd"] = processes_fd
+
+    return True
+
+
+def requests_processes_others():
+    """return True if another roboauto process is making requests,
+    files of processes that are not running are removed"""
+    processes_dir = requests_processes_dir_get()
+    try:
+        process_pids = os.listdir(processes_dir)
+    except OSError:
+        return True
+
+    own_pid = str(os.getpid())
+    for process_pid in process_pids:
+        if process_pid == own_pid:
+            continue
+        try:
+            os.kill(int(process_pid), 0)
+        except ValueError:
+            continue
+        except PermissionError:
+            return True
+        except OSError:
+            try:
+                os.remove(processes_dir + "/" + process_pid)
+            except OSError:
+                pass
+            continue
+        return True
+
+    return False
+
+
+def requests_process_exclusive_acquire():
+    """return True if this process holds the processes lock
+    exclusively, so that no other process is registered and the file
+    lock of the circuit is not needed, release it with
+    requests_process_exclusive_release
+    the processes directory is checked every
+    requests_processes_check_interval seconds, when other processes
+    are waiting the lock is not taken again and they can register"""
+
+    with roboauto_state["requests_processes_lock"]:
+        current_time = time.monotonic()
+        checked = roboauto_state["requests_processes_checked"]
+        if \
+            checked is None or \
+            current_time - checked > roboauto_state["requests_processes_check_interval"]:
+            roboauto_state["requests_processes_checked"] = current_time
+            roboauto_state["requests_processes_others"] = requests_processes_others()
+
+        if roboauto_state["requests_processes_others"]:
+            return False
+
+        if roboauto_state["requests_processes_exclusive_users"] < 1:
+            # fails if another process holds the shared lock
+            try:
+                fcntl.lockf(
+                    roboauto_state["requests_processes_fd"],
+                    fcntl.LOCK_EX | fcntl.LOCK_NB
+                )
+            except OSError:
+                return False
+
+        roboauto_state["requests_processes_exclusive_users"] += 1
+
+    return True
+
+
+def requests_process_exclusive_release():
+    with roboauto_state["requests_processes_lock"]:
+        roboauto_state["requests_processes_exclusive_users"] -= 1
+        if roboauto_state["requests_processes_exclusive_users"] < 1:
+            # posix locks are converted atomically
+            try:
+                fcntl.lockf(roboauto_state["requests_processes_fd"], fcntl.LOCK_SH)
+            except OSError:
+                print_err(f"unlocking {requests_processes_lock_file_get()}")
+
+
+@contextlib.contextmanager
+def requests_circuit_lock(user, timeout):
+    """one request at a time for every circuit, the threads of this
+    process wait on an in-process lock, the file lock is used just
+    when another roboauto process is registered, that is when this
+    process can not hold the processes lock exclusively
+    yield False if the lock is not acquired in timeout seconds"""
+
+    starting_time = time.monotonic()
+
+    with roboauto_state["requests_circuits_lock"]:
+        circuit = roboauto_state["requests_circuits"].setdefault(
+            user, {"lock": threading.Lock(), "users": 0}
+        )
+        circuit["users"] += 1
+
+    try:
+        if not circuit["lock"].acquire(timeout=timeout):
+            metrics_observe("requests_lock_wait_seconds", time.monotonic() - starting_time)
+            yield False
+            return
+
+        try:
+            if requests_process_exclusive_acquire():
+                try:
+                    metrics_observe(
+                        "requests_lock_wait_seconds", time.monotonic() - starting_time
+                    )
+                    metrics_increment("requests_locks_total", labels={"lock": "process"})
+                    yield True
+                finally:
+                    requests_process_exclusive_release()
+                return
+
+            import filelock
+
+            file_lock = filelock.FileLock(lock_file_name_get(user))
+            try:
+                file_lock.acquire(
+                    timeout=max(0, timeout - (time.monotonic() - starting_time))
+                )
+            except filelock.Timeout:
+                metrics_observe(
+                    "requests_lock_wait_seconds", time.monotonic() - starting_time
+                )
+                yield False
+                return
+
+            try:
+                metrics_observe(
+                    "requests_lock_wait_seconds", time.monotonic() - starting_time
+                )
+                metrics_increment("requests_locks_total", labels={"lock": "file"})
+                yield True
+            finally:
+                file_lock.release()
+        finally:
+            circuit["lock"].release()
+    finally:
+        with roboauto_state["requests_circuits_lock"]:
+            circuit["users"] -= 1
+            if circuit["users"] < 1:
+                roboauto_state["requests_circuits"].pop(user, None)
+
+
+def requests_backoff_get(base, attempt, maximum):
+    """exponential backoff with equal jitter, so that the robots of
+    a coordinator do not retry all at the same time"""
+    backoff = min(maximum, base * 2 ** min(attempt, 16))
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+def requests_host_get(url):
+    return urllib.parse.urlsplit(url).netloc
+
+
+def requests_coordinator_label(host):
+    """the coordinator of host, used as label of the metrics"""
+    for coordinator, coordinator_info in roboauto_options["federation"].items():
+        if not isinstance(coordinator_info, dict):
+            continue
+        if requests_host_get(coordinator_info.get("url", "")) == host:
+            return coordinator
+
+    return host
+
+
+def requests_host_allowed(host, timeout):
+    """return False while the circuit of host is open, after too many
+    consecutive failures requests fail fast until the backoff is over,
+    then a single request is let through to probe the host, the
+    others fail until the probe ends or timeout seconds are passed"""
+
+    if roboauto_options["circuit_breaker_failures"] < 1:
+        return True
+
+    current_time = time.time()
+    with roboauto_state["requests_hosts_lock"]:
+        host_health = roboauto_state["requests_hosts"].get(host, None)
+        if \
+            host_health is None or \
+            host_health["failures"] < roboauto_options["circuit_breaker_failures"]:
+            return True
+        if current_time < host_health["open_until"]:
+            return False
+        host_health["open_until"] = current_time + timeout
+
+    return True
+
+
+def requests_host_is_open(host):
+    if roboauto_options["circuit_breaker_failures"] < 1:
+        return False
+
+    with roboauto_state["requests_hosts_lock"]:
+        host_health = roboauto_state["requests_hosts"].get(host, None)
+        return \
+            host_health is not None and \
+            host_health["failures"] >= roboauto_options["circuit_breaker_failures"] and \
+            time.time() < host_health["open_until"]
+
+
+def requests_host_success(host):
+    with roboauto_state["requests_hosts_lock"]:
+        host_health = roboauto_state["requests_hosts"].pop(host, None)
+
+    if \
+        host_health is not None and \
+        host_health["failures"] >= roboauto_options["circuit_breaker_failures"] > 0:
+        print_err(f"{host} is reachable again", error=False)
+
+
+def requests_latency_observe(host, starting_time):
+    metrics_observe(
+        "requests_seconds", time.monotonic() - starting_time,
+        labels={"coordinator": requests_coordinator_label(host)}
+    )
+
+
+def requests_host_failure(host):
+    failures_maximum = roboauto_options["circuit_breaker_failures"]
+
+    metrics_increment(
+        "requests_errors_total", labels={"coordinator": requests_coordinator_label(host)}
+    )
+
+    with roboauto_state["requests_hosts_lock"]:
+        host_health = roboauto_state["requests_hosts"].setdefault(
+            host, {"failures": 0, "open_until": 0}
+        )
+        host_health["failures"] += 1
+        if failures_maximum < 1 or host_health["failures"] < failures_maximum:
+            return
+
+        open_seconds = requests_backoff_get(
+            roboauto_options["circuit_breaker_timeout"],
+            host_health["failures"] - failures_maximum,
+            roboauto_state["circuit_breaker_timeout_maximum"]
+        )
+        host_health["open_until"] = time.time() + open_seconds
+
+    print_err(
+        f"{host} failed {host_health['failures']} times, " +
+        f"not making requests for {int(open_seconds)} seconds"
+    )
+
+
 def requests_tor_response(
     url: str, user, timeout, headers, data, error_print=True
-) -> requests.Response | bool | None:
+) -> "requests.Response | bool | None":
+    import requests
+
     if not url.startswith("http://127.0.0.1"):
         tor_socks = \
             user + ":" + user + "@" + \
@@ -41,32 +411,53 @@ def requests_tor_response(
     else:
         proxies = None
 
+    host = requests_host_get(url)
+    if not requests_host_allowed(host, timeout):
+        metrics_increment(
+            "requests_circuit_open_total",
+            labels={"coordinator": requests_coordinator_label(host)}
+        )
+        if error_print is not False and error_print is not None:
+            print_err(f"{host} is not reachable, circuit open", level=error_print)
+        return None
+
+    if not requests_process_register():
+        return False
+
+    # set again when the request is made, after the lock is acquired
+    starting_time = time.monotonic()
+
     # one concurrent connection per circuit
     try:
         filelock_timeout = roboauto_state["filelock_timeout"]
-        try:
-            with filelock.FileLock(
-                lock_file_name_get(user),
-                timeout=filelock_timeout
-            ):
-                if data is None:
-                    return requests.get(
-                        url, proxies=proxies, timeout=timeout,
-                        headers=headers
-                    )
-                else:
-                    return requests.post(
-                        url, proxies=proxies, timeout=timeout,
-                        headers=headers, data=data
-                    )
-        except filelock.Timeout:
-            if error_print is not False and error_print is not None:
-                print_err(f"{user} filelock timeout {filelock_timeout}", level=error_print)
+        with requests_circuit_lock(user, filelock_timeout) as circuit_locked:
+            if not circuit_locked:
+                if error_print is not False and error_print is not None:
+                    print_err(f"{user} lock timeout {filelock_timeout}", level=error_print)
 
-            return False
+                return False
+
+            session = requests_session_get(user)
+            starting_time = time.monotonic()
+            if data is None:
+                response = session.get(
+                    url, proxies=proxies, timeout=timeout,
+                    headers=headers
+                )
+            else:
+                response = session.post(
+                    url, proxies=proxies, timeout=timeout,
+                    headers=headers, data=data
+                )
     except requests.exceptions.RequestException as e:
         error_string = str(e)
 
+        requests_latency_observe(host, starting_time)
+        requests_host_failure(host)
+
+        # the connection may be broken, do not reuse it
+        requests_session_remove(user)
+
         if error_print is not False and error_print is not None:
             print_err(error_string, date=False, error=False, level=error_print)
 
@@ -75,13 +466,25 @@ def requests_tor_response(
         else:
             return False
 
+    requests_latency_observe(host, starting_time)
+
+    # 5xx are errors of the coordinator, 4xx are errors of the request
+    if response_is_error(response):
+        requests_host_failure(host)
+    else:
+        requests_host_success(host)
+
+    return response
+
 
 def requests_tor(url, user, headers, data=None, options=None):
     requests_options = {
         "until_true": True,
         "error_print": True,
         "timeout": roboauto_options["requests_timeout"],
-        "max_retries": roboauto_state["requests_max_retries"]
+        "max_retries": roboauto_state["requests_max_retries"],
+        # time.monotonic after which requests are not retried
+        "deadline": None
     }
 
     if options is not None and options is not False:
@@ -96,6 +499,7 @@ def requests_tor(url, user, headers, data=None, options=None):
     error_print = requests_options["error_print"]
     timeout = requests_options["timeout"]
     max_retries = requests_options["max_retries"]
+    deadline = requests_options["deadline"]
 
     if until_true:
         error_happened = False
@@ -105,6 +509,14 @@ def requests_tor(url, user, headers, data=None, options=None):
         request_failed = 0
         while response_is_error(response):
             error_happened = True
+
+            # a coordinator that is down is not retried, robots of other
+            # coordinators can be checked in the meantime
+            if requests_host_is_open(requests_host_get(url)):
+                if error_print is not False and error_print is not None:
+                    print_err(f"not retrying {url}, circuit open", level=error_print)
+                return False
+
             if error_print is not False and error_print is not None:
                 status_code = "error"
                 if not isinstance(response, bool) and response is not None:
@@ -119,14 +531,29 @@ def requests_tor(url, user, headers, data=None, options=None):
                 )
 
             request_failed += 1
+            metrics_increment("requests_retries_total", labels={
+                "coordinator": requests_coordinator_label(requests_host_get(url))
+            })
             if request_failed >= max_retries:
                 if error_print is not False and error_print is not None:
                     print_err("maximum retries reached", level=error_print)
                 return False
 
-            time.sleep(roboauto_options["error_interval"])
+            backoff = requests_backoff_get(
+                roboauto_options["error_interval"], request_failed - 1,
+                roboauto_state["error_interval_maximum"]
+            )
+            retry_timeout = timeout
+            if deadline is not None:
+                retry_timeout = min(timeout, deadline - time.monotonic() - backoff)
+                if retry_timeout <= 0:
+                    if error_print is not False and error_print is not None:
+                        print_err("deadline reached", level=error_print)
+                    return False
+
+            time.sleep(backoff)
             response = requests_tor_response(
-                url, user, timeout, headers, data, error_print=bool(error_print)
+                url, user, retry_timeout, headers, data, error_print=bool(error_print)
             )
         if error_happened:
             if error_print is not False and error_print is not None:
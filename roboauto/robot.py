@@ -3,10 +3,12 @@
 """robot.py"""
 
 # pylint: disable=C0116 missing-function-docstring
+# pylint: disable=C0302 too-many-lines
 
 import os
 import re
 import shutil
+import threading
 
 from roboauto.logger import print_out, print_err, print_war
 from roboauto.requests_api import \
@@ -22,12 +24,15 @@ from roboauto.utils import \
     roboauto_first_coordinator, file_is_executable, \
     roboauto_get_coordinator_url, \
     roboauto_get_coordinator_from_argv, \
+    roboauto_get_multi_coordinators_from_argv, get_uint, \
     token_get_base91, sha256_single, \
     dir_make_sure_exists, \
     string_from_multiline_format, string_to_multiline_format
 from roboauto.gpg_key import gpg_generate_robot, gpg_import_key, gpg_sign_message
 from roboauto.subprocess_commands import subprocess_generate_invoice
 from roboauto.nostr import nostr_pubkey_from_token
+from roboauto.storage import \
+    storage_is_sqlite, storage_robot_save, storage_robot_set_state
 
 
 def robot_get_dir_dic():
@@ -72,7 +77,76 @@ def robot_var_from_dic(robot_dic):
         roboauto_get_coordinator_url(robot_dic["coordinator"])
 
 
+def robot_registry_sync():
+    """remove from the registry the robots of the state directories
+    that changed, robots moved by other processes are loaded again"""
+
+    mtimes = {}
+    for robot_state, state_dir in robot_get_dir_dic().items():
+        try:
+            mtimes[robot_state] = os.stat(state_dir).st_mtime_ns
+        except OSError:
+            mtimes[robot_state] = None
+
+    registry = roboauto_state["robot_registry"]
+    old_mtimes = roboauto_state["robot_registry_mtimes"]
+    if mtimes == old_mtimes:
+        return True
+
+    changed_states = {
+        robot_state for robot_state, mtime in mtimes.items()
+        if old_mtimes.get(robot_state, None) != mtime
+    }
+    for robot_name, robot_dic in list(registry.items()):
+        if robot_dic["state"] in changed_states:
+            registry.pop(robot_name, None)
+
+    roboauto_state["robot_registry_mtimes"] = mtimes
+
+    return True
+
+
+def robot_registry_get(robot_name):
+    """return a copy of the robot in the registry, None if not present"""
+
+    with roboauto_state["robot_registry_lock"]:
+        robot_registry_sync()
+        robot_dic = roboauto_state["robot_registry"].get(robot_name, None)
+        if robot_dic is None:
+            return None
+        return robot_dic.copy()
+
+
+def robot_registry_add(robot_dic):
+    with roboauto_state["robot_registry_lock"]:
+        robot_registry_sync()
+        roboauto_state["robot_registry"][robot_dic["name"]] = {
+            "name": robot_dic["name"],
+            "state": robot_dic["state"],
+            "dir": robot_dic["dir"],
+            "token": robot_dic["token"],
+            "coordinator": robot_dic["coordinator"]
+        }
+
+
+def robot_registry_remove(robot_name=None):
+    """remove a robot from the registry, all the robots if None"""
+
+    with roboauto_state["robot_registry_lock"]:
+        if robot_name is None:
+            roboauto_state["robot_registry"].clear()
+        else:
+            roboauto_state["robot_registry"].pop(robot_name, None)
+
+
 def robot_load_from_name(robot_name, check_coordinator=True, error_print=True):
+    robot_dic = robot_registry_get(robot_name)
+    if robot_dic is not None:
+        if check_coordinator:
+            if roboauto_get_coordinator_url(robot_dic["coordinator"]) is False:
+                return False
+        return robot_dic
+
     possible_state_base_dir = robot_get_dir_dic()
     found = False
     robot_dir = ""
@@ -115,13 +189,19 @@ def robot_load_from_name(robot_name, check_coordinator=True, error_print=True):
                 print_war(f"{robot_name} reading coordinator, using default")
             coordinator = roboauto_first_coordinator()
 
-    return robot_get_dic(
+    robot_dic = robot_get_dic(
         robot_name, robot_state, robot_dir, token, coordinator,
         check_coordinator=check_coordinator
     )
+    if robot_dic is not False:
+        robot_registry_add(robot_dic)
+
+    return robot_dic
 
 
 def robot_save_to_disk_and_get_dic(robot_name, robot_state, robot_dir, token, coordinator):
+    robot_registry_remove(robot_name)
+
     if os.makedirs(robot_dir) is not None:
         print_err("creating directory")
         return False
@@ -136,6 +216,10 @@ def robot_save_to_disk_and_get_dic(robot_name, robot_state, robot_dir, token, co
     if file_write(robot_dir + "/coordinator", coordinator) is False:
         return False
 
+    if storage_is_sqlite():
+        # on errors the database is marked stale and imported again
+        storage_robot_save(robot_name, robot_state, token, coordinator)
+
     return robot_get_dic(robot_name, robot_state, robot_dir, token, coordinator)
 
 
@@ -275,6 +359,7 @@ def robot_change_dir(robot_name, destination_state, error_is_already=True):
     destination_dir = robot_get_dir_dic()[destination_state]
 
     if robot_name != "--all":
+        robot_registry_remove(robot_name)
         robot_dic = robot_load_from_name(robot_name)
         if robot_dic is False:
             return False
@@ -290,6 +375,11 @@ def robot_change_dir(robot_name, destination_state, error_is_already=True):
             except OSError:
                 print_err(f"moving {robot_name} to {destination_state}")
                 return False
+            finally:
+                robot_registry_remove(robot_name)
+            if storage_is_sqlite():
+                # on errors the database is marked stale and imported again
+                storage_robot_set_state(robot_name, destination_state)
     else:
         if destination_dir == roboauto_state["active_home"]:
             print_err("you can not set all robots active for privacy concerns")
@@ -301,6 +391,11 @@ def robot_change_dir(robot_name, destination_state, error_is_already=True):
             except OSError:
                 print_err(f"moving {robot_name} to {destination_state}")
                 return False
+            finally:
+                robot_registry_remove(active_robot)
+            if storage_is_sqlite():
+                # on errors the database is marked stale and imported again
+                storage_robot_set_state(active_robot, destination_state)
 
     return True
 
@@ -527,7 +622,10 @@ def robot_save_gpg_public_private(robot_dic, robot_response_json):
     return True
 
 
-def robot_generate(coordinator, robot_state):
+def robot_generate_registered(coordinator):
+    """generate the token and the keys of a new robot and register it
+    on the coordinator, return a dictionary with the name, the token
+    and the keys of the robot, nothing is saved on disk"""
     coordinator_url = roboauto_get_coordinator_url(coordinator)
     if coordinator_url is False:
         return False
@@ -562,6 +660,22 @@ def robot_generate(coordinator, robot_state):
         print_err("getting robot name")
         return False
 
+    return {
+        "name": robot_name,
+        "token": token,
+        "fingerprint": fingerprint,
+        "public_key": public_key,
+        "private_key": private_key
+    }
+
+
+def robot_generate(coordinator, robot_state):
+    generated_robot = robot_generate_registered(coordinator)
+    if generated_robot is False:
+        return False
+
+    robot_name = generated_robot["name"]
+
     robot_dir = robot_get_dir_dic()[robot_state] + "/" + robot_name
 
     if os.path.exists(robot_dir):
@@ -572,13 +686,14 @@ def robot_generate(coordinator, robot_state):
         return False
 
     robot_dic = robot_save_to_disk_and_get_dic(
-        robot_name, robot_state, robot_dir, token, coordinator
+        robot_name, robot_state, robot_dir, generated_robot["token"], coordinator
     )
     if robot_dic is False:
         return False
 
     if not robot_save_gpg_keys(
-        robot_dir, public_key, private_key, fingerprint, set_default=True
+        robot_dir, generated_robot["public_key"], generated_robot["private_key"],
+        generated_robot["fingerprint"], set_default=True
     ):
         return False
 
@@ -606,6 +721,198 @@ def robot_generate_argv(argv):
     return True
 
 
+def robot_pool_dir_get(coordinator):
+    return roboauto_state["pool_home"] + "/" + coordinator
+
+
+def robot_pool_list(coordinator):
+    """robots ready in the pool of the coordinator, robots still
+    being written start with a dot"""
+    pool_dir = robot_pool_dir_get(coordinator)
+    if not os.path.isdir(pool_dir):
+        return []
+
+    return [
+        robot_name for robot_name in robot_list_dir(pool_dir)
+        if not robot_name.startswith(".")
+    ]
+
+
+def robot_pool_add(coordinator):
+    """generate a robot registered on the coordinator and put it in the
+    pool, it is written in a temporary directory and then renamed so
+    that other processes never take a robot not completely written"""
+    pool_dir = robot_pool_dir_get(coordinator)
+    if not dir_make_sure_exists(pool_dir):
+        return False
+
+    generated_robot = robot_generate_registered(coordinator)
+    if generated_robot is False:
+        return False
+
+    robot_name = generated_robot["name"]
+
+    robot_dir_tmp = pool_dir + "/." + robot_name
+    try:
+        os.makedirs(robot_dir_tmp)
+    except OSError:
+        print_err(f"creating {robot_dir_tmp}")
+        return False
+
+    if \
+        file_write(robot_dir_tmp + "/token", generated_robot["token"]) is False or \
+        file_write(robot_dir_tmp + "/coordinator", coordinator) is False or \
+        not robot_save_gpg_keys(
+            robot_dir_tmp, generated_robot["public_key"], generated_robot["private_key"],
+            generated_robot["fingerprint"], set_default=True
+        ):
+        shutil.rmtree(robot_dir_tmp, ignore_errors=True)
+        return False
+
+    try:
+        os.rename(robot_dir_tmp, pool_dir + "/" + robot_name)
+    except OSError:
+        print_err(f"{robot_name} moving to the pool of {coordinator}")
+        shutil.rmtree(robot_dir_tmp, ignore_errors=True)
+        return False
+
+    return robot_name
+
+
+def robot_pool_take(coordinator, robot_state):
+    """move a robot from the pool of the coordinator to the robot_state
+    directory, return None if the pool is empty"""
+    pool_dir = robot_pool_dir_get(coordinator)
+    destination_dir = robot_get_dir_dic()[robot_state]
+
+    for robot_name in robot_pool_list(coordinator):
+        robot_dir = destination_dir + "/" + robot_name
+        if os.path.exists(robot_dir):
+            print_err(f"robot {robot_name} in the pool of {coordinator} already exists")
+            continue
+
+        # the rename fails if another process already took the robot
+        try:
+            os.rename(pool_dir + "/" + robot_name, robot_dir)
+        except FileNotFoundError:
+            continue
+        except OSError:
+            print_err(f"{robot_name} moving from the pool of {coordinator}")
+            return False
+
+        robot_pool_refill_notify()
+
+        robot_registry_remove(robot_name)
+
+        token = file_read(robot_dir + "/token")
+        if token is False:
+            return False
+
+        if storage_is_sqlite():
+            # on errors the database is marked stale and imported again
+            storage_robot_save(robot_name, robot_state, token, coordinator)
+
+        return robot_get_dic(robot_name, robot_state, robot_dir, token, coordinator)
+
+    return None
+
+
+def robot_pool_fill(coordinators, pool_size):
+    """generate robots until the pools of the coordinators have
+    pool_size robots, return False if some could not be generated"""
+    return_status = True
+
+    for coordinator in coordinators:
+        while len(robot_pool_list(coordinator)) < pool_size:
+            robot_name = robot_pool_add(coordinator)
+            if robot_name is False:
+                print_err(f"generating a robot for the pool of {coordinator}")
+                return_status = False
+                break
+            print_out(f"{robot_name} added to the pool of {coordinator}")
+
+    return return_status
+
+
+def robot_pool_coordinators_get():
+    """coordinators of the active robots, the ones that could need
+    a new robot when the maximum orders of a robot is reached"""
+    coordinators = set()
+    for robot_name in robot_list_dir(roboauto_state["active_home"]):
+        robot_dic = robot_load_from_name(robot_name, error_print=False)
+        if robot_dic is not False:
+            coordinators.add(robot_dic["coordinator"])
+
+    return sorted(coordinators)
+
+
+def robot_pool_refill_notify():
+    roboauto_state["robot_pool_refill_event"].set()
+
+
+def robot_pool_refill_loop():
+    # the pool has to keep being refilled when a fill fails
+    # pylint: disable=W0718 broad-exception-caught
+
+    refill_event = roboauto_state["robot_pool_refill_event"]
+    while True:
+        refill_event.clear()
+        pool_size = roboauto_options["robot_pool_size"]
+        if \
+            pool_size > 0 and \
+            roboauto_options["robot_maximum_orders"] > 0 and \
+            roboauto_options["create_new_after_maximum_orders"] is True:
+            try:
+                robot_pool_fill(robot_pool_coordinators_get(), pool_size)
+            except Exception as e:
+                print_err(f"refilling robot pool {repr(e)}")
+        refill_event.wait(timeout=roboauto_state["robot_pool_refill_interval"])
+
+
+def robot_pool_refill_start():
+    """keep the pools of the coordinators of the active robots full in
+    a background thread, it is woken up when a robot is taken"""
+    refill_thread = threading.Thread(
+        target=robot_pool_refill_loop, name="robot-pool-refill", daemon=True
+    )
+    refill_thread.start()
+
+    return True
+
+
+def robot_pool_argv(argv):
+    if len(argv) >= 1 and re.match('^--', argv[0]) is not None:
+        coordinators, argv = roboauto_get_multi_coordinators_from_argv(argv)
+        if coordinators is False:
+            return False
+        coordinators = [
+            coordinator for coordinator in coordinators
+            if roboauto_options["federation"].get(coordinator, None) is not None
+        ]
+    else:
+        coordinators = robot_pool_coordinators_get()
+
+    if len(argv) >= 1:
+        pool_size = get_uint(argv[0])
+        if pool_size is False:
+            return False
+        argv = argv[1:]
+    else:
+        pool_size = roboauto_options["robot_pool_size"]
+
+    if pool_size < 1:
+        print_err("pool size is 0, set robot_pool_size or pass the size")
+        return False
+
+    if robot_pool_fill(coordinators, pool_size) is False:
+        return False
+
+    for coordinator in coordinators:
+        print_out(f"{coordinator} {len(robot_pool_list(coordinator))}")
+
+    return True
+
+
 def waiting_queue_get():
     if os.path.isfile(roboauto_state["waiting_queue_file"]):
         nicks_waiting = file_json_read(roboauto_state["waiting_queue_file"])
@@ -629,37 +936,45 @@ def waiting_queue_print():
 
 def robot_wait(robot_name):
     """move robot to waiting queue"""
-    nicks_waiting = waiting_queue_get()
+    with roboauto_state["waiting_queue_lock"]:
+        nicks_waiting = waiting_queue_get()
 
-    if robot_name in nicks_waiting:
-        return True
+        if robot_name in nicks_waiting:
+            return True
 
-    nicks_waiting.append(robot_name)
-    print_out(robot_name + " added to waiting queue")
-    if file_json_write(roboauto_state["waiting_queue_file"], nicks_waiting) is False:
-        print_err("writing waiting queue")
-        return False
+        nicks_waiting.append(robot_name)
+        print_out(robot_name + " added to waiting queue")
+        if file_json_write(roboauto_state["waiting_queue_file"], nicks_waiting) is False:
+            print_err("writing waiting queue")
+            return False
 
     return False
 
 
 def robot_unwait(nicks_waiting, robot_name=None):
-    """remove robot or first in the list from the waiting queue"""
+    """remove robot or first in the list from the waiting queue
+    nicks_waiting is read again from disk, since when robots are
+    checked concurrently it could have been changed in the meantime"""
 
-    if robot_name is not None:
-        try:
-            nicks_waiting.remove(robot_name)
-        except ValueError:
-            print_err(f"{robot_name} is not in the waiting queue")
-            return False
-    else:
-        robot_name = nicks_waiting.pop(0)
+    with roboauto_state["waiting_queue_lock"]:
+        nicks_waiting[:] = waiting_queue_get()
 
-    if file_json_write(
-        roboauto_state["waiting_queue_file"], nicks_waiting
-    ) is False:
-        print_err("writing waiting queue")
-        return False
+        if robot_name is not None:
+            try:
+                nicks_waiting.remove(robot_name)
+            except ValueError:
+                print_err(f"{robot_name} is not in the waiting queue")
+                return False
+        else:
+            if len(nicks_waiting) < 1:
+                return False
+            robot_name = nicks_waiting.pop(0)
+
+        if file_json_write(
+            roboauto_state["waiting_queue_file"], nicks_waiting
+        ) is False:
+            print_err("writing waiting queue")
+            return False
 
     return robot_name
 
@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+
+"""storage.py"""
+
+# pylint: disable=C0116 missing-function-docstring
+
+import os
+import json
+import sqlite3
+
+from roboauto.logger import print_out, print_err
+from roboauto.global_state import roboauto_state, roboauto_options
+from roboauto.date_utils import \
+    timestamp_from_date_string, get_hour_from_date_string
+from roboauto.order_data import \
+    order_is_public, order_is_paused, order_is_waiting_taker_bond
+from roboauto.utils import \
+    json_loads, file_read, file_json_read, dir_make_sure_exists
+
+
+STORAGE_SCHEMA = """\
+CREATE TABLE IF NOT EXISTS robots (
+    name TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    coordinator TEXT NOT NULL,
+    token TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS robots_state ON robots (state);
+CREATE INDEX IF NOT EXISTS robots_coordinator ON robots (coordinator);
+CREATE TABLE IF NOT EXISTS orders (
+    robot TEXT NOT NULL,
+    order_id INTEGER NOT NULL,
+    status INTEGER,
+    expires_at INTEGER,
+    expires_hour INTEGER,
+    online INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL,
+    PRIMARY KEY (robot, order_id)
+);
+CREATE INDEX IF NOT EXISTS orders_status ON orders (status);
+CREATE INDEX IF NOT EXISTS orders_expires_at ON orders (expires_at);
+DROP TABLE IF EXISTS robot_files;
+DROP TABLE IF EXISTS waiting_queue;
+"""
+
+# last order of every robot
+STORAGE_LAST_ORDER_JOIN = """\
+LEFT JOIN orders ON orders.robot = robots.name AND orders.order_id = (
+    SELECT MAX(order_id) FROM orders WHERE orders.robot = robots.name
+)"""
+
+STORAGE_STATES = ("active", "pending", "paused", "inactive")
+
+
+def storage_is_sqlite():
+    return roboauto_options["storage_backend"] == "sqlite"
+
+
+def storage_file_get():
+    return roboauto_state["data_home"] + "/roboauto.sqlite3"
+
+
+def storage_stale_file_get():
+    return storage_file_get() + "-stale"
+
+
+def storage_backend_check():
+    """the directories are changed without updating the database while
+    the backend is files, so an existing database is marked as stale
+    and it is imported again when the backend is sqlite"""
+
+    storage_file = storage_file_get()
+    storage_stale_file = storage_stale_file_get()
+
+    if not storage_is_sqlite():
+        if os.path.isfile(storage_file) and not os.path.isfile(storage_stale_file):
+            return storage_stale_mark()
+        return True
+
+    if os.path.isfile(storage_stale_file):
+        connection = storage_connection()
+        if connection is False:
+            return False
+        if storage_stale_import(connection) is False:
+            return False
+
+    return True
+
+
+def storage_stale_mark():
+    """the database does not have the last changes of the directories,
+    it will be imported again before it is used"""
+    storage_stale_file = storage_stale_file_get()
+    try:
+        with open(storage_stale_file, "w", encoding="utf8"):
+            pass
+    except EnvironmentError:
+        print_err(f"writing {storage_stale_file}")
+        return False
+
+    return True
+
+
+def storage_stale_import(connection):
+    storage_stale_file = storage_stale_file_get()
+    if not os.path.isfile(storage_stale_file):
+        return True
+
+    with roboauto_state["storage_stale_lock"]:
+        if not os.path.isfile(storage_stale_file):
+            return True
+
+        print_out(f"{storage_file_get()} is stale, importing robots")
+        if storage_import_layout(connection) is False:
+            return False
+
+        try:
+            os.remove(storage_stale_file)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            print_err(f"removing {storage_stale_file}")
+            return False
+
+    return True
+
+
+def storage_connection():
+    """return the connection of the current thread to the database,
+    when the database is created or it is stale the current directories
+    are imported"""
+
+    storage_local = roboauto_state["storage_local"]
+
+    connection = getattr(storage_local, "connection", None)
+    if connection is not None:
+        if storage_stale_import(connection) is False:
+            return False
+        return connection
+
+    storage_file = storage_file_get()
+    storage_is_new = not os.path.isfile(storage_file)
+
+    try:
+        connection = sqlite3.connect(
+            storage_file, timeout=roboauto_state["filelock_timeout"]
+        )
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(STORAGE_SCHEMA)
+    except sqlite3.Error as e:
+        print_err(f"opening {storage_file}: {e}")
+        return False
+
+    storage_local.connection = connection
+
+    if storage_is_new:
+        print_out(f"{storage_file} created, importing robots")
+        if storage_import_layout(connection) is False:
+            return False
+        try:
+            os.remove(storage_stale_file_get())
+        except FileNotFoundError:
+            pass
+        except OSError:
+            print_err(f"removing {storage_stale_file_get()}")
+            return False
+    elif storage_stale_import(connection) is False:
+        return False
+
+    return connection
+
+
+def storage_execute(query, parameters=()):
+    """execute a query that modifies the database in a transaction,
+    return False on error, the directories are already changed so
+    the database is marked as stale"""
+
+    connection = storage_connection()
+    if connection is False:
+        storage_stale_mark()
+        return False
+
+    try:
+        with connection:
+            connection.execute(query, parameters)
+    except sqlite3.Error as e:
+        print_err(f"storage: {e}")
+        storage_stale_mark()
+        return False
+
+    return True
+
+
+def storage_query(query, parameters=()):
+    """return the rows of a query, False on error"""
+
+    connection = storage_connection()
+    if connection is False:
+        return False
+
+    try:
+        return connection.execute(query, parameters).fetchall()
+    except sqlite3.Error as e:
+        print_err(f"storage: {e}")
+        return False
+
+
+def storage_order_row(robot_name, order_id, order_dic):
+    status = None
+    expires_at = None
+    expires_hour = None
+    online = 0
+
+    order_info = order_dic.get("order_info", {})
+    order_response_json = order_dic.get("order_response_json", {})
+    if isinstance(order_info, dict):
+        status = order_info.get("status", None)
+    if isinstance(order_response_json, dict):
+        expires_at_string = order_response_json.get("expires_at", None)
+        if expires_at_string is not None:
+            expires_at = int(timestamp_from_date_string(expires_at_string))
+            expires_hour = get_hour_from_date_string(expires_at_string)
+
+    if status is not None and (
+        order_is_public(status) or
+        order_is_paused(status) or
+        order_is_waiting_taker_bond(status)
+    ):
+        online = 1
+
+    return (
+        robot_name, int(order_id), status, expires_at, expires_hour, online,
+        json.dumps(order_dic)
+    )
+
+
+def storage_robot_save(robot_name, robot_state, token, coordinator):
+    return storage_execute(
+        "INSERT OR REPLACE INTO robots (name, state, coordinator, token) " +
+        "VALUES (?, ?, ?, ?)",
+        (robot_name, robot_state, coordinator, token)
+    )
+
+
+def storage_robot_set_state(robot_name, robot_state):
+    return storage_execute(
+        "UPDATE robots SET state = ? WHERE name = ?",
+        (robot_state, robot_name)
+    )
+
+
+def storage_order_save(robot_name, order_id, order_dic):
+    return storage_execute(
+        "INSERT OR REPLACE INTO orders " +
+        "(robot, order_id, status, expires_at, expires_hour, online, data) " +
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        storage_order_row(robot_name, order_id, order_dic)
+    )
+
+
+def storage_robot_list(robot_state):
+    """return a list of robot dic with the last order in order_dic,
+    None when the robot does not have orders"""
+
+    rows = storage_query(
+        "SELECT robots.name, robots.coordinator, robots.token, orders.data " +
+        "FROM robots " + STORAGE_LAST_ORDER_JOIN + " " +
+        "WHERE robots.state = ? ORDER BY robots.name",
+        (robot_state,)
+    )
+    if rows is False:
+        return False
+
+    state_dir = roboauto_state[robot_state + "_home"]
+
+    robot_list = []
+    for robot_name, coordinator, token, order_data in rows:
+        order_dic = None
+        if order_data is not None:
+            order_dic = json_loads(order_data)
+            if order_dic is False:
+                print_err(f"{robot_name} order in storage is not json")
+                order_dic = None
+        robot_list.append({
+            "name": robot_name,
+            "state": robot_state,
+            "dir": state_dir + "/" + robot_name,
+            "token": token,
+            "coordinator": coordinator,
+            "order_dic": order_dic
+        })
+
+    return robot_list
+
+
+def storage_active_orders_this_hour(current_hour):
+    """return the number of active robots with the last order online
+    and expiring in current_hour, False on error"""
+
+    rows = storage_query(
+        "SELECT COUNT(*) FROM robots " + STORAGE_LAST_ORDER_JOIN + " " +
+        "WHERE robots.state = 'active' AND orders.online = 1 " +
+        "AND orders.expires_hour = ?",
+        (current_hour,)
+    )
+    if rows is False:
+        return False
+
+    return rows[0][0]
+
+
+def storage_active_orders_expires_at():
+    """return the expiry timestamps of the active robots with
+    the last order online, False on error"""
+
+    rows = storage_query(
+        "SELECT orders.expires_at FROM robots " + STORAGE_LAST_ORDER_JOIN + " " +
+        "WHERE robots.state = 'active' AND orders.online = 1"
+    )
+    if rows is False:
+        return False
+
+    return [row[0] for row in rows]
+
+
+def storage_robot_dir_files(robot_dir):
+    """return a list of (name, content) of the files of the robot
+    directory, orders excluded"""
+
+    robot_files = []
+    for dir_path, dir_names, file_names in os.walk(robot_dir):
+        if dir_path == robot_dir and "orders" in dir_names:
+            dir_names.remove("orders")
+        for file_name in file_names:
+            file_path = dir_path + "/" + file_name
+            try:
+                with open(file_path, "r", encoding="utf8") as file:
+                    content = file.read()
+            except (EnvironmentError, UnicodeDecodeError):
+                print_err(f"reading {file_path}")
+                continue
+            robot_files.append((os.path.relpath(file_path, robot_dir), content))
+
+    return robot_files
+
+
+def storage_import_layout(connection):
+    """replace the content of the database with the robots in the
+    data directories"""
+
+    robot_rows = []
+    order_rows = []
+
+    for robot_state in STORAGE_STATES:
+        state_dir = roboauto_state[robot_state + "_home"]
+        for robot_name in sorted(os.listdir(state_dir)):
+            robot_dir = state_dir + "/" + robot_name
+            if not os.path.isdir(robot_dir):
+                continue
+
+            token = file_read(robot_dir + "/token", error_print=False)
+            coordinator = file_read(robot_dir + "/coordinator", error_print=False)
+            if token is False or coordinator is False:
+                print_err(f"{robot_name} does not have token and coordinator, skipping")
+                continue
+            robot_rows.append((robot_name, robot_state, coordinator, token))
+
+            orders_dir = robot_dir + "/orders"
+            if os.path.isdir(orders_dir):
+                for order_id in os.listdir(orders_dir):
+                    if not order_id.isdigit():
+                        continue
+                    order_dic = file_json_read(orders_dir + "/" + order_id)
+                    if order_dic is False or not isinstance(order_dic, dict):
+                        print_err(f"{robot_name} reading order {order_id}, skipping")
+                        continue
+                    order_rows.append(storage_order_row(robot_name, order_id, order_dic))
+
+    try:
+        with connection:
+            for table in ("robots", "orders"):
+                connection.execute(f"DELETE FROM {table}")
+            connection.executemany(
+                "INSERT INTO robots (name, state, coordinator, token) " +
+                "VALUES (?, ?, ?, ?)",
+                robot_rows
+            )
+            connection.executemany(
+                "INSERT INTO orders " +
+                "(robot, order_id, status, expires_at, expires_hour, online, data) " +
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                order_rows
+            )
+    except sqlite3.Error as e:
+        print_err(f"storage: {e}")
+        return False
+
+    print_out(
+        f"imported {len(robot_rows)} robots and {len(order_rows)} orders",
+        date=False
+    )
+
+    return True
+
+
+def storage_export_layout(connection, export_dir):
+    """write the robots in the database in export_dir with the same
+    layout of the data directory, the other files of the robots, like
+    the chats, and the waiting queue are not kept in the database and
+    are copied from the data directory"""
+
+    try:
+        robot_rows = connection.execute(
+            "SELECT name, state, coordinator, token FROM robots"
+        ).fetchall()
+        order_rows = connection.execute(
+            "SELECT robot, order_id, data FROM orders"
+        ).fetchall()
+    except sqlite3.Error as e:
+        print_err(f"storage: {e}")
+        return False
+
+    robot_dirs = {}
+    file_rows = []
+    for robot_name, robot_state, coordinator, token in robot_rows:
+        robot_dir = export_dir + "/" + robot_state + "/" + robot_name
+        robot_dirs[robot_name] = robot_dir
+        if not dir_make_sure_exists(robot_dir):
+            return False
+
+        data_robot_dir = roboauto_state[robot_state + "_home"] + "/" + robot_name
+        for file_name, content in storage_robot_dir_files(data_robot_dir):
+            file_rows.append((robot_name, file_name, content))
+
+    nicks_waiting = []
+    if os.path.isfile(roboauto_state["waiting_queue_file"]):
+        nicks_waiting = file_json_read(roboauto_state["waiting_queue_file"])
+        if nicks_waiting is False:
+            print_err("reading waiting queue")
+            return False
+
+    try:
+        for robot_name, file_name, content in file_rows:
+            file_path = robot_dirs[robot_name] + "/" + file_name
+            if not dir_make_sure_exists(os.path.dirname(file_path)):
+                return False
+            with open(file_path, "w", encoding="utf8") as file:
+                file.write(content)
+
+        # token, coordinator and orders are always the current ones
+        for robot_name, robot_state, coordinator, token in robot_rows:
+            for file_name, content in (("token", token), ("coordinator", coordinator)):
+                with open(robot_dirs[robot_name] + "/" + file_name, "w", encoding="utf8") as file:
+                    file.write(content + "\n")
+
+        for robot_name, order_id, order_data in order_rows:
+            if robot_name not in robot_dirs:
+                continue
+            orders_dir = robot_dirs[robot_name] + "/orders"
+            if not dir_make_sure_exists(orders_dir):
+                return False
+            with open(orders_dir + "/" + str(order_id), "w", encoding="utf8") as file:
+                json.dump(
+                    json.loads(order_data), file, indent=roboauto_options["tab_size"]
+                )
+                file.write("\n")
+
+        with open(export_dir + "/waiting-queue", "w", encoding="utf8") as file:
+            json.dump(nicks_waiting, file, indent=roboauto_options["tab_size"])
+            file.write("\n")
+    except EnvironmentError:
+        print_err(f"writing to {export_dir}")
+        return False
+
+    print_out(
+        f"exported {len(robot_rows)} robots and {len(order_rows)} orders",
+        date=False
+    )
+
+    return True
+
+
+def storage_import(argv):
+    if len(argv) > 0:
+        print_err(f"option {argv[0]} not recognized")
+        return False
+
+    connection = storage_connection()
+    if connection is False:
+        return False
+
+    if storage_import_layout(connection) is False:
+        return False
+
+    try:
+        os.remove(storage_stale_file_get())
+    except FileNotFoundError:
+        pass
+    except OSError:
+        print_err(f"removing {storage_stale_file_get()}")
+        return False
+
+    return True
+
+
+def storage_export(argv):
+    if len(argv) < 1:
+        print_err("insert export directory")
+        return False
+    export_dir = argv[0]
+    argv = argv[1:]
+
+    if os.path.exists(export_dir):
+        if not os.path.isdir(export_dir):
+            print_err(f"{export_dir} is not a directory")
+            return False
+        if len(os.listdir(export_dir)) > 0:
+            print_err(f"{export_dir} is not empty")
+            return False
+
+    if not os.path.isfile(storage_file_get()):
+        print_err(f"{storage_file_get()} does not exist")
+        return False
+
+    connection = storage_connection()
+    if connection is False:
+        return False
+
+    return storage_export_layout(connection, export_dir)
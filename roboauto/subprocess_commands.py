@@ -6,13 +6,18 @@
 
 import os
 import time
+import json
 import subprocess
 import select
 import signal
+import threading
+import itertools
 
 from roboauto.global_state import roboauto_state, roboauto_options
-from roboauto.logger import print_out, print_err
-from roboauto.utils import file_is_executable, json_dumps, get_uint
+from roboauto.logger import \
+    print_out, print_err, logger_context_set, logger_context_clear
+from roboauto.utils import file_is_executable, json_dumps, get_uint, json_loads
+from roboauto.metrics import metrics_observe, metrics_increment
 
 
 def subprocess_run_command(program, error_print=True):
@@ -30,6 +35,167 @@ def subprocess_run_command(program, error_print=True):
     return process.stdout
 
 
+def lightning_node_worker_read(worker):
+    """read the responses of the worker and wake up the requests
+    waiting for them, when the worker ends the requests still
+    waiting get False"""
+    for response_line in worker["process"].stdout:
+        response = json_loads(response_line)
+        if not isinstance(response, dict) or "id" not in response:
+            print_err("lightning-node worker response is not valid")
+            continue
+
+        with worker["lock"]:
+            request = worker["pending"].pop(response["id"], None)
+        if request is None:
+            print_err(f"lightning-node worker response to unknown request {response['id']}")
+            continue
+
+        request["response"] = response
+        request["event"].set()
+
+    with worker["lock"]:
+        worker["running"] = False
+        for request in worker["pending"].values():
+            request["response"] = False
+            request["event"].set()
+        worker["pending"].clear()
+
+    with roboauto_state["lightning_node_worker_lock"]:
+        if roboauto_state["lightning_node_worker_handle"] is worker:
+            roboauto_state["lightning_node_worker_handle"] = None
+
+
+def lightning_node_worker_get():
+    """start lightning-node worker if it is not running, return None
+    if it can not be started"""
+    with roboauto_state["lightning_node_worker_lock"]:
+        worker = roboauto_state["lightning_node_worker_handle"]
+        if isinstance(worker, dict):
+            return worker
+
+        try:
+            # pylint: disable=R1732 consider-using-with
+            process = subprocess.Popen(
+                [roboauto_state["lightning_node_command"], "worker"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                start_new_session=True, text=True, bufsize=1
+            )
+        except OSError:
+            print_err("starting lightning-node worker")
+            return None
+
+        worker = {
+            "process": process,
+            "running": True,
+            "pending": {},
+            "counter": itertools.count(1),
+            "lock": threading.Lock()
+        }
+        threading.Thread(
+            target=lightning_node_worker_read, args=(worker,),
+            name="lightning-node-worker", daemon=True
+        ).start()
+
+        roboauto_state["lightning_node_worker_handle"] = worker
+
+        return worker
+
+
+def lightning_node_worker_request(action, args):
+    """send a request to lightning-node worker and wait for the response,
+    return None if the request could not be sent, so that it can be
+    run in argv mode, False if it was sent but it failed"""
+    worker = lightning_node_worker_get()
+    if worker is None:
+        return None
+
+    request = {
+        "event": threading.Event(),
+        "response": None
+    }
+    with worker["lock"]:
+        if not worker["running"]:
+            return None
+        request_id = next(worker["counter"])
+        worker["pending"][request_id] = request
+        try:
+            worker["process"].stdin.write(json.dumps({
+                "id": request_id,
+                "action": action,
+                "args": args
+            }) + "\n")
+            worker["process"].stdin.flush()
+        except OSError:
+            worker["pending"].pop(request_id, None)
+            return None
+
+    timeout = roboauto_options["requests_timeout"]
+    if not request["event"].wait(timeout=timeout):
+        with worker["lock"]:
+            worker["pending"].pop(request_id, None)
+        print_err(f"lightning-node worker {action} timeout {timeout}")
+        return False
+
+    return request["response"]
+
+
+def lightning_node_run(action, args, error_print=True):
+    """run a lightning-node action, with lightning_node_worker set in
+    the config the request is sent to the running worker, otherwise or
+    if the worker is not available lightning-node is run with the
+    action as argument, return the output of the action"""
+    starting_time = time.monotonic()
+
+    output = lightning_node_run_action(action, args, error_print=error_print)
+
+    metrics_observe(
+        "lightning_node_seconds", time.monotonic() - starting_time,
+        labels={"action": action}
+    )
+    if output is False:
+        metrics_increment("lightning_node_errors_total", labels={"action": action})
+
+    return output
+
+
+def lightning_node_worker_error_get(response):
+    """error of a failed worker response, workers that do not send
+    the standard error of the action have it in the output"""
+    error_string = str(response.get("error", "")).strip()
+    if error_string == "":
+        error_string = str(response.get("output", "")).strip()
+
+    return error_string
+
+
+def lightning_node_run_action(action, args, error_print=True):
+    if roboauto_options["lightning_node_worker"] is True:
+        response = lightning_node_worker_request(action, args)
+        if response is False:
+            return False
+        if isinstance(response, dict):
+            if response.get("ok", False) is not True:
+                if error_print:
+                    error_string = lightning_node_worker_error_get(response)
+                    if error_string:
+                        print_err(error_string, error=False, date=False)
+                return False
+
+            # same output as when run with arguments
+            output = str(response.get("output", ""))
+            if output != "" and not output.endswith("\n"):
+                output += "\n"
+            return output
+
+        print_err(f"lightning-node worker not available, running lightning-node {action}")
+
+    return subprocess_run_command(
+        [roboauto_state["lightning_node_command"], action] + args,
+        error_print=error_print
+    )
+
+
 def message_notification_send(event, message):
     if not file_is_executable(roboauto_state["message_notification_command"]):
         print_err("message notification command not found, no messages will be sent")
@@ -47,10 +213,9 @@ def message_notification_send(event, message):
 
 
 def subprocess_generate_invoice(invoice_amout, invoice_label):
-    invoice_generate_output = subprocess_run_command([
-        roboauto_state["lightning_node_command"], "invoice",
-        invoice_amout, invoice_label
-    ])
+    invoice_generate_output = lightning_node_run(
+        "invoice", [invoice_amout, invoice_label]
+    )
     if invoice_generate_output is False:
         print_err("generating the invoice")
         return False
@@ -91,20 +256,211 @@ def subprocess_kill(process):
     return True
 
 
+def subprocess_pay_stop(job):
+    """stop the payment, pay_subprocess is None when the payment was
+    started by lightning-node worker, in that case the group of the
+    pay process is killed, or just the pay process when the worker
+    does not start it in its own group"""
+    if job["pay_subprocess"] is not None:
+        return subprocess_kill(job["pay_subprocess"])
+
+    try:
+        if job["pay_pgid"] is not None:
+            os.killpg(job["pay_pgid"], signal.SIGTERM)
+        else:
+            os.kill(job["pay_pid"], signal.SIGTERM)
+    except OSError:
+        pass
+
+    return True
+
+
+def subprocess_pay_log_print(job):
+    """print and remove the standard error of a payment started by
+    lightning-node worker"""
+    pay_log = job["pay_log"]
+    if pay_log is None:
+        return True
+    job["pay_log"] = None
+
+    try:
+        with open(pay_log, "r", encoding="utf8") as pay_log_file:
+            pay_stderr = pay_log_file.read()
+        os.remove(pay_log)
+    except (EnvironmentError, UnicodeDecodeError):
+        print_err(f"reading pay log {pay_log}")
+        return False
+
+    print_err(pay_stderr, end="", date=False, error=False)
+
+    return True
+
+
+def pay_job_get(robot_name):
+    """return the payment job of the robot, None if it is not paying"""
+    with roboauto_state["pay_jobs_lock"]:
+        return roboauto_state["pay_jobs"].get(robot_name, None)
+
+
+def pay_jobs_count(job_type=None):
+    with roboauto_state["pay_jobs_lock"]:
+        return sum(
+            1 for job in roboauto_state["pay_jobs"].values()
+            if job_type is None or job["type"] == job_type
+        )
+
+
+def pay_jobs_wait():
+    """return the seconds before a payment job has to be checked,
+    None if there are no payment jobs"""
+    with roboauto_state["pay_jobs_lock"]:
+        next_checks = [
+            job["next_check"] for job in roboauto_state["pay_jobs"].values()
+        ]
+
+    if len(next_checks) < 1:
+        return None
+
+    return max(0, min(next_checks) - time.time())
+
+
+def pay_jobs_check():
+    """check the order of the payment jobs that have to be checked,
+    jobs that are finished are removed and their completion function
+    is called, return the number of finished jobs"""
+    current_time = time.time()
+    with roboauto_state["pay_jobs_lock"]:
+        jobs_due = [
+            job for job in roboauto_state["pay_jobs"].values()
+            if job["next_check"] <= current_time
+        ]
+
+    jobs_finished = 0
+    for job in jobs_due:
+        logger_context_set(
+            job["robot_dic"]["name"], job["robot_dic"]["coordinator"], job["order_id"]
+        )
+        try:
+            job_output = subprocess_pay_job_step(job)
+            if job_output is None:
+                job["next_check"] = time.time() + roboauto_options["pay_interval"]
+                continue
+
+            with roboauto_state["pay_jobs_lock"]:
+                roboauto_state["pay_jobs"].pop(job["robot_dic"]["name"], None)
+            subprocess_pay_job_close(job)
+            subprocess_pay_job_complete(job, job_output)
+            jobs_finished += 1
+        finally:
+            logger_context_clear()
+
+    return jobs_finished
+
+
+def subprocess_pay_start(invoice, pay_label):
+    """start paying the invoice, return the pay subprocess, the pid
+    of the payment, its process group and the file with its standard
+    error, the subprocess is None when the payment was started by
+    lightning-node worker, the group and the file are used just with
+    the worker, False if the payment was not started"""
+    if roboauto_options["lightning_node_worker"] is True:
+        pay_response = lightning_node_worker_request("pay", [invoice, pay_label])
+        if pay_response is False:
+            return False
+        if isinstance(pay_response, dict):
+            if pay_response.get("ok", False) is not True:
+                error_string = lightning_node_worker_error_get(pay_response)
+                if error_string:
+                    print_err(error_string, error=False, date=False)
+                print_err("lightning-node worker pay failed")
+                return False
+            pay_log = pay_response.get("log", None)
+            if not isinstance(pay_log, str) or pay_log == "":
+                pay_log = None
+            pay_pid = get_uint(str(pay_response.get("output", "")).strip())
+            if pay_pid is False:
+                print_err("pay command did not return a pid")
+                return False
+
+            # the worker starts the payment in its own group, when the
+            # group is the one of the worker just the payment is killed
+            worker = roboauto_state["lightning_node_worker_handle"]
+            worker_pid = None
+            if isinstance(worker, dict):
+                worker_pid = worker["process"].pid
+            try:
+                pay_pgid = os.getpgid(pay_pid)
+            except OSError:
+                pay_pgid = None
+            if pay_pgid == worker_pid:
+                pay_pgid = None
+
+            return None, pay_pid, pay_pgid, pay_log
+
+        print_err("lightning-node worker not available, running lightning-node pay")
+
+    pay_command = [
+        roboauto_state["lightning_node_command"], "pay",
+        invoice, pay_label
+    ]
+
+    # pylint: disable=R1732 consider-using-with
+    pay_subprocess = subprocess.Popen(
+        pay_command,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        start_new_session=True, text=True
+    )
+    read_line = subprocess_readline_with_timeout(pay_subprocess, 4)
+    if read_line is None or read_line is False:
+        if read_line is None:
+            print_err(
+                "process read timeout, check lightning node script, " +
+                "it should print out the subprocess pid"
+            )
+        subprocess_kill(pay_subprocess)
+        subprocess_close(pay_subprocess)
+        return False
+    pay_pid = get_uint(read_line.strip())
+    if pay_pid is False:
+        print_err("pay command did not return a pid")
+        subprocess_kill(pay_subprocess)
+        subprocess_close(pay_subprocess)
+        return False
+
+    return pay_subprocess, pay_pid, None, None
+
+
+def subprocess_close(process):
+    """close the pipes of the process and wait for it to end"""
+    for process_file in (process.stdout, process.stderr):
+        if process_file is not None:
+            process_file.close()
+
+    try:
+        process.wait(timeout=4)
+    except subprocess.TimeoutExpired:
+        pass
+
+
 def subprocess_pay_invoice_and_check(
     robot_dic, order_id,
     invoice, amount_satoshis_string,
     pay_label, is_paid_function,
     string_checking, string_paid, string_not_paid,
     order_dic_function, failure_function,
-    maximum_retries=None
+    maximum_retries=None,
+    completion_function=None,
+    job_type="pay",
+    background=False
 ):
+    """check and pay the invoice, then check the order until it is paid
+    completion_function is called with the order_dic, or False if the
+    invoice was not paid, and its output is returned
+    if background is True, return True after the payment is started
+    and leave the checks of the order to pay_jobs_check"""
     robot_name = robot_dic["name"]
 
-    check_output = subprocess_run_command([
-        roboauto_state["lightning_node_command"], "check",
-        invoice, amount_satoshis_string
-    ])
+    check_output = lightning_node_run("check", [invoice, amount_satoshis_string])
     if check_output is False:
         print_err(
             "lightning-node check returned false, invoice will not be paid"
@@ -113,82 +469,137 @@ def subprocess_pay_invoice_and_check(
     print_out(check_output, end="", date=False)
     print_out("invoice checked successfully")
 
-    pay_command = [
-        roboauto_state["lightning_node_command"], "pay",
-        invoice, pay_label
-    ]
+    starting_time = time.monotonic()
+    pay_started = subprocess_pay_start(invoice, pay_label)
+    metrics_observe(
+        "lightning_node_seconds", time.monotonic() - starting_time,
+        labels={"action": "pay"}
+    )
+    if pay_started is False:
+        metrics_increment("lightning_node_errors_total", labels={"action": "pay"})
+        return False
+    pay_subprocess, pay_pid, pay_pgid, pay_log = pay_started
+
+    job = {
+        "type": job_type,
+        "pay_subprocess": pay_subprocess,
+        "pay_pid": pay_pid,
+        "pay_pgid": pay_pgid,
+        "pay_log": pay_log,
+        "robot_dic": robot_dic,
+        "order_id": order_id,
+        "is_paid_function": is_paid_function,
+        "string_checking": string_checking,
+        "string_paid": string_paid,
+        "string_not_paid": string_not_paid,
+        "order_dic_function": order_dic_function,
+        "failure_function": failure_function,
+        "maximum_retries": maximum_retries,
+        "completion_function": completion_function,
+        "subprocess_running": True,
+        "retries_total": 0,
+        "retries_after_failed": 0,
+        "next_check": time.time()
+    }
+
+    if background is True:
+        with roboauto_state["pay_jobs_lock"]:
+            roboauto_state["pay_jobs"][robot_name] = job
+        print_out(f"{robot_name} {order_id} {job_type} started, checking in background")
+        return True
 
-    subprocess_running = True
-    retries_total = 0
-    retries_after_failed = 0
-    with subprocess.Popen(
-        pay_command,
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-        start_new_session=True, text=True
-    ) as pay_subprocess:
-        read_line = subprocess_readline_with_timeout(pay_subprocess, 4)
-        if read_line is None or read_line is False:
-            if read_line is None:
-                print_err(
-                    "process read timeout, check lightning node script, " +
-                    "it should print out the subprocess pid"
-                )
-            subprocess_kill(pay_subprocess)
-            return False
-        pay_pid = get_uint(read_line.strip())
-        if pay_pid is False:
-            print_err("pay command did not return a pid")
-            subprocess_kill(pay_subprocess)
+    try:
+        while True:
+            job_output = subprocess_pay_job_step(job)
+            if job_output is not None:
+                break
+            time.sleep(roboauto_options["pay_interval"])
+    finally:
+        subprocess_pay_job_close(job)
+
+    return subprocess_pay_job_complete(job, job_output)
+
+
+def subprocess_pay_job_close(job):
+    if job["pay_subprocess"] is not None:
+        subprocess_close(job["pay_subprocess"])
+    subprocess_pay_log_print(job)
+
+
+def subprocess_pay_job_complete(job, job_output):
+    metrics_increment("payments_total", labels={
+        "type": job["type"],
+        "result": "failed" if job_output is False else "paid"
+    })
+
+    if job["completion_function"] is None:
+        return job_output
+
+    return job["completion_function"](job_output)
+
+
+def subprocess_pay_job_step(job):
+    """check once the order of the payment job, return None if the
+    invoice is not paid yet, the order_dic when it is paid and False
+    when the payment failed"""
+    pay_subprocess = job["pay_subprocess"]
+    pay_pid = job["pay_pid"]
+    robot_dic = job["robot_dic"]
+    order_id = job["order_id"]
+    maximum_retries = job["maximum_retries"]
+
+    robot_name = robot_dic["name"]
+
+    if job["subprocess_running"]:
+        try:
+            os.kill(pay_pid, 0)
+        except OSError:
+            if pay_subprocess is not None:
+                _, stderr = pay_subprocess.communicate()
+                print_err(stderr, end="", date=False, error=False)
+            else:
+                subprocess_pay_log_print(job)
+            print_err("pay subprocess ended")
+            job["subprocess_running"] = False
+    if not job["subprocess_running"]:
+        maximum_retries_after_failed = 4
+        if job["retries_after_failed"] >= maximum_retries_after_failed:
+            print_err("maximum retries after pay command failed")
+            subprocess_pay_stop(job)
             return False
+        job["retries_after_failed"] += 1
 
-        while True:
-            if subprocess_running:
-                try:
-                    os.kill(pay_pid, 0)
-                except OSError:
-                    _, stderr = pay_subprocess.communicate()
-                    print_err(stderr, end="", date=False, error=False)
-                    print_err("pay subprocess ended")
-                    subprocess_running = False
-            if not subprocess_running:
-                maximum_retries_after_failed = 4
-                if retries_after_failed >= maximum_retries_after_failed:
-                    print_err("maximum retries after pay command failed")
-                    subprocess_kill(pay_subprocess)
-                    return False
-                retries_after_failed += 1
-
-            if maximum_retries is not None and retries_total > maximum_retries:
-                print_err("maximum retries occured for pay command")
-                subprocess_kill(pay_subprocess)
-                return False
-            retries_total += 1
+    if maximum_retries is not None and job["retries_total"] > maximum_retries:
+        print_err("maximum retries occured for pay command")
+        subprocess_pay_stop(job)
+        return False
+    job["retries_total"] += 1
 
-            print_out(string_checking)
+    print_out(job["string_checking"])
 
-            order_dic = order_dic_function(robot_dic, order_id)
-            if order_dic is False or order_dic is None or isinstance(order_dic, str):
-                subprocess_kill(pay_subprocess)
-                return False
+    order_dic = job["order_dic_function"](robot_dic, order_id)
+    if order_dic is False or order_dic is None or isinstance(order_dic, str):
+        subprocess_pay_stop(job)
+        return False
 
-            order_response_json = order_dic["order_response_json"]
+    order_response_json = order_dic["order_response_json"]
 
-            order_status = order_response_json.get("status", False)
-            if order_status is False:
-                print_err(json_dumps(order_response_json), error=False, date=False)
-                print_err(f"getting order_status of {robot_name} {order_id}")
-                subprocess_kill(pay_subprocess)
-                return False
+    order_status = order_response_json.get("status", False)
+    if order_status is False:
+        print_err(json_dumps(order_response_json), error=False, date=False)
+        print_err(f"getting order_status of {robot_name} {order_id}")
+        subprocess_pay_stop(job)
+        return False
 
-            if is_paid_function(order_status):
-                if not failure_function(order_status):
-                    print_out(robot_name + " " + string_paid)
-                    return_output = order_dic
-                else:
-                    print_err(robot_name + " " + string_not_paid)
-                    return_output = False
+    if job["is_paid_function"](order_status):
+        if not job["failure_function"](order_status):
+            print_out(robot_name + " " + job["string_paid"])
+            job_output = order_dic
+        else:
+            print_err(robot_name + " " + job["string_not_paid"])
+            job_output = False
 
-                subprocess_kill(pay_subprocess)
-                return return_output
+        subprocess_pay_stop(job)
+        return job_output
 
-            time.sleep(roboauto_options["pay_interval"])
+    return None
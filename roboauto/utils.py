@@ -7,6 +7,7 @@
 
 import os
 import re
+import stat
 import getpass
 import json
 import configparser
@@ -14,8 +15,10 @@ import random
 import secrets
 import hashlib
 import struct
+import functools
 
-from roboauto.logger import print_out, print_err
+from roboauto.logger import print_out, print_err, logger_close
+from roboauto.dir_watch import dir_watch_stop
 from roboauto.global_state import roboauto_options, roboauto_state
 
 
@@ -205,6 +208,7 @@ def update_single_option(name, new_value, print_info=False):
     if roboauto_options[name] != new_value:
         old_value = roboauto_options[name]
         roboauto_options[name] = new_value
+        roboauto_state["config_changed"].add(name)
         if print_info:
             print_out(
                 "option %s changed from %s to %s" %
@@ -221,12 +225,58 @@ def get_file_hash(filename):
         return None
 
 
+def config_file_stat_get(file_name):
+    """mtime, size and inode of the file, None if it is not a file"""
+    try:
+        file_stat = os.stat(file_name)
+    except OSError:
+        return None
+
+    if not stat.S_ISREG(file_stat.st_mode):
+        return None
+
+    return file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino
+
+
+def config_callback_add(options, function):
+    """call function after a reload of the config changes one of
+    options, federation is used for changes of the coordinators"""
+    roboauto_state["config_callbacks"].append((frozenset(options), function))
+
+
+def config_callbacks_run():
+    config_changed = roboauto_state["config_changed"]
+    roboauto_state["config_changed"] = set()
+
+    if len(config_changed) < 1:
+        return True
+
+    for options, function in roboauto_state["config_callbacks"]:
+        if options & config_changed:
+            function()
+
+    return True
+
+
+def config_reload_signal_handler(signum, frame):
+    """reload the config file at the next update, even if it did not
+    change on disk"""
+    # pylint: disable=W0613 unused-argument
+    roboauto_state["config_reload_requested"] = True
+
+
 def update_roboauto_options(is_update=False):
+    """read the config file, it is parsed again just when its mtime,
+    size or inode changed and its content is different, or after
+    SIGHUP, then the callbacks of the changed options are called"""
+
     # pylint: disable=R1702 too-many-nested-blocks
 
     print_info=is_update
 
-    if not os.path.isfile(roboauto_state["config_file"]):
+    config_file_stat = config_file_stat_get(roboauto_state["config_file"])
+    if config_file_stat is None:
+        roboauto_state["config_file_stat"] = None
         if roboauto_state["config_file_hash"] is not None:
             roboauto_state["config_file_hash"] = None
             if print_info:
@@ -237,9 +287,18 @@ def update_roboauto_options(is_update=False):
             if print_info:
                 print_out("config file present")
 
+    reload_requested = roboauto_state["config_reload_requested"]
+    if config_file_stat == roboauto_state["config_file_stat"] and not reload_requested:
+        return True
+    roboauto_state["config_file_stat"] = config_file_stat
+    roboauto_state["config_reload_requested"] = False
+
     new_config_file_hash = get_file_hash(roboauto_state["config_file"])
     if new_config_file_hash != roboauto_state["config_file_hash"]:
         roboauto_state["config_file_hash"] = new_config_file_hash
+    elif reload_requested:
+        if print_info:
+            print_out("reloading config file")
     else:
         return True
 
@@ -270,17 +329,40 @@ def update_roboauto_options(is_update=False):
                 new_value = parser.get(general_section, option).strip("'\"")
                 update_single_option(option, new_value, print_info=print_info)
 
+        option = "storage_backend"
+        if parser.has_option(general_section, option):
+            new_value = parser.get(general_section, option).strip("'\"")
+            if new_value not in ("files", "sqlite"):
+                print_err(f"{option} should be files or sqlite")
+                return False
+            update_single_option(option, new_value, print_info=print_info)
+
         option = "create_new_after_maximum_orders"
         if parser.has_option(general_section, option):
             new_value = parser.getboolean(general_section, option)
             update_single_option(option, new_value, print_info=print_info)
 
+        option = "lightning_node_worker"
+        if parser.has_option(general_section, option):
+            new_value = parser.getboolean(general_section, option)
+            update_single_option(option, new_value, print_info=print_info)
+
+        option = "log_json"
+        if parser.has_option(general_section, option):
+            new_value = parser.getboolean(general_section, option)
+            update_single_option(option, new_value, print_info=print_info)
+
         for option in (
             "tor_port", "seconds_pending_order", "order_maximum", "robot_maximum_orders",
             "log_level_waiting_for_taker_bond", "tab_size", "routing_budget_ppm",
             "requests_timeout", "orders_timeout", "active_interval",
-            "pending_interval", "pay_interval", "error_interval",
-            "default_duration", "default_escrow"
+            "pending_interval", "urgent_interval", "pay_interval", "error_interval",
+            "circuit_breaker_failures", "circuit_breaker_timeout",
+            "default_duration", "default_escrow",
+            "keep_online_concurrency", "keep_online_coordinator_concurrency",
+            "recreate_concurrency",
+            "book_cache_ttl", "robot_pool_size", "metrics_port",
+            "log_rotate_size", "log_rotate_hours", "log_rotate_keep"
         ):
             if parser.has_option(general_section, option):
                 try:
@@ -347,6 +429,7 @@ def update_roboauto_options(is_update=False):
                     new_value = coord_dict[key]
                     if old_value != new_value:
                         roboauto_options["federation"][coord_name][key] = new_value
+                        roboauto_state["config_changed"].add("federation")
                         if print_info:
                             print_out(
                                 f"{coord_name} {key} changed from {old_value} to {new_value}"
@@ -355,6 +438,7 @@ def update_roboauto_options(is_update=False):
                 if print_info:
                     print_out(f"{coord_name} added as new coordinator")
                 roboauto_options["federation"].update({coord_name: coord_dict})
+                roboauto_state["config_changed"].add("federation")
                 for key in federation_section_options:
                     value = coord_dict[key]
                     if print_info:
@@ -368,10 +452,11 @@ def update_roboauto_options(is_update=False):
     for coord_name in list(roboauto_options["federation"]):
         if coord_name not in new_coordinator_list:
             del roboauto_options["federation"][coord_name]
+            roboauto_state["config_changed"].add("federation")
             if print_info:
                 print_out(f"coordinator {coord_name} removed")
 
-    return True
+    return config_callbacks_run()
 
 
 def global_setup(config_dir=None, data_dir=None):
@@ -410,6 +495,7 @@ def global_setup(config_dir=None, data_dir=None):
     roboauto_state["inactive_home"] = roboauto_home + "/inactive"
     roboauto_state["paused_home"] = roboauto_home + "/paused"
     roboauto_state["coordinators_home"] = roboauto_home + "/coordinators"
+    roboauto_state["pool_home"] = roboauto_home + "/pool"
     roboauto_state["lock_home"] = roboauto_home + "/lock"
     roboauto_state["gnupg_home"] = roboauto_home + "/gnupg"
     roboauto_state["log_home"] = roboauto_home + "/logs"
@@ -426,6 +512,7 @@ def global_setup(config_dir=None, data_dir=None):
         roboauto_state["pending_home"],
         roboauto_state["inactive_home"],
         roboauto_state["coordinators_home"],
+        roboauto_state["pool_home"],
         roboauto_state["paused_home"],
         roboauto_state["lock_home"],
         roboauto_state["gnupg_home"],
@@ -449,8 +536,42 @@ def global_setup(config_dir=None, data_dir=None):
 
 
 def global_shutdown():
-    if roboauto_state["logger"] is not None:
-        roboauto_state["logger"].close()
+    lightning_node_worker = roboauto_state["lightning_node_worker_handle"]
+    if isinstance(lightning_node_worker, dict):
+        # lightning-node worker ends when its input is closed
+        try:
+            lightning_node_worker["process"].stdin.close()
+        except OSError:
+            pass
+
+    with roboauto_state["requests_sessions_lock"]:
+        for session_entry in roboauto_state["requests_sessions"].values():
+            session_entry["session"].close()
+        roboauto_state["requests_sessions"].clear()
+
+    # other processes will use the file locks just while this is running
+    requests_process_file = roboauto_state["requests_process_file"]
+    if isinstance(requests_process_file, str):
+        try:
+            os.remove(requests_process_file)
+        except OSError:
+            pass
+        roboauto_state["requests_process_file"] = None
+    requests_processes_fd = roboauto_state["requests_processes_fd"]
+    if requests_processes_fd is not None:
+        try:
+            os.close(requests_processes_fd)
+        except OSError:
+            pass
+        roboauto_state["requests_processes_fd"] = None
+
+    dir_watch_stop()
+
+    storage_connection = getattr(roboauto_state["storage_local"], "connection", None)
+    if storage_connection is not None:
+        storage_connection.close()
+
+    logger_close()
 
 
 def state_set_command_type(command_type):
@@ -697,6 +818,7 @@ def base91_encode(bindata):
     return out
 
 
+@functools.lru_cache(maxsize=4096)
 def token_get_base91(token_string):
     return base91_encode(hashlib.sha256(token_string.encode("utf-8")).digest())
 